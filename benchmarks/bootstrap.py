@@ -0,0 +1,85 @@
+# Runs the Authentik bootstrap against the fake Authentik (and a fake Synapse), reporting the time taken and the
+# peak Python memory for each directory size. Peak memory should stay flat as the directory grows.
+# Usage: python -m benchmarks.bootstrap [--sizes 1000 5000 20000] [--latency 0.02] [--prefetch 1 4]
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+
+os.environ.setdefault("AUTHENTIK_API_URL", "http://authentik.invalid")
+os.environ.setdefault("AUTHENTIK_TOKEN", "benchmark")
+os.environ.setdefault("IDP_GROUP_TO_ROOM", '{"group-0": ["!room:example.com"]}')
+os.environ.setdefault("SYNAPSE_RATE_LIMIT", "0")
+os.environ.setdefault("COALESCE_WINDOW", "0")
+# Keep the (bounded) account cache small, so it doesn't hide how memory grows with the directory size
+os.environ.setdefault("ACCOUNT_CACHE_SIZE", "1000")
+
+import httpx
+
+import bootstrap
+from benchmarks import fake_authentik
+from synapse import synapse_admin
+from synapse.account_cache import account_id_cache
+from synapse.coalesce import known_membership
+from utilities import authentik, database, jobs
+
+# Users per group, so the mapped group (and its joins) stays the same size whatever the directory size
+USERS_PER_GROUP = 100
+
+
+def fake_synapse(request: httpx.Request):
+    path = request.url.path
+    if "/auth_providers/" in path:
+        return httpx.Response(404, json={"errcode": "M_NOT_FOUND"})
+    if path.endswith("/joined_rooms"):
+        return httpx.Response(200, json={"joined_rooms": ["!room:example.com"]})
+    if "m.room.power_levels" in path:
+        return httpx.Response(200, json={"users": {os.environ["MATRIX_ADMIN_USER_ID"]: 100}})
+    if path.endswith("/members"):
+        return httpx.Response(200, json={"members": []})
+    if request.method == "PUT" and "/users/" in path:
+        return httpx.Response(201, json={})
+    return httpx.Response(200, json={})
+
+
+async def run(size: int, latency: float, prefetch: int):
+    database.close()
+    database.DATABASE_FILE = os.path.join(common.DATA_DIR, f"bootstrap-{size}-{prefetch}.db")
+    account_id_cache._entries.clear()
+    known_membership.forget_room("!room:example.com")
+    authentik.AUTHENTIK_PREFETCH_PAGES = prefetch
+
+    app = fake_authentik.create_app(size, max(size // USERS_PER_GROUP, 1), latency)
+    await synapse_admin.open_client(httpx.MockTransport(fake_synapse))
+    await jobs.start(resume=False)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    job = await bootstrap.bootstrap(httpx.ASGITransport(app=app))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await jobs.stop()
+    await synapse_admin.close_client()
+    print(f"{size:>8} users, prefetch {prefetch}: {elapsed:8.2f} s   peak memory {peak / 1024 / 1024:7.2f} MiB   "
+          f"{app.state.requests} Authentik requests   {job.succeeded + job.skipped}/{job.total} room operations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20_000])
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every Authentik response")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    for prefetch in args.prefetch:
+        for size in args.sizes:
+            asyncio.run(run(size, args.latency, prefetch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Shared setup for the benchmarks. Import this before any app module, it fills in the required config with dummy
+# values and points DATA_DIR at a temporary directory so benchmarks never touch real data.
+import os
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("WEBHOOK_SECRET", "benchmark")
+os.environ.setdefault("MATRIX_ADMIN_TOKEN", "benchmark")
+os.environ.setdefault("MATRIX_ADMIN_USER_ID", "@admin:example.com")
+os.environ.setdefault("MATRIX_URL", "http://synapse.invalid")
+os.environ.setdefault("MATRIX_SERVER_NAME", "example.com")
+os.environ.setdefault("IDP_NAME", "oidc-benchmark")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="synapse-group-sync-bench-")
+os.environ.pop("DATABASE_FILE", None)
+
+DATA_DIR = os.environ["DATA_DIR"]
+
+
+def make_user(i: int):
+    return {
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+        "userName": f"user{i}",
+        "name": {"formatted": f"User {i}", "familyName": "User", "givenName": f"{i}", "middleName": None,
+                 "honorificPrefix": None, "honorificSuffix": None},
+        "displayName": f"User {i}",
+        "emails": [{"value": f"user{i}@example.com", "type": "work", "primary": True}],
+        "active": True,
+        "externalId": f"external-{i}",
+    }
+
+
+# Time fn() repeatedly, returning latencies in milliseconds
+def measure(fn, iterations: int):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def percentile(values, pct: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarise(name: str, latencies):
+    print(f"{name:<40} mean {statistics.fmean(latencies):9.3f} ms   p50 {percentile(latencies, 50):9.3f} ms   "
+          f"p99 {percentile(latencies, 99):9.3f} ms   (n={len(latencies)})")
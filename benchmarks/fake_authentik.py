@@ -0,0 +1,101 @@
+# A fake Authentik serving the paginated core users/groups APIs. Users and groups are generated per page, so a
+# directory of any size can be served without holding it in memory. Like Authentik, groups list their users unless
+# include_users=false, and users can be filtered by group with groups_by_pk.
+# Usage: python -m benchmarks.fake_authentik [--users 100000] [--groups 1000] [--latency 0.02] [--port 9000]
+# Then run the bootstrap against it with AUTHENTIK_API_URL=http://127.0.0.1:9000 AUTHENTIK_TOKEN=fake
+import argparse
+import asyncio
+import math
+from typing import Optional
+
+from fastapi import FastAPI
+
+
+def group_pk(i: int):
+    return f"group-{i}"
+
+
+# The indexes of the users in a group, user i is in group i % groups
+def group_users(pk: str, users: int, groups: int):
+    prefix, _, i = pk.partition("-")
+    if prefix != "group" or not i.isdigit() or int(i) >= groups:
+        return range(0)
+    return range(int(i), users, groups)
+
+
+def make_group(i: int, users: int, groups: int, include_users: bool = True):
+    group = {"pk": group_pk(i), "name": f"Group {i}", "is_superuser": False, "parent": None, "attributes": {}}
+    if include_users:
+        members = group_users(group_pk(i), users, groups)
+        group["users"] = list(members)
+        group["users_obj"] = [make_user(j, groups) for j in members]
+    return group
+
+
+# Every user is a member of one group, the groups' members are spread evenly over the groups
+def make_user(i: int, groups: int):
+    return {
+        "pk": i,
+        "username": f"user{i}",
+        "name": f"User {i}",
+        "email": f"user{i}@example.com",
+        "uid": f"uid-{i}",
+        "is_active": True,
+        "type": "internal",
+        "groups": [group_pk(i % groups)] if groups else [],
+        "attributes": {},
+    }
+
+
+def paginate(count: int, page: int, page_size: int, make):
+    total_pages = max(math.ceil(count / page_size), 1)
+    start = (page - 1) * page_size
+    end = min(start + page_size, count)
+    return {
+        "pagination": {
+            "next": page + 1 if page < total_pages else 0,
+            "previous": page - 1 if page > 1 else 0,
+            "count": count,
+            "current": page,
+            "total_pages": total_pages,
+            "start_index": start + 1,
+            "end_index": end,
+        },
+        "results": [make(i) for i in range(start, max(end, start))],
+    }
+
+
+def create_app(users: int, groups: int, latency: float = 0.0):
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.get("/api/v3/core/groups/")
+    async def list_groups(page: int = 1, page_size: int = 100, include_users: bool = True):
+        app.state.requests += 1
+        if latency:
+            await asyncio.sleep(latency)
+        return paginate(groups, page, page_size, lambda i: make_group(i, users, groups, include_users))
+
+    @app.get("/api/v3/core/users/")
+    async def list_users(page: int = 1, page_size: int = 100, groups_by_pk: Optional[str] = None):
+        app.state.requests += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if groups_by_pk is not None:
+            members = group_users(groups_by_pk, users, groups)
+            return paginate(len(members), page, page_size, lambda i: make_user(members[i], groups))
+        return paginate(users, page, page_size, lambda i: make_user(i, groups))
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every response")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.users, args.groups, args.latency), host="127.0.0.1", port=args.port)
@@ -0,0 +1,133 @@
+# A fake Synapse serving the admin and client API endpoints the sync uses, keeping users, room members and the admin
+# user's rooms/power levels in memory. Every request can be delayed, and a share of them answered with 429 (rate
+# limited, with retry_after_ms) or 500 to exercise the retries.
+# In process, pass httpx.ASGITransport(app=create_app(...)) to synapse_admin.open_client. app.state.calls counts the
+# requests per endpoint and response status.
+# Usage: python -m benchmarks.fake_synapse [--latency 0.02] [--rate-limited 0.01] [--errors 0.0] [--port 8008]
+# Then run the app against it with MATRIX_URL=http://127.0.0.1:8008
+import argparse
+import asyncio
+import random
+from collections import Counter
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+ADMIN_USER_ID = "@admin:example.com"
+
+
+def error(status: int, errcode: str, message: str, **extra):
+    return JSONResponse(status_code=status, content={"errcode": errcode, "error": message, **extra})
+
+
+# latency is the mean seconds added to every request (uniformly between 0.5x and 1.5x), rate_limited and errors the
+# share of requests answered with 429 and 500. The 429s ask to retry after retry_after_ms, or don't say if it's None.
+def create_app(latency: float = 0.0, rate_limited: float = 0.0, errors: float = 0.0,
+               retry_after_ms: Optional[int] = 100, admin_user_id: str = ADMIN_USER_ID, seed: int = 0):
+    app = FastAPI()
+    app.state.calls = Counter()
+    # Users that exist, and the user linked to each (auth provider, external ID)
+    app.state.users = set()
+    app.state.external_ids = {}
+    # room ID -> member user IDs
+    app.state.rooms = {}
+    # Rooms the admin user is an admin of
+    app.state.admin_rooms = set()
+    randomness = random.Random(seed)
+
+    # Count, delay and maybe fail each request before it reaches its endpoint
+    @app.middleware("http")
+    async def inject(request: Request, call_next):
+        endpoint = request.scope["path"]
+        if latency:
+            await asyncio.sleep(latency * randomness.uniform(0.5, 1.5))
+
+        roll = randomness.random()
+        if roll < rate_limited + errors:
+            endpoint = "injected"
+            retry_after = {"retry_after_ms": retry_after_ms} if retry_after_ms is not None else {}
+            response = error(429, "M_LIMIT_EXCEEDED", "Too Many Requests", **retry_after) \
+                if roll < rate_limited else error(500, "M_UNKNOWN", "Internal server error")
+        else:
+            response = await call_next(request)
+            route = request.scope.get("route")
+            endpoint = route.name if route else endpoint
+        app.state.calls[(endpoint, response.status_code)] += 1
+        return response
+
+    def members_of(room_id: str):
+        return app.state.rooms.setdefault(room_id, set())
+
+    @app.put("/_synapse/admin/v2/users/{user_id}")
+    async def user(user_id: str, request: Request):
+        body = await request.json()
+        created = user_id not in app.state.users
+        app.state.users.add(user_id)
+        for external_id in body.get("external_ids") or ():
+            app.state.external_ids[(external_id["auth_provider"], external_id["external_id"])] = user_id
+        return JSONResponse(status_code=201 if created else 200, content={"name": user_id, **body})
+
+    @app.get("/_synapse/admin/v1/auth_providers/{provider}/users/{external_id}")
+    async def auth_provider_user(provider: str, external_id: str):
+        user_id = app.state.external_ids.get((provider, external_id))
+        if user_id is None:
+            return error(404, "M_NOT_FOUND", "User not found")
+        return {"user_id": user_id}
+
+    @app.post("/_synapse/admin/v1/join/{room_id}")
+    async def join(room_id: str, request: Request):
+        members_of(room_id).add((await request.json())["user_id"])
+        return {"room_id": room_id}
+
+    @app.post("/_matrix/client/v3/rooms/{room_id}/kick")
+    async def kick(room_id: str, request: Request):
+        user_id = (await request.json())["user_id"]
+        if user_id not in members_of(room_id):
+            return error(403, "M_FORBIDDEN", "The target user is not in the room")
+        members_of(room_id).discard(user_id)
+        return {}
+
+    @app.post("/_synapse/admin/v1/rooms/{room_id}/make_room_admin")
+    async def make_room_admin(room_id: str):
+        app.state.admin_rooms.add(room_id)
+        return {}
+
+    @app.post("/_matrix/client/v3/join/{room_id}")
+    async def admin_join(room_id: str):
+        members_of(room_id).add(admin_user_id)
+        return {"room_id": room_id}
+
+    @app.get("/_matrix/client/v3/joined_rooms")
+    async def joined_rooms():
+        return {"joined_rooms": [room_id for room_id, members in app.state.rooms.items() if admin_user_id in members]}
+
+    @app.get("/_matrix/client/v3/rooms/{room_id}/state/m.room.power_levels")
+    async def power_levels(room_id: str):
+        return {"users": {admin_user_id: 100} if room_id in app.state.admin_rooms else {}}
+
+    @app.get("/_synapse/admin/v1/rooms/{room_id}/members")
+    async def room_members(room_id: str):
+        members = sorted(members_of(room_id))
+        return {"members": members, "total": len(members)}
+
+    @app.get("/_matrix/client/v3/directory/room/{alias}")
+    async def directory(alias: str):
+        # Aliases map to the room with the same localpart, i.e. #room:example.com -> !room:example.com
+        return {"room_id": "!" + alias[1:], "servers": []}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.02, help="Mean seconds added to every response")
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--admin-user-id", default=ADMIN_USER_ID)
+    parser.add_argument("--port", type=int, default=8008)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.rate_limited, args.errors, admin_user_id=args.admin_user_id),
+                host="127.0.0.1", port=args.port)
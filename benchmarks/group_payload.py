@@ -0,0 +1,83 @@
+# Measures the CPU time and peak Python memory of SCIM group POST/PUT/GET requests with large member lists, from the
+# raw request body to the serialized response. Memory is measured in a second run, as tracing allocations slows
+# everything down.
+# Usage: python -m benchmarks.group_payload [--sizes 10000 50000] [--requests 5]
+import argparse
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+
+from fastapi.testclient import TestClient
+
+from main import app
+from utilities import database
+
+HEADERS = {"Authorization": f"Bearer {os.environ['WEBHOOK_SECRET']}", "Content-Type": "application/json"}
+
+
+def make_group(group_id: str, size: int, offset: int = 0):
+    return json.dumps({
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Group"],
+        "displayName": "Benchmark group",
+        "externalId": group_id,
+        "members": [{"value": f"@user{i}:example.com", "$ref": None} for i in range(offset, offset + size)],
+    }).encode()
+
+
+# Send each request, returning the CPU milliseconds (or with trace, the peak MiB allocated) per request
+def measure(send, bodies, trace: bool):
+    results = []
+    for body in bodies:
+        if trace:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.process_time()
+        response = send(body)
+        if trace:
+            results.append((tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20)
+        else:
+            results.append((time.process_time() - start) * 1000)
+        assert response.status_code < 300, response.text
+        del response
+    return results
+
+
+# POST a group, PUT it requests times (each replacing 1% of the members) and GET it requests times
+def run(client: TestClient, size: int, requests: int, trace: bool):
+    group_id = f"group-{size}-{'memory' if trace else 'cpu'}"
+    post_bodies = [make_group(group_id, size)]
+    put_bodies = [make_group(group_id, size, offset=(i + 1) * size // 100) for i in range(requests)]
+    return {
+        "POST": measure(lambda body: client.post("/scim/v2/Groups", content=body, headers=HEADERS), post_bodies,
+                        trace),
+        "PUT": measure(lambda body: client.put(f"/scim/v2/Groups/{group_id}", content=body, headers=HEADERS),
+                       put_bodies, trace),
+        "GET": measure(lambda body: client.get(f"/scim/v2/Groups/{group_id}", headers=HEADERS), [None] * requests,
+                       trace),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000])
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    database.DATABASE_FILE = os.path.join(common.DATA_DIR, "bench-group-payload.db")
+    with TestClient(app) as client:
+        for size in args.sizes:
+            cpu_times = run(client, size, args.requests, trace=False)
+            tracemalloc.start()
+            peaks = run(client, size, args.requests, trace=True)
+            tracemalloc.stop()
+            for method, times in cpu_times.items():
+                print(f"{f'{method} {size} members':<28} cpu mean {statistics.fmean(times):8.1f} ms   "
+                      f"max {max(times):8.1f} ms   peak memory {max(peaks[method]):7.1f} MiB   (n={len(times)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Load test of the sync paths against the fake Synapse: creates users over SCIM, syncs the mapped groups over SCIM,
+# then removes and re-adds every user's groups with the webhooks. Requests are sent concurrently to the app in
+# process, and each scenario reports its throughput, request latency, end to end latency (until the job a request
+# queued finished) and the Synapse requests made per operation.
+# Usage: python -m benchmarks.load [--users 2000] [--concurrency 50] [--latency 0.01] [--rate-limited 0.01]
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+from benchmarks.common import percentile
+
+GROUPS = 50
+ROOMS_PER_GROUP = 4
+
+
+def room_id(i: int):
+    return f"!room{i}:example.com"
+
+
+# Every group is mapped to its own rooms, 200 rooms in all
+os.environ.setdefault("IDP_GROUP_TO_ROOM", json.dumps({
+    f"group-{group}": [room_id(group * ROOMS_PER_GROUP + i) for i in range(ROOMS_PER_GROUP)] for group in range(GROUPS)
+}))
+os.environ.setdefault("SYNAPSE_RATE_LIMIT", "0")
+os.environ.setdefault("SYNAPSE_RETRY_BASE_DELAY", "0.05")
+os.environ.setdefault("COALESCE_WINDOW", "0")
+
+import httpx
+
+from benchmarks import fake_synapse
+from main import app
+from scim.store_cache import store_cache
+from synapse import synapse_admin
+from utilities import database, jobs
+
+SECRET = os.environ["WEBHOOK_SECRET"]
+SCIM_HEADERS = {"Authorization": f"Bearer {SECRET}"}
+
+
+# Every user is in two neighbouring groups
+def groups_of(user: int):
+    return [f"group-{user % GROUPS}", f"group-{(user + 1) % GROUPS}"]
+
+
+def scim_user(user: int):
+    return {
+        "userName": f"user{user}",
+        "name": {"formatted": f"User {user}", "familyName": "User", "givenName": str(user)},
+        "displayName": f"User {user}",
+        "emails": [{"value": f"user{user}@example.com"}],
+        "externalId": f"user{user}",
+    }
+
+
+def scim_group(group: int, users: int):
+    return {
+        "displayName": f"Group {group}",
+        "externalId": f"group-{group}",
+        "members": [{"value": f"@user{user}:example.com"} for user in range(users) if f"group-{group}" in groups_of(user)],
+    }
+
+
+class Scenario:
+    def __init__(self, name: str, requests):
+        self.name = name
+        # (method, path, json, headers)
+        self.requests = requests
+
+
+def scenarios(users: int):
+    return [
+        Scenario("SCIM POST /Users", [("POST", "/scim/v2/Users", scim_user(user), SCIM_HEADERS) for user in range(users)]),
+        Scenario("SCIM PUT /Groups", [
+            ("PUT", f"/scim/v2/Groups/group-{group}", scim_group(group, users), SCIM_HEADERS) for group in range(GROUPS)
+        ]),
+        Scenario("POST /sync/matrix/remove", [
+            ("POST", "/sync/matrix/remove", {"secret": SECRET, "user": {
+                "username": f"user{user}", "groups": groups_of(user)[:1], "remove_groups": groups_of(user)[1:]
+            }}, None) for user in range(users)
+        ]),
+        Scenario("POST /sync/matrix", [
+            ("POST", "/sync/matrix", {"secret": SECRET, "user": {"username": f"user{user}", "groups": groups_of(user)}},
+             None) for user in range(users)
+        ]),
+    ]
+
+
+async def run(client: httpx.AsyncClient, synapse, scenario: Scenario, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    calls = Counter(synapse.state.calls)
+    request_latencies = []
+    queued = []
+
+    async def send(method, path, body, headers):
+        async with semaphore:
+            sent_at = time.time()
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body, headers=headers)
+            request_latencies.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 300:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}: {response.text}")
+        job_id = response.headers.get("X-Job-ID") or (response.json() or {}).get("job_id")
+        if job_id:
+            queued.append((sent_at, jobs.get_job(job_id)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(*request) for request in scenario.requests))
+    for _, job in queued:
+        await jobs.wait(job, 0.01)
+    elapsed = time.perf_counter() - start
+
+    # Requests that didn't queue a job were done when they returned
+    end_to_end = [(job.finished_at - sent_at) * 1000 for sent_at, job in queued] or request_latencies
+    calls = Counter(synapse.state.calls) - calls
+    operations = len(scenario.requests)
+    failed = sum(job.failed for _, job in queued)
+    print(f"{scenario.name:<26} {operations:>6} ops in {elapsed:6.2f}s ({operations / elapsed:8.1f} ops/s)   "
+          f"request p50 {percentile(request_latencies, 50):7.1f} ms p99 {percentile(request_latencies, 99):7.1f} ms   "
+          f"end to end p50 {percentile(end_to_end, 50):7.1f} ms p99 {percentile(end_to_end, 99):7.1f} ms   "
+          f"{sum(calls.values()) / operations:5.1f} Synapse calls/op "
+          f"({calls[('injected', 429)]} rate limited, {calls[('injected', 500)]} errors, {failed} failed operations)")
+
+
+async def main(args):
+    database.DATABASE_FILE = os.path.join(common.DATA_DIR, "bench-load.db")
+    synapse = fake_synapse.create_app(args.latency, args.rate_limited, args.errors,
+                                      admin_user_id=os.environ["MATRIX_ADMIN_USER_ID"])
+    store_cache.load()
+    await synapse_admin.open_client(httpx.ASGITransport(app=synapse))
+    await jobs.start(resume=False)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app") as client:
+            for scenario in scenarios(args.users):
+                await run(client, synapse, scenario, args.concurrency)
+        print("Synapse requests:", dict(sorted(synapse.state.calls.items())))
+    finally:
+        await jobs.stop()
+        await synapse_admin.close_client()
+        database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests sent at once")
+    parser.add_argument("--latency", type=float, default=0.01, help="Mean seconds the fake Synapse takes to respond")
+    parser.add_argument("--rate-limited", type=float, default=0.01, help="Share of Synapse requests answered with 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="Share of Synapse requests answered with 500")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,69 @@
+# Compares the old nested-loop IDP_GROUP_TO_ROOM scans with the precomputed group/room indexes.
+# Usage: python -m benchmarks.mapping [--groups 5000] [--rooms 2000]
+import argparse
+import random
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+from benchmarks.common import measure, summarise
+
+from utilities.room_mapping import build_mapping_indexes
+from utils import get_rooms_for_groups, get_rooms_to_remove
+
+
+# The scans matrix_sync and matrix_sync_remove did before the indexes existed
+def scan_rooms_to_add(group_to_room, user_groups):
+    rooms = []
+    for group, group_rooms in group_to_room.items():
+        if group in user_groups:
+            rooms.extend(group_rooms)
+    return rooms
+
+
+def scan_rooms_to_remove(group_to_room, user_groups, remove_groups):
+    rooms_to_remove = []
+    for group, rooms in group_to_room.items():
+        if group in remove_groups:
+            for room_id in rooms:
+                allowed = False
+                for other_group, other_rooms in group_to_room.items():
+                    if other_group != group and other_group in user_groups and room_id in other_rooms:
+                        allowed = True
+                        break
+                if not allowed:
+                    rooms_to_remove.append(room_id)
+    return rooms_to_remove
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--groups", type=int, default=5000)
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--rooms-per-group", type=int, default=5)
+    parser.add_argument("--user-groups", type=int, default=20)
+    parser.add_argument("--remove-groups", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    rooms = [f"!room{i}:example.com" for i in range(args.rooms)]
+    group_to_room = {f"group{i}": rng.sample(rooms, args.rooms_per_group) for i in range(args.groups)}
+    group_to_rooms, _ = build_mapping_indexes(group_to_room)
+
+    groups = list(group_to_room)
+    cases = []
+    for _ in range(args.iterations):
+        user_groups = rng.sample(groups, args.user_groups)
+        cases.append((user_groups, user_groups[:args.remove_groups]))
+
+    print(f"{args.groups} groups, {args.rooms} rooms, user in {args.user_groups} groups, removing {args.remove_groups}")
+    summarise("scan rooms to add", measure(lambda i: scan_rooms_to_add(group_to_room, cases[i][0]), args.iterations))
+    summarise("indexed rooms to add", measure(
+        lambda i: get_rooms_for_groups(cases[i][0], group_to_rooms), args.iterations))
+    summarise("scan rooms to remove", measure(
+        lambda i: scan_rooms_to_remove(group_to_room, cases[i][0][args.remove_groups:], cases[i][1]), args.iterations))
+    summarise("indexed rooms to remove", measure(
+        lambda i: get_rooms_to_remove(cases[i][0][args.remove_groups:], cases[i][1], group_to_rooms), args.iterations))
+
+
+if __name__ == "__main__":
+    main()
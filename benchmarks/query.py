@@ -0,0 +1,45 @@
+# Measures SCIM list/filter queries against the indexed store columns.
+# Usage: python -m benchmarks.query [--size 100000] [--queries 200]
+import argparse
+import os
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+from benchmarks.common import make_user, measure, summarise
+
+from scim import query, store
+from utilities import database
+
+
+def bench(name: str, size: int, queries: int, expression, offset: int = 0, limit: int = 100):
+    def run(i):
+        where, parameters = query.compile_filter(expression(i), store.USER_COLUMNS) if expression else (None, [])
+        store.list_users(where, parameters, offset, limit)
+
+    summarise(f"{name}, {size} users", measure(run, queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    size, queries = args.size, args.queries
+
+    database.DATABASE_FILE = os.path.join(common.DATA_DIR, "bench-query.db")
+    with database.transaction():
+        for i in range(size):
+            store.put_user(f"external-{i}", make_user(i))
+
+    bench("userName eq", size, queries, lambda i: f'userName eq "USER{i * 7919 % size}"')
+    bench("externalId eq", size, queries, lambda i: f'externalId eq "external-{i * 7919 % size}"')
+    bench("userName eq or externalId eq", size, queries,
+          lambda i: f'userName eq "user{i}" or externalId eq "external-{i + 1}"')
+    bench("displayName sw", size, queries, lambda i: f'displayName sw "user {i * 7919 % size}"')
+    bench("userName co (scan)", size, max(queries // 10, 1), lambda i: f'userName co "{i}9"')
+    bench("list first page", size, queries, None)
+    bench("list last page", size, max(queries // 10, 1), None, offset=size - 100)
+    database.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Compares write latency of the legacy whole-file JSON store with the SQLite store.
+# Usage: python -m benchmarks.storage [--sizes 10000 100000] [--writes 200]
+import argparse
+import json
+import os
+import tracemalloc
+
+from benchmarks import common  # Sets up the config, must be imported before any app module
+from benchmarks.common import make_user, measure, summarise
+
+from scim import store
+from scim.store_cache import store_cache
+from utilities import database
+
+
+def bench_json(size: int, writes: int):
+    path = os.path.join(common.DATA_DIR, f"users-{size}.json")
+    with open(path, "w") as f:
+        json.dump({f"external-{i}": make_user(i) for i in range(size)}, f)
+
+    # Same read-modify-rewrite the JSON store did for every db_update_user
+    def write(i):
+        with open(path, "r") as f:
+            users = json.load(f)
+        users[f"external-{i}"] = make_user(i)
+        with open(path, "w") as f:
+            json.dump(users, f)
+
+    summarise(f"json file, {size} users", measure(write, writes))
+    os.remove(path)
+
+
+def bench_sqlite(size: int, writes: int):
+    database.close()
+    database.DATABASE_FILE = os.path.join(common.DATA_DIR, f"bench-{size}.db")
+    with database.transaction():
+        for i in range(size):
+            store.put_user(f"external-{i}", make_user(i))
+
+    summarise(f"sqlite, {size} users", measure(lambda i: store.put_user(f"external-{i}", make_user(i)), writes))
+
+    store_cache.enabled = False
+    summarise(f"sqlite get, {size} users", measure(lambda i: store.get_user(f"external-{i}"), writes))
+
+    store_cache.enabled = True
+    store_cache.clear()
+    tracemalloc.start()
+    store_cache.load()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    summarise(f"cached get, {size} users", measure(lambda i: store.get_user(f"external-{i}"), writes))
+    print(f"cache of {size} users: {memory / 2 ** 20:.1f} MiB")
+    store_cache.clear()
+    database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--json-writes", type=int, default=20, help="Writes for the (slow) JSON store")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        bench_json(size, args.json_writes)
+        bench_sqlite(size, args.writes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# Bootstrap a new deployment from Authentik instead of waiting for it to push every user over SCIM.
+# Pages through Authentik's core groups and users APIs, writes them to the SCIM store (creating/linking each user's
+# Matrix account like a SCIM user POST), then plans the room joins of every mapped group as one job.
+# Each page is written as soon as it arrives while the next pages are prefetched, so memory use only grows with the
+# group memberships, kept to remove the members that left a group once every user is imported.
+#
+# Usage: python bootstrap.py
+import argparse
+import asyncio
+import time
+
+from config import SYNC_CONCURRENCY
+from scim import handle_group, handle_user, store
+from scim.main import SCIM_USER_SCHEMA, SCIM_GROUP_SCHEMA
+from synapse import synapse_admin
+from utilities import authentik, database, jobs, room_mapping, shard_leases
+from utils import log, LogLevel
+
+# Authentik user types that can log in to Matrix, service accounts are skipped
+USER_TYPES = ("internal", "external")
+
+
+# The SCIM user Authentik's SCIM provider would send for a user
+def to_scim_user(user: dict):
+    given_name, _, family_name = (user.get("name") or "").partition(" ")
+    return {
+        "schemas": [SCIM_USER_SCHEMA],
+        "userName": user["username"],
+        "name": {"formatted": user.get("name"), "familyName": family_name or None, "givenName": given_name or None,
+                 "middleName": None, "honorificPrefix": None, "honorificSuffix": None},
+        "displayName": user.get("name") or user["username"],
+        "emails": [{"value": user["email"], "type": "other", "primary": True}] if user.get("email") else [],
+        "active": user.get("is_active", True),
+        "externalId": user["uid"],
+    }
+
+
+# Store every group, keeping the members of already stored groups until remove_stale_members runs. The users' groups
+# are added to their member lists afterwards. Returns the IDs of the imported groups.
+async def import_groups(client) -> list:
+    group_ids = []
+    async for page in authentik.iter_pages(client, "/api/v3/core/groups/", {"include_users": "false"}):
+        with database.transaction():
+            for group in page:
+                store.put_group_info(str(group["pk"]), {
+                    "schemas": [SCIM_GROUP_SCHEMA],
+                    "displayName": group["name"],
+                    "externalId": str(group["pk"]),
+                })
+        group_ids.extend(str(group["pk"]) for group in page)
+    return group_ids
+
+
+# Create/link each user's Matrix account, then store the users of a page and their group memberships. The members
+# imported into each group are added to imported_members.
+async def import_users(client, imported_members: dict) -> int:
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def create_account(user):
+        async with semaphore:
+            try:
+                return await handle_user.post(
+                    user["uid"], user.get("name") or user["username"], user.get("email") or None
+                )
+            except Exception as e:
+                log(LogLevel.ERROR, f"Error creating or linking the Matrix account of {user['username']}: {e!r}")
+                return None
+
+    count = 0
+    async for page in authentik.iter_pages(client, "/api/v3/core/users/", {"include_groups": "false"}):
+        users = [user for user in page if user.get("is_active", True) and user.get("type", "internal") in USER_TYPES]
+        matrix_ids = await asyncio.gather(*map(create_account, users))
+
+        with database.transaction():
+            for user, matrix_id in zip(users, matrix_ids):
+                if matrix_id is None:
+                    continue
+                store.put_user(user["uid"], to_scim_user(user))
+                group_ids = [str(group_id) for group_id in user.get("groups") or ()]
+                store.add_group_members((group_id, matrix_id, None) for group_id in group_ids)
+                for group_id in group_ids:
+                    imported_members.setdefault(group_id, set()).add(matrix_id)
+                count += 1
+    return count
+
+
+# Remove the user members that weren't imported from the imported groups, once every user is imported
+def remove_stale_members(group_ids, imported_members: dict) -> int:
+    count = 0
+    with database.transaction():
+        for group_id in group_ids:
+            group = store.get_group(group_id)
+            if group is None or group["members"] is None:
+                continue
+            members = imported_members.get(group_id, set())
+            stale = {
+                member["value"] for member in group["members"]
+                if member.get("ref") != "Group" and member["value"] not in members
+            }
+            if stale:
+                store.update_group_members(group_id, group, {}, stale)
+                count += len(stale)
+    return count
+
+
+# The room operations of every mapped group, as one job
+def plan_rooms():
+    operations = []
+    for group_id in sorted(room_mapping.get().group_to_rooms):
+        group = store.get_group(group_id, with_members=False)
+        if group is None:
+            log(LogLevel.INFO, f"Mapped group {group_id} doesn't exist in Authentik.")
+            continue
+        members = store.get_members_of_groups([group_id])
+        operations.extend(handle_group.plan_members(group_id, group.get("displayName"), members, set()))
+    return jobs.submit(operations)
+
+
+async def bootstrap(transport=None):
+    start = time.perf_counter()
+    async with authentik.create_client(transport) as client:
+        group_ids = await import_groups(client)
+        log(LogLevel.INFO, f"Imported {len(group_ids)} groups in {time.perf_counter() - start:.2f}s.")
+        imported_members = {}
+        users = await import_users(client, imported_members)
+        log(LogLevel.INFO, f"Imported {users} users in {time.perf_counter() - start:.2f}s.")
+    stale = remove_stale_members(group_ids, imported_members)
+    if stale:
+        log(LogLevel.INFO, f"Removed {stale} members no longer in their Authentik groups.")
+
+    job = plan_rooms()
+    log(LogLevel.INFO, f"Applying {job.total} room operations as job {job.id}.")
+    await jobs.wait(job)
+    log(LogLevel.INFO, f"Bootstrap finished in {time.perf_counter() - start:.2f}s: {job.to_dict()}")
+    return job
+
+
+async def _main():
+    await synapse_admin.open_client()
+    await room_mapping.load()
+    if shard_leases.has_live_leases():
+        # The app is running with several workers and runs every queued operation of its shards, so the room
+        # operations are left to it rather than run here as well
+        log(LogLevel.INFO, "The app is running with several workers, its workers will apply the room operations.")
+        await jobs.start(workers=0, sharded=True)
+    else:
+        # Jobs queued by the app are left for the app to resume
+        await jobs.start(resume=False)
+    try:
+        await bootstrap()
+    finally:
+        await jobs.stop()
+        await synapse_admin.close_client()
+        database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import Authentik's groups and users and join them to their rooms.")
+    parser.parse_args()
+    asyncio.run(_main())
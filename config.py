@@ -9,6 +9,8 @@ if os.path.exists(".env"):
     load_dotenv()
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# json (one JSON object per line) or text
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
 
 WEBHOOK_SECRET=os.environ.get("WEBHOOK_SECRET")
 if not WEBHOOK_SECRET:
@@ -33,8 +35,100 @@ if not DATA_DIR:
 
 AUTHENTIK_API_URL=os.environ.get("AUTHENTIK_API_URL")
 AUTHENTIK_TOKEN=os.environ.get("AUTHENTIK_TOKEN")
+# Pages fetched ahead while the current page of Authentik users/groups is processed
+AUTHENTIK_PREFETCH_PAGES=int(os.environ.get("AUTHENTIK_PREFETCH_PAGES", "4"))
 
 IDP_GROUP_TO_ROOM=json.loads(os.environ.get("IDP_GROUP_TO_ROOM", "{}"))
+# YAML/JSON file (relative to DATA_DIR) mapping groups to rooms, used instead of IDP_GROUP_TO_ROOM if it exists and
+# reloaded when it changes. With GROUP_MAPPING_RECONCILE, a group's members are joined to the rooms a reload adds to the
+# group and kicked from the rooms it removes.
+GROUP_MAPPING_FILE=os.path.join(DATA_DIR, os.environ.get("GROUP_MAPPING_FILE", "group-mapping.yaml"))
+GROUP_MAPPING_RECONCILE=os.environ.get("GROUP_MAPPING_RECONCILE", "false").lower() in ("1", "true", "yes")
 IDP_NAME=os.environ.get("IDP_NAME")
 if not IDP_NAME:
-    raise RuntimeError("IDP_NAME environment variable is not set")
\ No newline at end of file
+    raise RuntimeError("IDP_NAME environment variable is not set")
+
+# Synapse HTTP Client
+SYNAPSE_TIMEOUT=float(os.environ.get("SYNAPSE_TIMEOUT", "10"))
+SYNAPSE_CONNECT_TIMEOUT=float(os.environ.get("SYNAPSE_CONNECT_TIMEOUT", "5"))
+SYNAPSE_MAX_CONNECTIONS=int(os.environ.get("SYNAPSE_MAX_CONNECTIONS", "20"))
+SYNAPSE_MAX_KEEPALIVE_CONNECTIONS=int(os.environ.get("SYNAPSE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+# Seconds to cache the admin user's joined rooms and room power levels (0 disables the cache)
+ROOM_ADMIN_CACHE_TTL=float(os.environ.get("ROOM_ADMIN_CACHE_TTL", "300"))
+
+# Cache of IdP external ID -> Matrix user ID lookups: maximum entries, and seconds found/not found accounts are cached
+ACCOUNT_CACHE_SIZE=int(os.environ.get("ACCOUNT_CACHE_SIZE", "100000"))
+ACCOUNT_CACHE_TTL=float(os.environ.get("ACCOUNT_CACHE_TTL", "86400"))
+ACCOUNT_CACHE_NEGATIVE_TTL=float(os.environ.get("ACCOUNT_CACHE_NEGATIVE_TTL", "60"))
+
+# Seconds the responses to webhook and SCIM writes are kept to answer retries of the same request (0 disables this),
+# how many are kept, and the request headers carrying a delivery ID
+IDEMPOTENCY_TTL=float(os.environ.get("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_SIZE=int(os.environ.get("IDEMPOTENCY_SIZE", "10000"))
+IDEMPOTENCY_HEADERS=[
+    header.strip().lower() for header in os.environ.get("IDEMPOTENCY_HEADERS", "Idempotency-Key,X-Delivery-ID").split(",")
+    if header.strip()
+]
+
+# Keep a copy of the SCIM users and groups in memory for GETs
+STORE_CACHE=os.environ.get("STORE_CACHE", "true").lower() in ("1", "true", "yes")
+
+# Send every SCIM user update to Synapse, even if nothing Synapse stores changed since the last update
+USER_FORCE_SYNC=os.environ.get("USER_FORCE_SYNC", "false").lower() in ("1", "true", "yes")
+
+# Maximum concurrent room membership operations, overall and per room
+SYNC_CONCURRENCY=int(os.environ.get("SYNC_CONCURRENCY", "10"))
+SYNC_ROOM_CONCURRENCY=int(os.environ.get("SYNC_ROOM_CONCURRENCY", "4"))
+
+# SQLite database used for the SCIM user/group store
+DATABASE_FILE=os.environ.get("DATABASE_FILE", f"{DATA_DIR}/synapse-group-sync.db")
+
+# How SCIM group writes are applied to rooms:
+#   join - add the group's added members to the group's rooms (never removes anyone)
+#   reconcile - diff each room's members against all groups mapped to it and only join/kick the differences
+SCIM_GROUP_SYNC_MODE=os.environ.get("SCIM_GROUP_SYNC_MODE", "join")
+if SCIM_GROUP_SYNC_MODE not in ("join", "reconcile"):
+    raise RuntimeError("SCIM_GROUP_SYNC_MODE must be one of: join, reconcile")
+
+# Full-state reconciler: seconds between scheduled runs (0 disables), where group members are read from and how many
+# rooms are reconciled at once
+RECONCILE_INTERVAL=float(os.environ.get("RECONCILE_INTERVAL", "0"))
+RECONCILE_SOURCE=os.environ.get("RECONCILE_SOURCE", "store")
+if RECONCILE_SOURCE not in ("store", "authentik"):
+    raise RuntimeError("RECONCILE_SOURCE must be one of: store, authentik")
+RECONCILE_CONCURRENCY=int(os.environ.get("RECONCILE_CONCURRENCY", "4"))
+
+# Background job queue for room membership operations
+JOB_WORKERS=int(os.environ.get("JOB_WORKERS", "4"))
+JOB_BATCH_SIZE=int(os.environ.get("JOB_BATCH_SIZE", "100"))
+JOB_PERSIST=os.environ.get("JOB_PERSIST", "true").lower() in ("1", "true", "yes")
+JOB_HISTORY=int(os.environ.get("JOB_HISTORY", "1000"))
+
+# Number of uvicorn worker processes. With more than one, the job queue is split into JOB_SHARDS shards of rooms which
+# the workers lease from each other through the database (renewed every JOB_LEASE_TTL / 3 seconds), and workers check
+# the database for operations queued by other workers every JOB_POLL_INTERVAL seconds
+UVICORN_WORKERS=int(os.environ.get("UVICORN_WORKERS", "1"))
+JOB_SHARDS=int(os.environ.get("JOB_SHARDS", "64"))
+JOB_LEASE_TTL=float(os.environ.get("JOB_LEASE_TTL", "15"))
+JOB_POLL_INTERVAL=float(os.environ.get("JOB_POLL_INTERVAL", "0.2"))
+if UVICORN_WORKERS > 1 and not JOB_PERSIST:
+    raise RuntimeError("JOB_PERSIST must be enabled to run more than one worker (UVICORN_WORKERS)")
+
+# Seconds queued operations wait so later operations for the same user and room can replace them (0 disables)
+COALESCE_WINDOW=float(os.environ.get("COALESCE_WINDOW", "0.5"))
+# Seconds room memberships seen by joins, kicks and member fetches are trusted to skip no-op operations (0 disables)
+MEMBERSHIP_CACHE_TTL=float(os.environ.get("MEMBERSHIP_CACHE_TTL", "60"))
+
+# Retries of rate limited (429) and transient (502/503/504, connection errors) Synapse requests
+SYNAPSE_MAX_RETRIES=int(os.environ.get("SYNAPSE_MAX_RETRIES", "5"))
+SYNAPSE_RETRY_BASE_DELAY=float(os.environ.get("SYNAPSE_RETRY_BASE_DELAY", "0.5"))
+SYNAPSE_RETRY_MAX_DELAY=float(os.environ.get("SYNAPSE_RETRY_MAX_DELAY", "30"))
+# Requests per second sent to Synapse (0 disables the limit), and how many may be sent at once after being idle
+SYNAPSE_RATE_LIMIT=float(os.environ.get("SYNAPSE_RATE_LIMIT", "20"))
+SYNAPSE_RATE_BURST=int(os.environ.get("SYNAPSE_RATE_BURST", "20"))
+
+# SCIM Bulk and list limits
+SCIM_BULK_MAX_OPERATIONS=int(os.environ.get("SCIM_BULK_MAX_OPERATIONS", "1000"))
+SCIM_BULK_MAX_PAYLOAD_SIZE=int(os.environ.get("SCIM_BULK_MAX_PAYLOAD_SIZE", str(1024 * 1024)))
+SCIM_FILTER_MAX_RESULTS=int(os.environ.get("SCIM_FILTER_MAX_RESULTS", "200"))
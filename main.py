@@ -1,31 +1,108 @@
-from fastapi import FastAPI, APIRouter, Request, status
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, APIRouter, Request, status, HTTPException, Depends
 from fastapi.exceptions import RequestValidationError
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
-from utils import bcolors, LogLevel, log
-from config import IDP_GROUP_TO_ROOM
+from utils import LogLevel, log, correlation_id
+from config import UVICORN_WORKERS
 
+import reconcile
+import scim.bulk
 import scim.main
+import scim.query
 import webhook
+from scim import store
+from scim.store_cache import store_cache
+from utilities import auth, database, idempotency, jobs, metrics, room_mapping
+from utilities.idempotency import idempotency_store
+from synapse import synapse_admin
+from synapse.account_cache import account_id_cache
+from synapse.coalesce import coalescer, known_membership
+from synapse.room_cache import room_admin_cache
+
+log(LogLevel.INFO, "Starting Synapse Group Sync")
+
 
-print(f"{bcolors.OKGREEN}INFO:{bcolors.ENDC} Starting Synapse Group Sync")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    store.import_json_files()
+    store_cache.load()
+    account_id_cache.warm()
+    # One pooled Synapse client for the lifetime of the app
+    await synapse_admin.open_client()
+    await room_mapping.load()
+    # With several uvicorn workers, each process runs the operations of the rooms whose shards it leases
+    await jobs.start(sharded=UVICORN_WORKERS > 1)
+    reconcile.start()
+    room_mapping.start()
+    yield
+    await room_mapping.stop()
+    await reconcile.stop()
+    await jobs.stop()
+    await synapse_admin.close_client()
+    database.close()
 
-print(f"{bcolors.OKGREEN}INFO:{bcolors.ENDC} Loaded Mappings:")
 
-for mapped_group in IDP_GROUP_TO_ROOM:
-    print(
-        f"{bcolors.OKGREEN}INFO:{bcolors.ENDC} Group: {mapped_group} {bcolors.OKBLUE}->{bcolors.ENDC} Rooms: {IDP_GROUP_TO_ROOM[mapped_group]}")
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 router = APIRouter()
 
 
+# Answer retries of webhook and SCIM writes with the response to the first copy instead of handling them again
+@app.middleware("http")
+async def deduplicate(request: Request, call_next):
+    if not idempotency_store.enabled or not idempotency.applies(request.method, request.url.path):
+        return await call_next(request)
+    return await idempotency.handle(request, call_next)
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    "http_request_duration_seconds", "Time taken to handle requests, by route.", ("method", "route", "status")
+)
+
+
+# Time every request, labelled by its route's path template (i.e. /scim/v2/Groups/{group_id}) so IDs don't each get
+# their own label
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route.path if route else "unmatched",
+                            str(response.status_code))
+    return response
+
+
+# Tag everything logged while handling a request, including the Synapse calls and queued jobs it causes, with the
+# caller's X-Request-ID (or a new ID), which is echoed back in the response
+@app.middleware("http")
+async def correlate_request(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex
+    token = correlation_id.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        correlation_id.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     log(LogLevel.ERROR, f"Validation error:\n{exc}\nFor Request:\n{request}\n")
     return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"error": "Validation error"})
 
 
+# Invalid list filters are answered as SCIM errors
+@app.exception_handler(scim.query.InvalidFilter)
+async def invalid_filter_handler(request: Request, exc: scim.query.InvalidFilter):
+    content = scim.bulk.error_content(exc.status_code, exc.detail, "invalidFilter")
+    return JSONResponse(status_code=exc.status_code, content=content)
+
+
 @router.get("/", tags=["root"])
 async def root():
     return {"status": "success"}
@@ -33,9 +110,33 @@ async def root():
 
 @router.get("/health", tags=["health"])
 async def health():
-    return {"status": "success"}
+    return {
+        "status": "success",
+        "room_admin_cache": room_admin_cache.stats(),
+        "account_cache": account_id_cache.stats(),
+        "store_cache": store_cache.stats(),
+        "idempotency": idempotency_store.stats(),
+        "queue_depth": jobs.get_queue_depth(),
+        "job_shards": jobs.get_owned_shards(),
+        "coalesced_operations": coalescer.coalesced,
+        "known_membership": known_membership.stats(),
+    }
+
+
+@router.get("/metrics", tags=["health"])
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@router.get("/jobs/{job_id}", tags=["jobs"])
+async def get_job(job_id: str, token: str = Depends(auth.verify_token)):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 
 app.include_router(router)
 app.include_router(webhook.router)
 app.include_router(scim.main.router, prefix="/scim/v2")
+app.include_router(scim.bulk.router, prefix="/scim/v2")
@@ -0,0 +1,236 @@
+# Full-state reconciler. Fetches each mapped room's members once, compares them with the members of every group
+# mapped to the room (from the SCIM store or Authentik) and joins/kicks the differences, so rooms end up correct
+# even if a webhook was missed or failed. Rooms are handled one at a time per worker, so memory stays flat however
+# many rooms are mapped. From Authentik, a group's members are loaded when the first of its rooms is reconciled and
+# dropped once the last one is.
+#
+# Usage: python reconcile.py [--dry-run] [--source store|authentik]
+# Inside the app it runs every RECONCILE_INTERVAL seconds, queueing its joins/kicks as jobs.
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from config import RECONCILE_CONCURRENCY, RECONCILE_INTERVAL, RECONCILE_SOURCE
+from scim import store
+from synapse import synapse_admin
+from synapse.room import add_to_room, remove_from_room, get_room_members, get_members_diff, run_membership_ops
+from utilities import database, jobs, room_mapping
+from utils import log, LogLevel
+
+
+class ReconcileSummary:
+    __slots__ = ("rooms", "failed_rooms", "no_kick_rooms", "joins", "kicks", "failed", "source_seconds",
+                 "fetch_seconds", "apply_seconds", "total_seconds")
+
+    def __init__(self):
+        self.rooms = 0
+        self.failed_rooms = 0
+        # Rooms only joined to, as the members of some of their groups are unknown
+        self.no_kick_rooms = 0
+        self.joins = 0
+        self.kicks = 0
+        self.failed = 0
+        self.source_seconds = 0.0
+        self.fetch_seconds = 0.0
+        self.apply_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def log(self, dry_run: bool):
+        prefix = "[dry run] " if dry_run else ""
+        log(LogLevel.INFO, f"{prefix}Reconciled {self.rooms} rooms ({self.failed_rooms} failed, {self.no_kick_rooms} "
+                           f"skipped for kicks): {self.joins} to join, {self.kicks} to kick, {self.failed} failed.")
+        # Times are summed over rooms handled concurrently
+        log(LogLevel.INFO, f"{prefix}Timings: total {self.total_seconds:.2f}s, loading groups "
+                           f"{self.source_seconds:.2f}s, fetching members {self.fetch_seconds:.2f}s, applying "
+                           f"{self.apply_seconds:.2f}s.")
+
+
+# Desired members of the rooms in room_to_groups, from the SCIM store
+class StoreSource:
+    def __init__(self, room_to_groups):
+        self.room_to_groups = room_to_groups
+
+    async def get_members(self, room_id: str):
+        return store.get_members_of_groups(self.room_to_groups[room_id])
+
+    # Whether the room's members not in get_members can be kicked, not if any of its groups isn't stored (i.e. it's
+    # only synced by the webhooks)
+    def can_kick(self, room_id: str):
+        return not store.get_unknown_groups(self.room_to_groups[room_id])
+
+    # Called once a room was reconciled
+    def done(self, room_id: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+# Desired members of the rooms in room_to_groups, from Authentik. Each group is loaded once, when the first of its rooms
+# asks for it, and dropped when the last of them is done, so only the groups of the rooms in progress are held.
+class AuthentikSource:
+    def __init__(self, room_to_groups):
+        # Imported here so the store source works without Authentik configured
+        from utilities import authentik
+
+        self.authentik = authentik
+        self.room_to_groups = room_to_groups
+        self.client = authentik.create_client()
+        # group -> rooms not done yet
+        self._remaining = Counter(group for groups in room_to_groups.values() for group in groups)
+        # group -> task loading its members
+        self._groups = {}
+
+    async def get_members(self, room_id: str):
+        groups = self.room_to_groups[room_id]
+        for group in groups:
+            if group not in self._groups:
+                self._groups[group] = asyncio.create_task(self.authentik.get_members_of_group(self.client, group))
+        return set().union(*await asyncio.gather(*(self._groups[group] for group in groups)))
+
+    def can_kick(self, room_id: str):
+        return True
+
+    def done(self, room_id: str):
+        for group in self.room_to_groups[room_id]:
+            self._remaining[group] -= 1
+            if self._remaining[group] <= 0:
+                del self._remaining[group]
+                task = self._groups.pop(group, None)
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def close(self):
+        for task in self._groups.values():
+            task.cancel()
+        await asyncio.gather(*self._groups.values(), return_exceptions=True)
+        self._groups.clear()
+        await self.client.aclose()
+
+
+def get_source(source: str, room_to_groups):
+    if source == "store":
+        return StoreSource(room_to_groups)
+    if source == "authentik":
+        return AuthentikSource(room_to_groups)
+    raise ValueError(f"Unknown reconcile source: {source}")
+
+
+async def _reconcile_room(room_id: str, source, summary: ReconcileSummary, dry_run: bool, queue: bool):
+    start = time.perf_counter()
+    # Not remembered, every mapped room is read once per run
+    current_members = await get_room_members(room_id, remember=False)
+    summary.fetch_seconds += time.perf_counter() - start
+    summary.rooms += 1
+    if current_members is None:
+        summary.failed_rooms += 1
+        return
+
+    start = time.perf_counter()
+    desired_members = await source.get_members(room_id)
+    summary.source_seconds += time.perf_counter() - start
+    to_join, to_kick = get_members_diff(current_members, desired_members)
+    if not source.can_kick(room_id):
+        summary.no_kick_rooms += 1
+        to_kick = set()
+    summary.joins += len(to_join)
+    summary.kicks += len(to_kick)
+    if not to_join and not to_kick:
+        return
+
+    if dry_run:
+        log(LogLevel.INFO, f"[dry run] {room_id}: join {sorted(to_join)}, kick {sorted(to_kick)}")
+        return
+
+    # Queued, so they're applied in order with the joins/kicks of webhooks for the same room
+    if queue:
+        jobs.submit([("join", member, room_id) for member in sorted(to_join)]
+                    + [("kick", member, room_id) for member in sorted(to_kick)])
+        return
+
+    start = time.perf_counter()
+    results = await run_membership_ops(add_to_room, [(member, room_id) for member in to_join])
+    results.update(await run_membership_ops(remove_from_room, [(member, room_id) for member in to_kick]))
+    summary.apply_seconds += time.perf_counter() - start
+    summary.failed += sum(not success for success in results.values())
+
+
+# Reconcile every mapped room. With queue, joins/kicks are submitted to the job queue instead of applied directly.
+async def reconcile(source: str = RECONCILE_SOURCE, dry_run: bool = False, queue: bool = False) -> ReconcileSummary:
+    summary = ReconcileSummary()
+    start = time.perf_counter()
+
+    # The whole run uses the mapping as it was when it started
+    room_to_groups = room_mapping.get().room_to_groups
+    members_source = get_source(source, room_to_groups)
+
+    # Rooms of the same groups one after another, so each group's members are held for as short as possible
+    rooms = iter(sorted(room_to_groups, key=lambda room_id: (sorted(room_to_groups[room_id]), room_id)))
+
+    async def worker():
+        for room_id in rooms:
+            try:
+                await _reconcile_room(room_id, members_source, summary, dry_run, queue)
+            except Exception as e:
+                log(LogLevel.ERROR, f"Error reconciling {room_id}: {e!r}")
+                summary.failed_rooms += 1
+            finally:
+                members_source.done(room_id)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(RECONCILE_CONCURRENCY)))
+    finally:
+        await members_source.close()
+
+    summary.total_seconds = time.perf_counter() - start
+    summary.log(dry_run)
+    return summary
+
+
+_task = None
+
+
+async def _run_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        # Only one of several app processes reconciles
+        if not jobs.is_leader():
+            continue
+        try:
+            await reconcile(queue=True)
+        except Exception as e:
+            log(LogLevel.ERROR, f"Scheduled reconcile failed: {e!r}")
+
+
+# Start reconciling every RECONCILE_INTERVAL seconds in the background (if set)
+def start(interval: float = RECONCILE_INTERVAL):
+    global _task
+    if interval > 0:
+        _task = asyncio.create_task(_run_periodically(interval))
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+async def _main(args):
+    await synapse_admin.open_client()
+    try:
+        await room_mapping.load()
+        await reconcile(args.source, args.dry_run)
+    finally:
+        await synapse_admin.close_client()
+        database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join/kick room members to match the groups mapped to each room.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the joins/kicks that would be made")
+    parser.add_argument("--source", choices=("store", "authentik"), default=RECONCILE_SOURCE,
+                        help="Where group members are read from")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,277 @@
+# SCIM Bulk (RFC 7644 section 3.7). All operations of a request are applied as one batch: Synapse upserts of different
+# users run concurrently, every store write happens in one transaction and the room joins of all groups go into one job.
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Request
+from pydantic import BaseModel, Field, ValidationError
+
+from config import SCIM_BULK_MAX_OPERATIONS, SCIM_BULK_MAX_PAYLOAD_SIZE, SYNC_CONCURRENCY
+from scim import handle_user, handle_group
+from scim.main import SCIMUser, SCIMUserUpdate, SCIMGroup, SCIMGroupUpdate, db_get_group, db_create_user, \
+    db_update_user, db_create_group, db_update_group
+from synapse.user import generate_matrix_id
+from utilities import auth, database, fast_json, jobs
+from utilities.fast_json import JSONResponse
+from utils import log, LogLevel
+
+SCIM_BULK_REQUEST_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+SCIM_BULK_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkResponse"
+SCIM_ERROR_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:Error"
+
+BULK_ID_PREFIX = "bulkId:"
+
+MODELS = {
+    ("POST", "Users"): SCIMUser,
+    ("PUT", "Users"): SCIMUserUpdate,
+    ("POST", "Groups"): SCIMGroup,
+    ("PUT", "Groups"): SCIMGroupUpdate,
+}
+
+
+class SCIMBulkOperation(BaseModel):
+    method: str
+    path: str
+    bulkId: Optional[str] = None
+    version: Optional[str] = None
+    data: Optional[Dict[str, Any]] = None
+
+
+class SCIMBulkRequest(BaseModel):
+    schemas: List[str] = Field(default=[SCIM_BULK_REQUEST_SCHEMA])
+    failOnErrors: Optional[int] = None
+    Operations: List[SCIMBulkOperation]
+
+
+class BulkError(Exception):
+    def __init__(self, status: int, detail: str, scim_type: Optional[str] = None):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.scim_type = scim_type
+
+
+def error_content(status: int, detail: str, scim_type: Optional[str] = None):
+    content = {"schemas": [SCIM_ERROR_SCHEMA], "status": str(status), "detail": detail}
+    if scim_type:
+        content["scimType"] = scim_type
+    return content
+
+
+# One operation of a bulk request, carried through validation, the Synapse upsert and the store write
+class PreparedOperation:
+    __slots__ = ("operation", "method", "resource", "resource_id", "model", "data", "matrix_id", "error")
+
+    def __init__(self, operation: SCIMBulkOperation):
+        self.operation = operation
+        self.method = operation.method.upper()
+        self.resource = None
+        self.resource_id = None
+        self.model = None
+        # The dumped group, stored and returned as is
+        self.data = None
+        self.matrix_id = None
+        self.error = None
+
+    @property
+    def id(self):
+        if self.resource == "Users" and self.method == "POST":
+            return self.matrix_id
+        if self.method == "POST":
+            return self.model.externalId
+        return self.resource_id
+
+
+# Check an operation's method/path and validate its data
+def validate(prepared: PreparedOperation):
+    operation = prepared.operation
+    parts = operation.path.strip("/").split("/")
+    prepared.resource = parts[0]
+    if prepared.resource not in ("Users", "Groups"):
+        raise BulkError(400, f"Unsupported path: {operation.path}", "invalidPath")
+
+    if prepared.method == "POST":
+        if len(parts) != 1:
+            raise BulkError(400, f"Invalid path for POST: {operation.path}", "invalidPath")
+        if not operation.bulkId:
+            raise BulkError(400, "bulkId is required for POST operations", "invalidValue")
+    elif prepared.method == "PUT":
+        if len(parts) != 2:
+            raise BulkError(400, f"Invalid path for PUT: {operation.path}", "invalidPath")
+        prepared.resource_id = parts[1]
+    else:
+        raise BulkError(405, f"Unsupported bulk method: {operation.method}")
+
+    try:
+        prepared.model = MODELS[(prepared.method, prepared.resource)].model_validate(operation.data or {})
+    except ValidationError as e:
+        raise BulkError(400, f"Invalid {prepared.resource} data: {e.errors(include_url=False)}", "invalidSyntax")
+
+
+# Create/update the user in Synapse
+async def upsert_user(prepared: PreparedOperation):
+    user = prepared.model
+    email = user.emails[0].value if user.emails else None
+    try:
+        if prepared.method == "POST":
+            prepared.matrix_id = await handle_user.post(user.externalId, user.displayName, email)
+        else:
+            prepared.matrix_id = await handle_user.put(prepared.resource_id, user.externalId, user.displayName, email)
+    except Exception as e:
+        log(LogLevel.ERROR, f"Bulk {prepared.method} {prepared.operation.path} failed: {e!r}")
+        raise BulkError(500, "Error creating or modifying user.")
+
+
+# The Matrix ID of the user an operation changes, a POST creates it from the externalId
+def get_user_key(prepared: PreparedOperation):
+    if prepared.method == "PUT":
+        return prepared.resource_id
+    return generate_matrix_id(prepared.model.externalId)
+
+
+# Replace bulkId references to users created earlier in the request with their IDs
+def resolve_members(prepared: PreparedOperation, bulk_ids):
+    for member in prepared.model.members or ():
+        if member["value"].startswith(BULK_ID_PREFIX):
+            bulk_id = member["value"][len(BULK_ID_PREFIX):]
+            if bulk_id not in bulk_ids:
+                raise BulkError(409, f"Unresolved bulkId reference: {member['value']}", "invalidValue")
+            member["value"] = bulk_ids[bulk_id]
+
+
+def response_for(prepared: PreparedOperation, base_location: str):
+    operation = prepared.operation
+    result = {"method": prepared.method}
+    if operation.bulkId:
+        result["bulkId"] = operation.bulkId
+
+    if prepared.error is not None:
+        result["status"] = str(prepared.error.status)
+        result["response"] = error_content(prepared.error.status, prepared.error.detail, prepared.error.scim_type)
+        return result
+
+    result["location"] = f"{base_location}/{prepared.resource}/{prepared.id}"
+    result["status"] = "201" if prepared.method == "POST" else "200"
+    if prepared.method == "POST":
+        data = prepared.data if prepared.data is not None else prepared.model.model_dump()
+        result["response"] = {"id": prepared.id, **data}
+    return result
+
+
+async def process(bulk_request: SCIMBulkRequest):
+    prepared_operations = [PreparedOperation(operation) for operation in bulk_request.Operations]
+    fail_on_errors = bulk_request.failOnErrors
+    bulk_ids = {}
+
+    for prepared in prepared_operations:
+        try:
+            validate(prepared)
+        except BulkError as e:
+            prepared.error = e
+
+    async def prepare(prepared):
+        try:
+            if prepared.resource == "Users":
+                await upsert_user(prepared)
+                if prepared.operation.bulkId:
+                    bulk_ids[prepared.operation.bulkId] = prepared.matrix_id
+            else:
+                resolve_members(prepared, bulk_ids)
+        except BulkError as e:
+            prepared.error = e
+
+    if fail_on_errors:
+        # Processing must stop at the failOnErrors-th error, so operations run one at a time in order
+        errors = 0
+        for index, prepared in enumerate(prepared_operations):
+            if prepared.error is None:
+                await prepare(prepared)
+            if prepared.error is not None:
+                errors += 1
+                if errors >= fail_on_errors:
+                    prepared_operations = prepared_operations[:index + 1]
+                    break
+    else:
+        # Users first, so groups can reference users created anywhere in the request by bulkId.
+        # Operations on the same user run one after another in request order, so the last one wins in Synapse too.
+        semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+        by_user = {}
+        for prepared in prepared_operations:
+            if prepared.error is None and prepared.resource == "Users":
+                by_user.setdefault(get_user_key(prepared), []).append(prepared)
+
+        async def prepare_in_order(user_operations):
+            for prepared in user_operations:
+                async with semaphore:
+                    await prepare(prepared)
+
+        await asyncio.gather(*map(prepare_in_order, by_user.values()))
+        for prepared in prepared_operations:
+            if prepared.error is None and prepared.resource == "Groups":
+                await prepare(prepared)
+
+    # Every store write in one transaction, planning the group room operations as we go.
+    # Unlike the single-user routes, which store a user before creating/updating it in Synapse, users are only stored
+    # once their upserts are done: groups are stored in the same transaction with the Matrix IDs the upserts returned
+    # for their bulkId members, and a user whose upsert failed is answered with an error without being stored.
+    room_operations = []
+    with database.transaction():
+        for prepared in prepared_operations:
+            if prepared.error is not None:
+                continue
+
+            if prepared.resource == "Users":
+                if prepared.method == "POST":
+                    db_create_user(prepared.model)
+                else:
+                    db_update_user(prepared.resource_id, prepared.model)
+            elif prepared.method == "POST":
+                prepared.data = prepared.model.model_dump()
+                db_create_group(prepared.model.externalId, prepared.data)
+                room_operations.extend(handle_group.plan(prepared.model))
+            else:
+                previous_group = db_get_group(prepared.resource_id)
+                prepared.data = prepared.model.model_dump()
+                db_update_group(prepared.resource_id, prepared.data)
+                room_operations.extend(handle_group.plan(prepared.model, previous_group))
+
+    # Room operations of the whole batch as one job, duplicates across groups are only queued once
+    job = jobs.submit(room_operations, reconcile_failed=True)
+    return prepared_operations, job
+
+
+router = APIRouter()
+
+
+@router.post("/Bulk")
+async def bulk(request: Request, token: str = Depends(auth.verify_token)):
+    body = await request.body()
+    if len(body) > SCIM_BULK_MAX_PAYLOAD_SIZE:
+        return JSONResponse(status_code=413, content=error_content(
+            413, f"The size of the bulk operation exceeds the maxPayloadSize ({SCIM_BULK_MAX_PAYLOAD_SIZE})."
+        ))
+
+    try:
+        bulk_request = SCIMBulkRequest.model_validate(fast_json.loads(body))
+    except (ValueError, ValidationError) as e:
+        log(LogLevel.ERROR, f"Invalid bulk request: {e}")
+        return JSONResponse(status_code=400, content=error_content(400, "Invalid bulk request", "invalidSyntax"))
+
+    if len(bulk_request.Operations) > SCIM_BULK_MAX_OPERATIONS:
+        return JSONResponse(status_code=413, content=error_content(
+            413, f"The number of operations exceeds the maxOperations ({SCIM_BULK_MAX_OPERATIONS})."
+        ))
+
+    log(LogLevel.INFO, f"SCIM Bulk: {len(bulk_request.Operations)} operations")
+
+    prepared_operations, job = await process(bulk_request)
+    base_location = str(request.url).rsplit("/Bulk", 1)[0]
+
+    return JSONResponse(
+        status_code=200,
+        content={
+            "schemas": [SCIM_BULK_RESPONSE_SCHEMA],
+            "Operations": [response_for(prepared, base_location) for prepared in prepared_operations],
+        },
+        headers={"X-Job-ID": job.id}
+    )
@@ -1,31 +1,68 @@
 # Matrix has no concept of groups, we are instead mapping any users within a group to specific rooms in Matrix.
-from typing import TYPE_CHECKING, Union
+from typing import TYPE_CHECKING, Optional, Union
 
-from config import IDP_GROUP_TO_ROOM
-from synapse.room import add_to_rooms
+from config import SCIM_GROUP_SYNC_MODE
+from scim import store
+from synapse.room import reconcile_room
+from utilities import room_mapping
 from utils import LogLevel, log
 
 if TYPE_CHECKING:
     from scim.main import SCIMGroup, SCIMGroupUpdate
 
 
-def process(group: Union['SCIMGroup', 'SCIMGroupUpdate']):
-    assigned_rooms = IDP_GROUP_TO_ROOM.get(group.externalId, [])
+# Get the user members added to and removed from a group since previous_group (the stored version of the group, or
+# None for a new group). A group without a member list leaves the members unchanged.
+def get_members_delta(group: Union['SCIMGroup', 'SCIMGroupUpdate'], previous_group: Optional[dict] = None):
+    if group.members is None:
+        return set(), set()
 
-    if group.members is not None:
-        for member in group.members:
-            # Check member is of type User
-            if member.ref == "Group":
-                continue
+    # Check member is of type User
+    members = {member["value"] for member in group.members if member["ref"] != "Group"}
+    previous_members = {
+        member["value"] for member in (previous_group or {}).get("members") or () if member.get("ref") != "Group"
+    }
+    return members - previous_members, previous_members - members
 
-            # Add User to Rooms
-            if len(assigned_rooms) == 0:
-                log(LogLevel.DEBUG, f"Group: {group.displayName} ({group.externalId}) has no assigned rooms.")
-                continue
-            log(LogLevel.DEBUG, f"Attempting to add {member.value} to rooms: {assigned_rooms}")
-            matrix_id = member.value
-            add_to_rooms(matrix_id, assigned_rooms)
 
-        # TODO: Remove users from rooms if they are no longer in the group
-        # Need to fetch all users in each effected room and compare to group members
-    log(LogLevel.DEBUG, f"Processed group: {group.displayName} ({group.externalId}), but found no members.")
+# Plan the room operations for the members added/removed since previous_group, as (action, matrix_id, room_id) tuples
+# for the job queue. The group must already be stored, reconcile mode reads the rooms' members from the store.
+def plan(group: Union['SCIMGroup', 'SCIMGroupUpdate'], previous_group: Optional[dict] = None):
+    added, removed = get_members_delta(group, previous_group)
+    return plan_members(group.externalId, group.displayName, added, removed)
+
+
+# Plan the room operations for user members added to/removed from the group with the external ID
+def plan_members(external_id: Optional[str], display_name: Optional[str], added, removed):
+    if not added and not removed:
+        log(LogLevel.DEBUG, "Processed group: %s (%s), but found no member changes.", display_name, external_id)
+        return []
+
+    group_to_rooms = room_mapping.get().group_to_rooms
+    assigned_rooms = group_to_rooms.get(external_id, frozenset())
+
+    if len(assigned_rooms) == 0:
+        log(LogLevel.DEBUG, "Group: %s (%s) has no assigned rooms.", display_name, external_id)
+        return []
+
+    log(LogLevel.DEBUG, "Group: %s (%s) has %d added and %d removed members for rooms: %s", display_name, external_id,
+        len(added), len(removed), assigned_rooms)
+
+    # Fetch each room's members once and only join/kick the differences
+    if SCIM_GROUP_SYNC_MODE == "reconcile":
+        return [("reconcile", None, room_id) for room_id in sorted(assigned_rooms)]
+
+    # Add new members to rooms. Removed members are left in them, another of their groups (maybe one only synced by the
+    # webhooks) may still grant the room.
+    return [("join", matrix_id, room_id) for matrix_id in sorted(added) for room_id in sorted(assigned_rooms)]
+
+
+# Only join/kick the differences between a room's members and the members of every group mapped to that room. Nobody
+# is kicked if any of those groups isn't stored, i.e. when its members only arrive over the webhooks.
+# Returns a dict of (matrix_id, room_id) -> success, or None if the room's members couldn't be fetched.
+async def reconcile_mapped_room(room_id: str):
+    groups = room_mapping.get().room_to_groups.get(room_id, ())
+    unknown = store.get_unknown_groups(groups)
+    if unknown:
+        log(LogLevel.INFO, f"Not kicking anyone from {room_id}, its groups {unknown} aren't stored.")
+    return await reconcile_room(room_id, store.get_members_of_groups(groups), kick=not unknown)
@@ -1,21 +1,24 @@
 from typing import Optional
 
+from config import USER_FORCE_SYNC
 from synapse import user
 from synapse.user import generate_matrix_id
 
 
-def post(external_id: str, display_name: str, email: Optional[str] = None):
+async def post(external_id: str, display_name: str, email: Optional[str] = None):
     # Check if User exists, return matrix ID if it does
     # If user doesn't exist create user and return matrix ID
 
-    matrix_id = user.get_matrix_account_id(external_id)
+    matrix_id = await user.get_matrix_account_id(external_id)
     if matrix_id is None:
         generated_matrix_id = generate_matrix_id(external_id)
-        user.create_or_modify_user(generated_matrix_id, display_name, external_id, email)
+        await user.create_or_modify_user(generated_matrix_id, display_name, external_id, email)
         matrix_id = generated_matrix_id
     return matrix_id
 
 
-def put(matrix_id: str, external_id: str, display_name: str, email: Optional[str] = None):
-    user.create_or_modify_user(matrix_id, display_name, external_id, email)
+# Unchanged users aren't sent to Synapse again, unless force is set
+async def put(matrix_id: str, external_id: str, display_name: str, email: Optional[str] = None,
+              force: bool = USER_FORCE_SYNC):
+    await user.create_or_modify_user(matrix_id, display_name, external_id, email, force)
     return matrix_id
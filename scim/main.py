@@ -1,15 +1,14 @@
-import json
-import os
-
-from fastapi import APIRouter, HTTPException, Path, Depends, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException, Path, Depends, Request, Query
+from fastapi.responses import Response
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Literal, Dict, Any, Optional, Union
+from typing_extensions import Annotated, TypedDict
 
-from config import DATA_DIR
-from utilities import auth
+from config import SCIM_BULK_MAX_OPERATIONS, SCIM_BULK_MAX_PAYLOAD_SIZE, SCIM_FILTER_MAX_RESULTS, USER_FORCE_SYNC
+from utilities import auth, jobs, metrics
+from utilities.fast_json import JSONResponse
 from utils import log, LogLevel
-from scim import handle_user, handle_group
+from scim import handle_user, handle_group, patch, query, store
 
 # SCIM Schemas
 SCIM_USER_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:User"
@@ -51,9 +50,10 @@ class SCIMUserUpdate(BaseModel):
     active: Optional[bool] = Field(None, title="User active status")
     externalId: Optional[str] = Field(None, title="External identifier for the user")
 
-class SCIMGroupMember(BaseModel):
+# A plain dict rather than a model, groups can have tens of thousands of members
+class SCIMGroupMember(TypedDict):
     value: str
-    ref: Optional[str] = Field(None, alias="$ref")
+    ref: Annotated[Optional[str], Field(None, alias="$ref")]
 
 class SCIMGroup(BaseModel):
     schemas: List[str] = [SCIM_GROUP_SCHEMA]
@@ -68,58 +68,68 @@ class SCIMGroupUpdate(BaseModel):
     members: Optional[List[SCIMGroupMember]] = None
     externalId: Optional[str] = Field(None, title="External identifier for the group")
 
-# File Stores
-user_file_location = f"{DATA_DIR}/users.json"
-group_file_location = f"{DATA_DIR}/groups.json"
 
-# Create Files if they don't exist
-if not os.path.exists(user_file_location):
-    with open(user_file_location, "w") as f:
-        json.dump({}, f)
+class SCIMPatchOperation(BaseModel):
+    op: str
+    path: Optional[str] = None
+    value: Optional[Any] = None
+
 
-if not os.path.exists(group_file_location):
-    with open(group_file_location, "w") as f:
-        json.dump({}, f)
+class SCIMPatchRequest(BaseModel):
+    schemas: List[str] = Field(default=[patch.SCIM_PATCH_SCHEMA])
+    Operations: List[SCIMPatchOperation]
 
 # Database Functions
 
+STORAGE_SECONDS = metrics.Histogram(
+    "storage_operation_duration_seconds", "Time taken by SCIM store reads and writes.", ("operation",),
+    buckets=metrics.FAST_BUCKETS
+)
+
+@metrics.timed(STORAGE_SECONDS, "get_user")
 def db_get_user(user_id: str):
-    with open(user_file_location, "r") as f:
-        users = json.load(f)
-    return users.get(user_id, None)
+    return store.get_user(user_id)
 
-def db_get_group(group_id: str):
-    with open(group_file_location, "r") as f:
-        groups = json.load(f)
-    return groups.get(group_id, None)
+@metrics.timed(STORAGE_SECONDS, "get_group")
+def db_get_group(group_id: str, with_members: bool = True):
+    return store.get_group(group_id, with_members)
 
+@metrics.timed(STORAGE_SECONDS, "create_user")
 def db_create_user(user: SCIMUser):
-    with open(user_file_location, "r") as f:
-        users = json.load(f)
-    users[user.externalId] = user.model_dump()
-    with open(user_file_location, "w") as f:
-        json.dump(users, f)
-
-def db_create_group(group: SCIMGroup):
-    with open(group_file_location, "r") as f:
-        groups = json.load(f)
-    groups[group.externalId] = group.model_dump()
-    with open(group_file_location, "w") as f:
-        json.dump(groups, f)
+    store.put_user(user.externalId, user.model_dump())
 
+# Groups are passed dumped, so the same dump can be reused for the response
+@metrics.timed(STORAGE_SECONDS, "create_group")
+def db_create_group(group_id: str, group: dict):
+    store.put_group(group_id, group)
+
+@metrics.timed(STORAGE_SECONDS, "update_user")
 def db_update_user(user_id: str, update_data: SCIMUserUpdate):
-    with open(user_file_location, "r") as f:
-        users = json.load(f)
-    users[user_id] = update_data.model_dump()
-    with open(user_file_location, "w") as f:
-        json.dump(users, f)
-
-def db_update_group(group_id: str, update_data: SCIMGroupUpdate):
-    with open(group_file_location, "r") as f:
-        groups = json.load(f)
-    groups[group_id] = update_data.model_dump()
-    with open(group_file_location, "w") as f:
-        json.dump(groups, f)
+    store.put_user(user_id, update_data.model_dump())
+
+@metrics.timed(STORAGE_SECONDS, "update_group")
+def db_update_group(group_id: str, group: dict):
+    store.put_group(group_id, group)
+
+@metrics.timed(STORAGE_SECONDS, "update_group_members")
+def db_update_group_members(group_id: str, group: dict, added: dict, removed):
+    store.update_group_members(group_id, group, added, removed)
+
+@metrics.timed(STORAGE_SECONDS, "list_users")
+def db_list_users(where, parameters, offset: int, limit: int):
+    return store.list_users(where, parameters, offset, limit)
+
+@metrics.timed(STORAGE_SECONDS, "list_groups")
+def db_list_groups(where, parameters, offset: int, limit: int, with_members: bool):
+    return store.list_groups(where, parameters, offset, limit, with_members)
+
+# Compile a list request's filter and paging to store.list_* arguments
+def db_list_arguments(filter_expression: Optional[str], columns: dict, start_index: int, count: Optional[int]):
+    where, parameters = query.compile_filter(filter_expression, columns) if filter_expression else (None, [])
+    # startIndex is 1-based, values below 1 are treated as 1
+    offset = max(start_index, 1) - 1
+    limit = SCIM_FILTER_MAX_RESULTS if count is None else min(max(count, 0), SCIM_FILTER_MAX_RESULTS)
+    return where, parameters, offset, limit
 
 # SCIM Routes
 
@@ -131,9 +141,13 @@ async def service_provider_config():
     return JSONResponse(
         content={
             "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"],
-            "patch": {"supported": False},
-            "bulk": {"supported": False},
-            "filter": {"supported": False},
+            "patch": {"supported": True},
+            "bulk": {
+                "supported": True,
+                "maxOperations": SCIM_BULK_MAX_OPERATIONS,
+                "maxPayloadSize": SCIM_BULK_MAX_PAYLOAD_SIZE
+            },
+            "filter": {"supported": True, "maxResults": SCIM_FILTER_MAX_RESULTS},
             "changePassword": {"supported": False},
             "sort": {"supported": False},
             "etag": {"supported": False},
@@ -156,15 +170,30 @@ async def service_provider_config():
 @router.post("/Users")
 async def create_user(user: SCIMUser, token: str = Depends(auth.verify_token)):
 
-    log(LogLevel.DEBUG, f"Attempting to Create User with: {user.model_dump()}")
+    log(LogLevel.DEBUG, "Attempting to Create User with: %r", user)
     log(LogLevel.INFO, f"SCIM User POST: {user.userName}")
 
     db_create_user(user)
-    matrix_id = handle_user.post(user.externalId, user.displayName, user.emails[0].value)
+    matrix_id = await handle_user.post(user.externalId, user.displayName, user.emails[0].value)
 
     return JSONResponse(status_code=201, content={"id": matrix_id, **user.model_dump()})
 
 
+# List/Filter Users
+@router.get("/Users")
+async def list_users(filter_expression: Optional[str] = Query(None, alias="filter"), startIndex: int = 1,
+                     count: Optional[int] = None, attributes: Optional[str] = None,
+                     excludedAttributes: Optional[str] = None, token: str = Depends(auth.verify_token)):
+
+    log(LogLevel.DEBUG, "SCIM User list: filter=%s startIndex=%d count=%s", filter_expression, startIndex, count)
+
+    where, parameters, offset, limit = db_list_arguments(filter_expression, store.USER_COLUMNS, startIndex, count)
+    total, users = db_list_users(where, parameters, offset, limit)
+    resources = [query.project({"id": user_id, **user}, attributes, excludedAttributes) for user_id, user in users]
+
+    return JSONResponse(status_code=200, content=query.list_response(resources, total, offset + 1))
+
+
 # Get User
 @router.get("/Users/{user_id}")
 async def get_user(user_id: str, token: str = Depends(auth.verify_token)):
@@ -177,13 +206,38 @@ async def get_user(user_id: str, token: str = Depends(auth.verify_token)):
 
 # Update User
 @router.put("/Users/{user_id}")
-async def update_user(user_id: str, update_data: SCIMUserUpdate, token: str = Depends(auth.verify_token)):
+async def update_user(user_id: str, update_data: SCIMUserUpdate, force: bool = USER_FORCE_SYNC,
+                      token: str = Depends(auth.verify_token)):
 
-    log(LogLevel.DEBUG, f"User updated: {user_id} -> {update_data.model_dump()}")
+    log(LogLevel.DEBUG, "User updated: %s -> %r", user_id, update_data)
     log(LogLevel.INFO, f"SCIM User PUT: {user_id}")
 
     db_update_user(user_id, update_data)
-    handle_user.put(user_id, update_data.externalId, update_data.displayName, update_data.emails[0].value)
+    await handle_user.put(user_id, update_data.externalId, update_data.displayName, update_data.emails[0].value, force)
+
+    return JSONResponse(status_code=200, content={"id": update_data.externalId, **update_data.model_dump()})
+
+
+# Patch User
+@router.patch("/Users/{user_id}")
+async def patch_user(user_id: str, patch_data: SCIMPatchRequest, force: bool = USER_FORCE_SYNC,
+                     token: str = Depends(auth.verify_token)):
+
+    log(LogLevel.DEBUG, "User patched: %s -> %r", user_id, patch_data)
+    log(LogLevel.INFO, f"SCIM User PATCH: {user_id}")
+
+    user = db_get_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    try:
+        update_data = SCIMUserUpdate.model_validate(patch.apply_user_patch(user, patch_data.Operations))
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid patched user: {e.errors(include_url=False)}")
+
+    db_update_user(user_id, update_data)
+    email = update_data.emails[0].value if update_data.emails else None
+    await handle_user.put(user_id, update_data.externalId, update_data.displayName, email, force)
 
     return JSONResponse(status_code=200, content={"id": update_data.externalId, **update_data.model_dump()})
 
@@ -199,13 +253,32 @@ async def update_user(user_id: str, update_data: SCIMUserUpdate, token: str = De
 @router.post("/Groups")
 async def create_group(group: SCIMGroup, token: str = Depends(auth.verify_token)):
 
-    log(LogLevel.DEBUG, f"Group created: {group.model_dump()}")
+    log(LogLevel.DEBUG, "Group created: %r", group)
     log(LogLevel.INFO, f"SCIM Group POST: {group.displayName}")
 
-    db_create_group(group)
-    handle_group.process(group)
+    data = group.model_dump()
+    db_create_group(group.externalId, data)
+    job = jobs.submit(handle_group.plan(group), reconcile_failed=True)
+
+    return JSONResponse(status_code=201, content={"id": group.externalId, **data},
+                        headers={"X-Job-ID": job.id})
+
 
-    return JSONResponse(status_code=201, content={"id": group.externalId, **group.model_dump()})
+# List/Filter Groups
+@router.get("/Groups")
+async def list_groups(filter_expression: Optional[str] = Query(None, alias="filter"), startIndex: int = 1,
+                      count: Optional[int] = None, attributes: Optional[str] = None,
+                      excludedAttributes: Optional[str] = None, token: str = Depends(auth.verify_token)):
+
+    log(LogLevel.DEBUG, "SCIM Group list: filter=%s startIndex=%d count=%s", filter_expression, startIndex, count)
+
+    where, parameters, offset, limit = db_list_arguments(filter_expression, store.GROUP_COLUMNS, startIndex, count)
+    # Member lists can be large, so they're only loaded when returned
+    with_members = query.is_returned("members", attributes, excludedAttributes)
+    total, groups = db_list_groups(where, parameters, offset, limit, with_members)
+    resources = [query.project({"id": group_id, **group}, attributes, excludedAttributes) for group_id, group in groups]
+
+    return JSONResponse(status_code=200, content=query.list_response(resources, total, offset + 1))
 
 
 # Get Group
@@ -222,13 +295,49 @@ async def get_group(group_id: str, token: str = Depends(auth.verify_token)):
 @router.put("/Groups/{group_id}")
 async def update_group(group_id: str, update_data: SCIMGroupUpdate, token: str = Depends(auth.verify_token)):
 
-    log(LogLevel.DEBUG, f"Group updated: {group_id} -> {update_data.model_dump()}")
+    log(LogLevel.DEBUG, "Group updated: %s -> %r", group_id, update_data)
     log(LogLevel.INFO, f"SCIM Group PUT: {update_data.displayName}")
 
-    db_update_group(group_id, update_data)
-    handle_group.process(update_data)
+    previous_group = db_get_group(group_id)
+    data = update_data.model_dump()
+    db_update_group(group_id, data)
+    job = jobs.submit(handle_group.plan(update_data, previous_group), reconcile_failed=True)
 
-    return JSONResponse(status_code=200, content={"id": update_data.externalId, **update_data.model_dump()})
+    return JSONResponse(status_code=200, content={"id": update_data.externalId, **data},
+                        headers={"X-Job-ID": job.id})
+
+
+# Patch Group, member changes are applied as a delta so only the changed members are stored and synced
+@router.patch("/Groups/{group_id}")
+async def patch_group(group_id: str, patch_data: SCIMPatchRequest, token: str = Depends(auth.verify_token)):
+
+    log(LogLevel.DEBUG, "Group patched: %s -> %r", group_id, patch_data)
+    log(LogLevel.INFO, f"SCIM Group PATCH: {group_id}")
+
+    group = db_get_group(group_id, with_members=False)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    def get_members():
+        return {member["value"] for member in db_get_group(group_id)["members"] or ()}
+
+    delta = patch.apply_group_patch(group, patch_data.Operations, get_members)
+
+    # Only keep the member changes that change anything
+    existing = store.get_group_members_in(group_id, delta.added.keys() | delta.removed)
+    added = {value: ref for value, ref in delta.added.items() if value not in existing}
+    removed = {value: ref for value, ref in existing.items() if value in delta.removed}
+
+    db_update_group_members(group_id, group, added, removed)
+    job = jobs.submit(handle_group.plan_members(
+        group.get("externalId"),
+        group.get("displayName"),
+        # Check member is of type User
+        {value for value, ref in added.items() if ref != "Group"},
+        {value for value, ref in removed.items() if ref != "Group"}
+    ), reconcile_failed=True)
+
+    return Response(status_code=204, headers={"X-Job-ID": job.id})
 
 
 # # Delete Group
@@ -0,0 +1,147 @@
+# SCIM PATCH (RFC 7644 section 3.5.2) for users and groups.
+# Group member changes are applied as a delta, so adding/removing one member doesn't touch the rest of the group.
+import re
+from typing import Any, Callable
+
+from fastapi import HTTPException
+
+SCIM_PATCH_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:PatchOp"
+
+# attribute[subAttribute eq "value"] with an optional .subAttribute after it, i.e. members[value eq "abc"]
+VALUE_FILTER = re.compile(r'^(\w+)\[(\w+) eq "([^"]*)"\](?:\.(\w+))?$')
+
+GROUP_ATTRIBUTES = ("displayName", "externalId")
+USER_ATTRIBUTES = ("userName", "name", "displayName", "emails", "active", "externalId")
+
+
+def _error(detail: str):
+    return HTTPException(status_code=400, detail=detail)
+
+
+def _get_op(operation) -> str:
+    op = operation.op.lower()
+    if op not in ("add", "remove", "replace"):
+        raise _error(f"Unsupported patch op: {operation.op}")
+    return op
+
+
+# (path, value) pairs an operation applies to, an operation without a path applies each attribute of its value
+def _get_targets(op: str, operation):
+    if operation.path is not None:
+        return [(operation.path, operation.value)]
+    if op == "remove":
+        raise _error("A remove operation requires a path")
+    if not isinstance(operation.value, dict):
+        raise _error("An operation without a path requires an object value")
+    return list(operation.value.items())
+
+
+# Member values and refs from a patch value, a list of members or a single member
+def _get_members(value) -> dict:
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(member, dict) and "value" in member for member in value):
+        raise _error("Members must be objects with a value")
+    return {member["value"]: member.get("$ref", member.get("ref")) for member in value}
+
+
+class GroupMembersDelta:
+    def __init__(self):
+        self.added = {}
+        self.removed = set()
+
+    def add(self, members: dict):
+        for value, ref in members.items():
+            self.removed.discard(value)
+            self.added[value] = ref
+
+    def remove(self, values):
+        for value in values:
+            self.added.pop(value, None)
+            self.removed.add(value)
+
+
+# Apply patch operations to a stored group (without its members), returning the member delta. get_members is only
+# called to load the current members for operations that need the whole list (replacing or removing all members).
+def apply_group_patch(group: dict, operations, get_members: Callable[[], set]) -> GroupMembersDelta:
+    delta = GroupMembersDelta()
+
+    for operation in operations:
+        op = _get_op(operation)
+        for path, value in _get_targets(op, operation):
+            member_filter = VALUE_FILTER.match(path)
+            if member_filter is not None:
+                attribute, sub_attribute, filter_value, _ = member_filter.groups()
+                if attribute != "members" or sub_attribute != "value" or op != "remove":
+                    raise _error(f"Unsupported patch path: {path}")
+                delta.remove([filter_value])
+
+            elif path == "members":
+                if op == "add":
+                    delta.add(_get_members(value))
+                elif op == "remove" and value is None:
+                    delta.remove(get_members() | delta.added.keys())
+                elif op == "remove":
+                    delta.remove(_get_members(value))
+                else:
+                    members = _get_members(value)
+                    delta.remove((get_members() | delta.added.keys()) - members.keys())
+                    delta.add(members)
+
+            elif path in GROUP_ATTRIBUTES:
+                group[path] = None if op == "remove" else value
+
+            else:
+                raise _error(f"Unsupported patch path: {path}")
+
+    return delta
+
+
+def _set_value(target: dict, attribute: str, op: str, value: Any):
+    if op == "remove":
+        target.pop(attribute, None)
+    elif op == "add" and isinstance(target.get(attribute), list) and isinstance(value, list):
+        target[attribute] = target[attribute] + value
+    else:
+        target[attribute] = value
+
+
+# Apply patch operations to a stored user, returning the patched user
+def apply_user_patch(user: dict, operations) -> dict:
+    user = dict(user)
+
+    for operation in operations:
+        op = _get_op(operation)
+        for path, value in _get_targets(op, operation):
+            value_filter = VALUE_FILTER.match(path)
+            if value_filter is not None:
+                # i.e. emails[type eq "work"].value
+                attribute, sub_attribute, filter_value, target_attribute = value_filter.groups()
+                if attribute not in USER_ATTRIBUTES or not isinstance(user.get(attribute), list):
+                    raise _error(f"Unsupported patch path: {path}")
+                matches = [item for item in user[attribute] if item.get(sub_attribute) == filter_value]
+                if not matches:
+                    raise HTTPException(status_code=400, detail=f"No values match: {path}")
+                if op == "remove" and target_attribute is None:
+                    user[attribute] = [item for item in user[attribute] if item not in matches]
+                for item in matches:
+                    if target_attribute is not None:
+                        _set_value(item, target_attribute, op, value)
+                    elif op != "remove":
+                        item.update(value if isinstance(value, dict) else {})
+                continue
+
+            attribute, _, sub_attribute = path.partition(".")
+            if attribute not in USER_ATTRIBUTES:
+                raise _error(f"Unsupported patch path: {path}")
+            if sub_attribute:
+                # i.e. name.givenName
+                parent = dict(user.get(attribute) or {})
+                _set_value(parent, sub_attribute, op, value)
+                user[attribute] = parent
+            else:
+                _set_value(user, attribute, op, value)
+
+    return user
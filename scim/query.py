@@ -0,0 +1,225 @@
+# SCIM list queries (RFC 7644 section 3.4.2): filters are compiled to SQL on the indexed store columns, so a lookup
+# like userName eq "x" is an index search instead of a scan of every stored resource.
+import json
+import re
+
+from fastapi import HTTPException
+
+SCIM_LIST_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:ListResponse"
+
+TOKEN = re.compile(r'\s*(\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+)')
+
+COMPARISONS = {"eq": "=", "ne": "!=", "gt": ">", "ge": ">=", "lt": "<", "le": "<="}
+OPERATORS = {*COMPARISONS, "co", "sw", "ew", "pr"}
+
+# Attributes returned whatever the attributes/excludedAttributes parameters ask for
+ALWAYS_RETURNED = {"id", "schemas"}
+
+# Largest character, used as the upper bound of a starts with (sw) range so it can use the column's index
+MAX_CHARACTER = "\U0010ffff"
+
+
+# Answered as a SCIM error with the invalidFilter scimType (RFC 7644 section 3.12)
+class InvalidFilter(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=400, detail=f"Invalid filter: {detail}")
+
+
+def _error(detail: str):
+    return InvalidFilter(detail)
+
+
+# Attribute names can be prefixed with their schema URN, i.e. urn:ietf:params:scim:schemas:core:2.0:User:userName
+def _attribute_name(attribute: str) -> str:
+    if attribute.lower().startswith("urn:"):
+        attribute = attribute.rsplit(":", 1)[1]
+    return attribute.lower()
+
+
+def _tokenize(expression: str):
+    tokens = []
+    expression = expression.strip()
+    position = 0
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise _error(f"Unexpected input at {position}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def _fold(sql: str, case_exact: bool) -> str:
+    return sql if case_exact else f"lower({sql})"
+
+
+class _Parser:
+    def __init__(self, tokens, columns: dict):
+        self.tokens = tokens
+        self.columns = columns
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].lower()
+        return None
+
+    def _next(self):
+        if self.position >= len(self.tokens):
+            raise _error("Unexpected end of filter")
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def parse(self):
+        sql, parameters = self._or()
+        if self.position < len(self.tokens):
+            raise _error(f"Unexpected {self.tokens[self.position]}")
+        return sql, parameters
+
+    def _or(self):
+        sql, parameters = self._and()
+        while self._peek() == "or":
+            self._next()
+            right_sql, right_parameters = self._and()
+            sql, parameters = f"({sql} OR {right_sql})", parameters + right_parameters
+        return sql, parameters
+
+    def _and(self):
+        sql, parameters = self._unary()
+        while self._peek() == "and":
+            self._next()
+            right_sql, right_parameters = self._unary()
+            sql, parameters = f"({sql} AND {right_sql})", parameters + right_parameters
+        return sql, parameters
+
+    def _unary(self):
+        token = self._peek()
+        if token == "not":
+            self._next()
+            sql, parameters = self._unary()
+            return f"NOT ({sql})", parameters
+        if token == "(":
+            self._next()
+            sql, parameters = self._or()
+            if self._next() != ")":
+                raise _error("Expected )")
+            return sql, parameters
+        return self._comparison()
+
+    def _comparison(self):
+        attribute = self._next()
+        if attribute in ("(", ")"):
+            raise _error(f"Unexpected {attribute}")
+        column = self.columns.get(_attribute_name(attribute))
+        if column is None:
+            raise _error(f"Unsupported attribute: {attribute}")
+        column, case_exact = column
+
+        operator = self._next().lower()
+        if operator not in OPERATORS:
+            raise _error(f"Unsupported operator: {operator}")
+        if operator == "pr":
+            return f"{column} IS NOT NULL", []
+
+        token = self._next()
+        try:
+            value = json.loads(token)
+        except ValueError:
+            raise _error(f"Invalid value: {token}")
+
+        if value is None:
+            if operator not in ("eq", "ne"):
+                raise _error(f"{operator} requires a value")
+            return f"{column} IS {'NOT ' if operator == 'ne' else ''}NULL", []
+        if not isinstance(value, str):
+            raise _error(f"Expected a string value for {attribute}")
+
+        # Comparisons on the column itself use its collation, so they can use its index
+        if operator in COMPARISONS:
+            return f"{column} {COMPARISONS[operator]} ?", [value]
+        if not value:
+            return f"{column} IS NOT NULL", []
+        if operator == "sw":
+            return f"({column} >= ? AND {column} < ?)", [value, value + MAX_CHARACTER]
+        if operator == "ew":
+            return f"{_fold(f'substr({column}, ?)', case_exact)} = {_fold('?', case_exact)}", [-len(value), value]
+        return f"instr({_fold(column, case_exact)}, {_fold('?', case_exact)}) > 0", [value]
+
+
+# Compile a filter to an SQL condition and its parameters. columns maps lowercase attribute names to their
+# (column, case exact) pair.
+def compile_filter(expression: str, columns: dict):
+    return _Parser(_tokenize(expression), columns).parse()
+
+
+# Attribute names from an attributes/excludedAttributes parameter, as a dict of attribute -> sub-attributes (None for
+# the whole attribute)
+def _parse_attributes(attributes: str) -> dict:
+    parsed = {}
+    for attribute in attributes.split(","):
+        attribute, _, sub_attribute = _attribute_name(attribute.strip()).partition(".")
+        if not attribute:
+            continue
+        if not sub_attribute:
+            parsed[attribute] = None
+        elif parsed.get(attribute, set()) is not None:
+            parsed.setdefault(attribute, set()).add(sub_attribute)
+    return parsed
+
+
+def is_returned(attribute: str, attributes=None, excluded_attributes=None) -> bool:
+    attribute = attribute.lower()
+    if attribute in ALWAYS_RETURNED:
+        return True
+    if attributes:
+        return attribute in _parse_attributes(attributes)
+    if excluded_attributes:
+        return _parse_attributes(excluded_attributes).get(attribute, set()) is not None
+    return True
+
+
+def _project_value(value, sub_attributes: set, keep: bool):
+    def project_item(item):
+        if not isinstance(item, dict):
+            return item
+        return {key: sub_value for key, sub_value in item.items() if (key.lower() in sub_attributes) == keep}
+
+    if isinstance(value, list):
+        return [project_item(item) for item in value]
+    return project_item(value)
+
+
+# Apply the attributes/excludedAttributes parameters to a resource
+def project(resource: dict, attributes=None, excluded_attributes=None) -> dict:
+    if attributes:
+        wanted = _parse_attributes(attributes)
+        projected = {}
+        for key, value in resource.items():
+            if key.lower() in ALWAYS_RETURNED:
+                projected[key] = value
+            elif key.lower() in wanted:
+                sub_attributes = wanted[key.lower()]
+                projected[key] = value if sub_attributes is None else _project_value(value, sub_attributes, True)
+        return projected
+
+    if excluded_attributes:
+        excluded = _parse_attributes(excluded_attributes)
+        projected = {}
+        for key, value in resource.items():
+            if key.lower() in ALWAYS_RETURNED or key.lower() not in excluded:
+                projected[key] = value
+            elif excluded[key.lower()] is not None:
+                projected[key] = _project_value(value, excluded[key.lower()], False)
+        return projected
+
+    return resource
+
+
+def list_response(resources, total: int, start_index: int):
+    return {
+        "schemas": [SCIM_LIST_RESPONSE_SCHEMA],
+        "totalResults": total,
+        "startIndex": start_index,
+        "itemsPerPage": len(resources),
+        "Resources": resources,
+    }
@@ -0,0 +1,307 @@
+# SQLite backed storage for SCIM users and groups
+import json
+import os
+import sys
+from typing import Optional
+
+from config import DATA_DIR
+from scim.store_cache import store_cache, GroupRecord
+from utilities import database
+from utils import log, LogLevel
+
+# Legacy JSON file stores, only read to import existing data into the database
+USER_JSON_FILE = f"{DATA_DIR}/users.json"
+GROUP_JSON_FILE = f"{DATA_DIR}/groups.json"
+
+# Filterable attributes of each resource: lowercase SCIM attribute -> (indexed column, case exact)
+USER_COLUMNS = {
+    "id": ("id", True),
+    "username": ("user_name", False),
+    "externalid": ("external_id", True),
+    "displayname": ("display_name", False),
+}
+GROUP_COLUMNS = {
+    "id": ("id", True),
+    "externalid": ("external_id", True),
+    "displayname": ("display_name", False),
+}
+
+
+def get_user(user_id: str) -> Optional[dict]:
+    if store_cache.enabled:
+        store_cache.check()
+        data = store_cache.users.get(user_id)
+        if data is not None or store_cache.complete:
+            store_cache.hits += 1
+            return json.loads(data) if data is not None else None
+        store_cache.misses += 1
+
+    row = database.fetchone("SELECT data FROM users WHERE id = ?", (user_id,))
+    if row is None:
+        return None
+    if store_cache.enabled:
+        store_cache.users[user_id] = row[0]
+    return json.loads(row[0])
+
+
+def put_user(user_id: str, user: dict):
+    data = json.dumps(user)
+    database.execute(
+        """
+        INSERT INTO users (id, external_id, user_name, display_name, data) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET external_id = excluded.external_id, user_name = excluded.user_name,
+            display_name = excluded.display_name, data = excluded.data
+        """,
+        (user_id, user.get("externalId"), user.get("userName"), user.get("displayName"), data)
+    )
+    if store_cache.enabled:
+        store_cache.users[user_id] = data
+
+
+# The cached record of a group, loaded from the database if it isn't cached
+def _get_group_record(group_id: str) -> Optional[GroupRecord]:
+    if store_cache.enabled:
+        store_cache.check()
+        record = store_cache.groups.get(group_id)
+        if record is not None or store_cache.complete:
+            store_cache.hits += 1
+            return record
+        store_cache.misses += 1
+
+    row = database.fetchone("SELECT data FROM groups WHERE id = ?", (group_id,))
+    if row is None:
+        return None
+    record = GroupRecord(row[0])
+    if store_cache.enabled:
+        store_cache.groups[group_id] = record
+    return record
+
+
+# With with_members=False the members aren't loaded, and are only present if the group has no member list (None)
+def get_group(group_id: str, with_members: bool = True) -> Optional[dict]:
+    record = _get_group_record(group_id)
+    if record is None:
+        return None
+    group = json.loads(record.data)
+
+    # Members are stored in their own table, a group stored with members=None keeps the key in its data
+    if "members" not in group and with_members:
+        members = record.members
+        if members is None:
+            rows = database.fetchall("SELECT value, ref FROM group_members WHERE group_id = ?", (group_id,))
+            store_cache.set_members(record, rows)
+            members = record.members
+        group["members"] = [{"value": value, "ref": ref} for value, ref in members.items()]
+    return group
+
+
+def put_group(group_id: str, group: dict):
+    group = dict(group)
+    members = group.pop("members", None)
+    if members is None:
+        group["members"] = None
+    data = json.dumps(group)
+
+    with database.transaction() as connection:
+        connection.execute(
+            """
+            INSERT INTO groups (id, external_id, display_name, data) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET external_id = excluded.external_id, display_name = excluded.display_name,
+                data = excluded.data
+            """,
+            (group_id, group.get("externalId"), group.get("displayName"), data)
+        )
+        # Only write the member rows that changed
+        members = {member["value"]: member.get("ref") for member in members or ()}
+        stored = {
+            value for value, in connection.execute("SELECT value FROM group_members WHERE group_id = ?", (group_id,))
+        }
+        connection.executemany(
+            "DELETE FROM group_members WHERE group_id = ? AND value = ?",
+            ((group_id, value) for value in stored - members.keys())
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO group_members (group_id, value, ref) VALUES (?, ?, ?)",
+            ((group_id, value, ref) for value, ref in members.items() if value not in stored)
+        )
+        if store_cache.enabled:
+            record = store_cache.groups[group_id] = GroupRecord(data)
+            store_cache.set_members(record, members.items())
+
+
+# Create or update a group without touching its member rows, a new group starts with an empty member list
+def put_group_info(group_id: str, group: dict):
+    group = {key: value for key, value in group.items() if key != "members"}
+    data = json.dumps(group)
+
+    with database.transaction() as connection:
+        connection.execute(
+            """
+            INSERT INTO groups (id, external_id, display_name, data) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET external_id = excluded.external_id, display_name = excluded.display_name,
+                data = excluded.data
+            """,
+            (group_id, group.get("externalId"), group.get("displayName"), data)
+        )
+        if store_cache.enabled:
+            record = store_cache.groups.get(group_id)
+            if record is None:
+                store_cache.groups[group_id] = GroupRecord(data)
+            else:
+                record.data = data
+
+
+# Apply a member delta to a stored group without touching its other members. added maps member values to their ref.
+def update_group_members(group_id: str, group: dict, added: dict, removed):
+    group = {key: value for key, value in group.items() if key != "members"}
+    data = json.dumps(group)
+
+    with database.transaction() as connection:
+        connection.execute(
+            "UPDATE groups SET external_id = ?, display_name = ?, data = ? WHERE id = ?",
+            (group.get("externalId"), group.get("displayName"), data, group_id)
+        )
+        connection.executemany(
+            "DELETE FROM group_members WHERE group_id = ? AND value = ?",
+            ((group_id, value) for value in removed)
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO group_members (group_id, value, ref) VALUES (?, ?, ?)",
+            ((group_id, value, ref) for value, ref in added.items())
+        )
+
+        record = store_cache.groups.get(group_id) if store_cache.enabled else None
+        if record is not None:
+            record.data = data
+            if record.members is not None:
+                for value in removed:
+                    record.members.pop(value, None)
+                record.members.update((sys.intern(value), ref) for value, ref in added.items())
+
+
+# Add (group_id, value, ref) member rows, to groups that are already stored
+def add_group_members(members):
+    members = list(members)
+    with database.transaction() as connection:
+        connection.executemany("INSERT OR REPLACE INTO group_members (group_id, value, ref) VALUES (?, ?, ?)", members)
+
+        if store_cache.enabled:
+            for group_id, value, ref in members:
+                record = store_cache.groups.get(group_id)
+                if record is not None and record.members is not None:
+                    record.members[sys.intern(value)] = ref
+
+
+# Get which of the values are members of a stored group, as a dict of value -> ref
+def get_group_members_in(group_id: str, values) -> dict:
+    record = _get_group_record(group_id) if store_cache.enabled else None
+    if record is not None and record.members is not None:
+        return {value: record.members[value] for value in values if value in record.members}
+
+    values = list(values)
+    members = {}
+    # Stay under SQLite's limit on the number of parameters
+    for start in range(0, len(values), 500):
+        chunk = values[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        members.update(database.fetchall(
+            f"SELECT value, ref FROM group_members WHERE group_id = ? AND value IN ({placeholders})", [group_id, *chunk]
+        ))
+    return members
+
+
+# Get the external IDs of every stored group the member is in
+def get_groups_of_member(value: str) -> set:
+    rows = database.fetchall(
+        "SELECT DISTINCT g.external_id FROM group_members m JOIN groups g ON g.id = m.group_id WHERE m.value = ?",
+        (value,)
+    )
+    return {row[0] for row in rows}
+
+
+# The groups (by external ID) the store has no record of, i.e. groups whose members only arrive over the webhooks. The
+# members of a room mapped to any of them aren't all known, so nobody is kicked from it.
+def get_unknown_groups(external_ids) -> list:
+    return sorted(group for group in external_ids if _get_group_record(group) is None)
+
+
+# Get the user members of every stored group with one of the given external IDs
+def get_members_of_groups(external_ids) -> set:
+    external_ids = list(external_ids)
+    if not external_ids:
+        return set()
+
+    placeholders = ", ".join("?" * len(external_ids))
+    rows = database.fetchall(
+        f"""
+        SELECT DISTINCT m.value FROM groups g JOIN group_members m ON m.group_id = g.id
+        WHERE g.external_id IN ({placeholders}) AND (m.ref IS NULL OR m.ref != 'Group')
+        """,
+        external_ids
+    )
+    return {row[0] for row in rows}
+
+
+# One page of the rows matching an SQL condition, returning the total number of matches and the page's (id, data) pairs
+def _list(table: str, where: Optional[str], parameters, offset: int, limit: int):
+    where = f"WHERE {where}" if where else ""
+    total = database.fetchone(f"SELECT COUNT(*) FROM {table} {where}", parameters)[0]
+    if limit <= 0 or offset >= total:
+        return total, []
+    rows = database.fetchall(
+        f"SELECT id, data FROM {table} {where} ORDER BY id LIMIT ? OFFSET ?", [*parameters, limit, offset]
+    )
+    return total, [(row_id, json.loads(data)) for row_id, data in rows]
+
+
+def list_users(where: Optional[str] = None, parameters=(), offset: int = 0, limit: int = 100):
+    return _list("users", where, parameters, offset, limit)
+
+
+# Like list_users, members are loaded with one query for the whole page unless with_members is False
+def list_groups(where: Optional[str] = None, parameters=(), offset: int = 0, limit: int = 100,
+                with_members: bool = True):
+    total, groups = _list("groups", where, parameters, offset, limit)
+    if not with_members:
+        return total, groups
+
+    group_ids = [group_id for group_id, group in groups if "members" not in group]
+    members = {group_id: [] for group_id in group_ids}
+    # Stay under SQLite's limit on the number of parameters
+    for start in range(0, len(group_ids), 500):
+        chunk = group_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        for group_id, value, ref in database.fetchall(
+                f"SELECT group_id, value, ref FROM group_members WHERE group_id IN ({placeholders})", chunk):
+            members[group_id].append({"value": value, "ref": ref})
+
+    for group_id, group in groups:
+        if group_id in members:
+            group["members"] = members[group_id]
+    return total, groups
+
+
+# Import the legacy users.json/groups.json stores once, on the first start with the database
+def import_json_files():
+    if database.get_meta("json_imported"):
+        return
+
+    with database.transaction():
+        # Another app process may have imported them while this one waited for the transaction
+        if database.get_meta("json_imported"):
+            return
+        if os.path.exists(USER_JSON_FILE):
+            with open(USER_JSON_FILE, "r") as f:
+                users = json.load(f)
+            for user_id, user in users.items():
+                put_user(user_id, user)
+            log(LogLevel.INFO, f"Imported {len(users)} users from {USER_JSON_FILE}")
+
+        if os.path.exists(GROUP_JSON_FILE):
+            with open(GROUP_JSON_FILE, "r") as f:
+                groups = json.load(f)
+            for group_id, group in groups.items():
+                put_group(group_id, group)
+            log(LogLevel.INFO, f"Imported {len(groups)} groups from {GROUP_JSON_FILE}")
+
+        database.set_meta("json_imported", "1")
@@ -0,0 +1,71 @@
+# In-memory copy of the SCIM store, so GETs are dict lookups instead of database reads. Records are kept as the JSON
+# stored in the database (one string per record, parsed on each read so callers can't change the cached copy), group
+# members as a dict of value -> ref which is loaded the first time the group is read with its members.
+# Writes through store.py update the copy. Writes by another process (i.e. bootstrap.py or reconcile.py) change
+# SQLite's data_version, which drops the copy, after which records are loaded again as they are read.
+import sys
+from typing import Optional
+
+from config import STORE_CACHE
+from utilities import database
+from utils import log, LogLevel
+
+
+class GroupRecord:
+    __slots__ = ("data", "members")
+
+    # members is None until loaded
+    def __init__(self, data: str, members: Optional[dict] = None):
+        self.data = data
+        self.members = members
+
+
+class StoreCache:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.users = {}
+        self.groups = {}
+        # Every stored record is in the cache, so a miss means the record doesn't exist
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self._data_version = None
+
+    def clear(self):
+        self.users.clear()
+        self.groups.clear()
+        self.complete = False
+
+    # Drop the cache if another connection changed the database since it was loaded
+    def check(self):
+        data_version = database.fetchone("PRAGMA data_version")[0]
+        if data_version != self._data_version:
+            if self._data_version is not None and (self.users or self.groups or self.complete):
+                log(LogLevel.INFO, "The store was changed by another process, reloading cached records as they're read.")
+            self.clear()
+            self._data_version = data_version
+
+    # Load every user and group (without their members)
+    def load(self):
+        if not self.enabled:
+            return
+        # Read the version first, so a write made while loading drops the cache
+        self._data_version = database.fetchone("PRAGMA data_version")[0]
+        self.users = dict(database.fetchall("SELECT id, data FROM users"))
+        self.groups = {group_id: GroupRecord(data) for group_id, data in database.fetchall("SELECT id, data FROM groups")}
+        self.complete = True
+        log(LogLevel.INFO, f"Cached {len(self.users)} users and {len(self.groups)} groups.")
+
+    def set_members(self, record: GroupRecord, members):
+        # Member values repeat across groups, share one copy of each
+        record.members = {sys.intern(value): ref for value, ref in members}
+
+    def stats(self):
+        return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses, "users": len(self.users),
+                "groups": len(self.groups)}
+
+
+store_cache = StoreCache(STORE_CACHE)
+
+# A rolled back write may already be in the cache
+database.on_rollback(store_cache.clear)
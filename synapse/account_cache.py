@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from config import ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_NEGATIVE_TTL
+from utilities import database
+from utils import log, LogLevel
+
+_MISSING = object()
+
+
+# Bounded LRU cache of IdP external ID -> Matrix user ID, persisted to the database so it survives restarts.
+# Accounts that don't exist yet are cached as None for a shorter time, so a user created outside of this app is
+# picked up quickly.
+class AccountIdCache:
+    def __init__(self, size: int, ttl: float, negative_ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._locks = {}
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self.ttl > 0
+
+    def _remember(self, external_id: str, matrix_id, expires_at: float):
+        self._entries[external_id] = (expires_at, matrix_id)
+        self._entries.move_to_end(external_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    # The cached Matrix ID (None if the account doesn't exist), or _MISSING
+    def _get(self, external_id: str):
+        entry = self._entries.get(external_id)
+        if entry is None:
+            # Evicted from memory, but maybe still persisted
+            row = database.fetchone("SELECT matrix_id, expires_at FROM account_ids WHERE external_id = ?",
+                                    (external_id,))
+            if row is None:
+                return _MISSING
+            entry = (row[1], row[0])
+            self._remember(external_id, row[0], row[1])
+
+        expires_at, matrix_id = entry
+        if expires_at < time.time():
+            self._entries.pop(external_id, None)
+            return _MISSING
+        self._entries.move_to_end(external_id)
+        return matrix_id
+
+    def set(self, external_id: str, matrix_id):
+        if not self.enabled:
+            return
+        expires_at = time.time() + (self.ttl if matrix_id is not None else self.negative_ttl)
+        self._remember(external_id, matrix_id, expires_at)
+        database.execute(
+            "INSERT OR REPLACE INTO account_ids (external_id, matrix_id, expires_at) VALUES (?, ?, ?)",
+            (external_id, matrix_id, expires_at)
+        )
+
+    # Return the cached Matrix ID for external_id, otherwise await loader() and cache its result
+    async def get_or_load(self, external_id: str, loader):
+        if not self.enabled:
+            return await loader()
+
+        matrix_id = self._get(external_id)
+        if matrix_id is not _MISSING:
+            self.hits += 1
+            return matrix_id
+
+        # Only one loader per external ID runs at a time, concurrent callers wait for and reuse its result
+        lock = self._locks.setdefault(external_id, asyncio.Lock())
+        try:
+            async with lock:
+                matrix_id = self._get(external_id)
+                if matrix_id is not _MISSING:
+                    self.hits += 1
+                    return matrix_id
+
+                self.misses += 1
+                matrix_id = await loader()
+                self.set(external_id, matrix_id)
+                return matrix_id
+        finally:
+            if not lock.locked() and self._locks.get(external_id) is lock:
+                del self._locks[external_id]
+
+    # Load the persisted entries and the accounts known from the user store (users PUT by their Matrix ID)
+    def warm(self):
+        if not self.enabled:
+            return
+        now = time.time()
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM account_ids WHERE expires_at < ?", (now,))
+            connection.execute(
+                """
+                INSERT OR IGNORE INTO account_ids (external_id, matrix_id, expires_at)
+                SELECT external_id, id, ? FROM users WHERE id LIKE '@%' AND external_id IS NOT NULL
+                """,
+                (now + self.ttl,)
+            )
+
+        self._entries.clear()
+        rows = database.fetchall(
+            "SELECT external_id, matrix_id, expires_at FROM account_ids ORDER BY expires_at DESC LIMIT ?",
+            (self.size,)
+        )
+        for external_id, matrix_id, expires_at in reversed(rows):
+            self._entries[external_id] = (expires_at, matrix_id)
+        log(LogLevel.DEBUG, "Loaded %d cached Matrix account IDs.", len(self._entries))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+account_id_cache = AccountIdCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_NEGATIVE_TTL)
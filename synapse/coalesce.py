@@ -0,0 +1,88 @@
+# Coalescing of pending membership operations per (matrix_user_id, room_id), and the room memberships we already know
+# about so operations that wouldn't change anything are dropped.
+import time
+from typing import Optional
+
+from config import MEMBERSHIP_CACHE_TTL
+
+
+# Tracks the latest pending operation for each key, earlier operations for the same key are superseded by it
+class Coalescer:
+    def __init__(self):
+        self._latest = {}
+        self.coalesced = 0
+
+    def track(self, key, operation):
+        self._latest[key] = operation
+
+    # An operation is superseded once a later operation for its key has been tracked
+    def is_superseded(self, key, operation):
+        superseded = self._latest.get(key, operation) is not operation
+        if superseded:
+            self.coalesced += 1
+        return superseded
+
+    def done(self, key, operation):
+        if self._latest.get(key) is operation:
+            del self._latest[key]
+
+    def __len__(self):
+        return len(self._latest)
+
+
+# Recently seen room memberships, from single joins/kicks and whole room member lists
+class KnownMembership:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.noops = 0
+        self._pairs = {}
+        self._rooms = {}
+
+    def set_member(self, matrix_user_id, room_id, joined: bool):
+        if self.ttl > 0:
+            self._pairs[(matrix_user_id, room_id)] = (time.monotonic(), joined)
+
+    def set_room_members(self, room_id, members):
+        if self.ttl > 0:
+            self._rooms[room_id] = (time.monotonic(), frozenset(members))
+
+    def room_ids(self):
+        return self._rooms.keys() | {key[1] for key in self._pairs}
+
+    def forget_room(self, room_id):
+        self._rooms.pop(room_id, None)
+        for key in [key for key in self._pairs if key[1] == room_id]:
+            del self._pairs[key]
+
+    # True/False if the membership is known, None if unknown or expired. The most recently seen source wins.
+    def is_joined(self, matrix_user_id, room_id) -> Optional[bool]:
+        oldest = time.monotonic() - self.ttl
+        pair = self._pairs.get((matrix_user_id, room_id))
+        if pair is not None and pair[0] < oldest:
+            del self._pairs[(matrix_user_id, room_id)]
+            pair = None
+        room = self._rooms.get(room_id)
+        if room is not None and room[0] < oldest:
+            del self._rooms[room_id]
+            room = None
+
+        if pair is not None and (room is None or pair[0] >= room[0]):
+            return pair[1]
+        if room is not None:
+            return matrix_user_id in room[1]
+        return None
+
+    # Whether an action ("join"/"kick") would leave the known membership unchanged
+    def is_noop(self, action, matrix_user_id, room_id):
+        joined = self.is_joined(matrix_user_id, room_id)
+        noop = joined is not None and joined == (action == "join")
+        if noop:
+            self.noops += 1
+        return noop
+
+    def stats(self):
+        return {"pairs": len(self._pairs), "rooms": len(self._rooms), "noops": self.noops}
+
+
+coalescer = Coalescer()
+known_membership = KnownMembership(MEMBERSHIP_CACHE_TTL)
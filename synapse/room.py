@@ -1,112 +1,248 @@
-import requests
-from fastapi import HTTPException
+import asyncio
+from contextlib import asynccontextmanager
 
-from config import MATRIX_URL, MATRIX_ADMIN_USER_ID, MATRIX_ADMIN_TOKEN
-from synapse.synapse_admin import get_headers
+from config import MATRIX_ADMIN_USER_ID, MATRIX_SERVER_NAME, SYNC_CONCURRENCY, SYNC_ROOM_CONCURRENCY
+from synapse.coalesce import known_membership
+from synapse.room_cache import room_admin_cache, JOINED_ROOMS_KEY, power_levels_key
+from synapse.synapse_admin import request
 from utils import log, LogLevel
 
 
-def add_to_room(matrix_user_id, room_id):
-    ensure_room_admin(room_id)
-
-    headers = get_headers()
+async def add_to_room(matrix_user_id, room_id):
+    await ensure_room_admin(room_id)
 
     log(LogLevel.INFO, f"Adding {matrix_user_id} to {room_id}.")
 
-    matrix_response = requests.post(
-        f"{MATRIX_URL}/_synapse/admin/v1/join/{room_id}",
-        headers=headers,
+    matrix_response = await request(
+        "POST",
+        f"/_synapse/admin/v1/join/{room_id}",
         json={"user_id": matrix_user_id}
     )
 
+    if matrix_response.status_code == 403:
+        # The admin may have lost its rights in the room, re-check on the next operation
+        room_admin_cache.invalidate(room_id)
+
     if matrix_response.status_code != 200:
         if matrix_response.json()["error"] == f"{matrix_user_id} is already in the room.":
             log(LogLevel.INFO, f"{matrix_user_id} is already in the room.")
+            known_membership.set_member(matrix_user_id, room_id, True)
             return True
         else:
             log(LogLevel.ERROR, f"Error adding {matrix_user_id} to {room_id}.")
-            log(LogLevel.DEBUG, f"{matrix_response.status_code}: {matrix_response.json()}")
+            log(LogLevel.DEBUG, "%d: %s", matrix_response.status_code, matrix_response.text)
             return False
     else:
         log(LogLevel.INFO, f"Added {matrix_user_id} to {room_id}.")
+        known_membership.set_member(matrix_user_id, room_id, True)
         return True
 
 
-def remove_from_room(matrix_user_id, room_id):
-    ensure_room_admin(room_id)
-
-    headers = get_headers()
+async def remove_from_room(matrix_user_id, room_id):
+    await ensure_room_admin(room_id)
 
     log(LogLevel.INFO, f"Removing {matrix_user_id} from {room_id}.")
 
-    matrix_response = requests.post(
-        f"{MATRIX_URL}/_matrix/client/v3/rooms/{room_id}/kick",
-        json={"user_id": matrix_user_id, "reason": "Removed from group"},
-        headers=headers
+    matrix_response = await request(
+        "POST",
+        f"/_matrix/client/v3/rooms/{room_id}/kick",
+        json={"user_id": matrix_user_id, "reason": "Removed from group"}
     )
 
+    if matrix_response.status_code == 403:
+        room_admin_cache.invalidate(room_id)
+
     if matrix_response.status_code != 200:
         log(LogLevel.ERROR, f"Error removing {matrix_user_id} from {room_id}.")
-        log(LogLevel.DEBUG, f"{matrix_response.status_code}: {matrix_response.json()}")
+        log(LogLevel.DEBUG, "%d: %s", matrix_response.status_code, matrix_response.text)
         return False
     else:
         log(LogLevel.INFO, f"Removed {matrix_user_id} from {room_id}.")
+        known_membership.set_member(matrix_user_id, room_id, False)
         return True
 
-def add_to_rooms(matrix_user_id, room_ids: [str]):
-    for room_id in room_ids:
-        add_to_room(matrix_user_id, room_id)
+async def add_to_rooms(matrix_user_id, room_ids: [str]):
+    return await run_membership_ops(add_to_room, [(matrix_user_id, room_id) for room_id in room_ids])
+
+async def remove_from_rooms(matrix_user_id, room_ids: [str]):
+    return await run_membership_ops(remove_from_room, [(matrix_user_id, room_id) for room_id in room_ids])
+
+
+# Limits shared by every caller, so concurrent requests together stay within SYNC_CONCURRENCY
+_sync_semaphore = None
+_room_semaphores = {}
+
+
+def _get_semaphores(room_id):
+    global _sync_semaphore
+    if _sync_semaphore is None:
+        _sync_semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+    room_semaphore = _room_semaphores.get(room_id)
+    if room_semaphore is None:
+        room_semaphore = _room_semaphores[room_id] = asyncio.Semaphore(SYNC_ROOM_CONCURRENCY)
+    return _sync_semaphore, room_semaphore
+
+
+# Wait for a free overall and per room slot for a membership operation in room_id
+@asynccontextmanager
+async def membership_slot(room_id):
+    sync_semaphore, room_semaphore = _get_semaphores(room_id)
+    # Take the room slot first so a busy room doesn't hold overall slots other rooms could use
+    async with room_semaphore, sync_semaphore:
+        yield
+
+
+# Run operation (add_to_room/remove_from_room) for every (matrix_user_id, room_id) pair concurrently, bounded overall
+# and per room. Returns a dict of pair -> success so partial failures can be reported.
+async def run_membership_ops(operation, pairs):
+    async def run(matrix_user_id, room_id):
+        async with membership_slot(room_id):
+            try:
+                return await operation(matrix_user_id, room_id)
+            except Exception as e:
+                log(LogLevel.ERROR, f"Error processing {matrix_user_id} in {room_id}: {e!r}")
+                return False
+
+    pairs = list(dict.fromkeys(pairs))
+    results = await asyncio.gather(*(run(matrix_user_id, room_id) for matrix_user_id, room_id in pairs))
+    return dict(zip(pairs, results))
+
+# Room IDs of the aliases resolved so far
+_room_ids = {}
+
+
+# Resolve a room alias (#room:example.com, or %23room:example.com) to its room ID, room IDs are returned as is
+async def resolve_room_id(room):
+    if not room.startswith(("#", "%23")):
+        return room
+
+    alias = room.replace("%23", "#", 1)
+    room_id = _room_ids.get(alias)
+    if room_id is not None:
+        return room_id
+
+    response = await request("GET", "/_matrix/client/v3/directory/room/" + alias.replace("#", "%23", 1))
+    if response.status_code != 200:
+        log(LogLevel.ERROR, f"Failed to resolve room alias {alias}.")
+        log(LogLevel.DEBUG, "%d: %s", response.status_code, response.text)
+        return None
+    room_id = _room_ids[alias] = response.json()["room_id"]
+    return room_id
+
+
+# Get the joined members of a room, or None if they couldn't be fetched. With remember, they're kept in known_membership
+# so later joins/kicks that wouldn't change them are skipped.
+async def get_room_members(room, remember: bool = True):
+    room_id = await resolve_room_id(room)
+    if room_id is None:
+        return None
+
+    response = await request("GET", f"/_synapse/admin/v1/rooms/{room_id}/members")
+    if response.status_code != 200:
+        log(LogLevel.ERROR, f"Failed to fetch members of {room}.")
+        log(LogLevel.DEBUG, "%d: %s", response.status_code, response.text)
+        return None
+    members = set(response.json().get("members", []))
+    if remember:
+        known_membership.set_room_members(room_id, members)
+    return members
+
+
+# The members to join and kick to get a room from current_members to desired_members. The admin user and users from
+# other homeservers are never kicked.
+def get_members_diff(current_members, desired_members):
+    desired_members = set(desired_members)
+    to_join = desired_members - current_members
+    to_kick = {
+        member for member in current_members - desired_members
+        if member != MATRIX_ADMIN_USER_ID and member.endswith(f":{MATRIX_SERVER_NAME}")
+    }
+    return to_join, to_kick
+
+
+# Join and kick only the differences between a room's current members and desired_members (only join without kick).
+# The admin user and users from other homeservers are never kicked. Returns a dict of (matrix_user_id, room_id) ->
+# success, or None if the room's members couldn't be fetched.
+async def reconcile_room(room_id, desired_members, kick: bool = True):
+    current_members = await get_room_members(room_id)
+    if current_members is None:
+        return None
+
+    to_join, to_kick = get_members_diff(current_members, desired_members)
+    if not kick:
+        to_kick = set()
+    log(LogLevel.INFO, f"Reconciling {room_id}: {len(to_join)} to join, {len(to_kick)} to kick.")
+
+    results = await run_membership_ops(add_to_room, [(member, room_id) for member in to_join])
+    results.update(await run_membership_ops(remove_from_room, [(member, room_id) for member in to_kick]))
+    return results
+
+
+# Get the rooms the admin user has joined (cached)
+async def get_joined_rooms():
+    async def load():
+        joined_rooms = await request("GET", "/_matrix/client/v3/joined_rooms")
+        if joined_rooms.status_code != 200:
+            log(LogLevel.ERROR, "Failed to fetch joined rooms.")
+            log(LogLevel.DEBUG, "%d: %s", joined_rooms.status_code, joined_rooms.text)
+            return None
+
+        rooms = frozenset(joined_rooms.json().get("joined_rooms", []))
+        log(LogLevel.DEBUG, "Admin has joined %d rooms.", len(rooms))
+        return rooms
+
+    return await room_admin_cache.get_or_load(JOINED_ROOMS_KEY, load) or frozenset()
+
+
+# Get the user power levels of a room (cached)
+async def get_power_levels(room_id):
+    async def load():
+        room_power_levels = await request("GET", f"/_matrix/client/v3/rooms/{room_id}/state/m.room.power_levels")
+        if room_power_levels.status_code != 200:
+            log(LogLevel.ERROR, f"Failed to fetch power levels of {room_id}.")
+            log(LogLevel.DEBUG, "%d: %s", room_power_levels.status_code, room_power_levels.text)
+            return None
+
+        users = room_power_levels.json().get("users", {})
+        log(LogLevel.DEBUG, "Room power levels of %s: %s", room_id, users)
+        return users
+
+    return await room_admin_cache.get_or_load(power_levels_key(room_id), load) or {}
 
-def remove_from_rooms(matrix_user_id, room_ids: [str]):
-    for room_id in room_ids:
-        remove_from_room(matrix_user_id, room_id)
 
 # Check if matrix user is in room and admin
-def is_in_room(headers, room_id, matrix_user):
-    log(LogLevel.DEBUG, f"Checking if {matrix_user} is in {room_id}.")
-
-    joined_rooms = requests.get(
-        f"{MATRIX_URL}/_matrix/client/v3/joined_rooms",
-        headers=headers
-    )
-
-    log(LogLevel.DEBUG, f"Joined rooms: {joined_rooms.json()}")
+async def is_in_room(room_id, matrix_user):
+    log(LogLevel.DEBUG, "Checking if %s is in %s.", matrix_user, room_id)
 
-    if room_id in joined_rooms.json().get("joined_rooms", []):
-        log(LogLevel.DEBUG, f"Room {room_id} joined.")
+    if room_id in await get_joined_rooms():
+        log(LogLevel.DEBUG, "Room %s joined.", room_id)
         return True
 
-    log(LogLevel.DEBUG, f"Room {room_id} not joined.")
+    log(LogLevel.DEBUG, "Room %s not joined.", room_id)
     return False
 
 
-def is_room_admin(headers, room_id, matrix_user):
-    log(LogLevel.DEBUG, f"Checking if {matrix_user} is an admin of {room_id}.")
+async def is_room_admin(room_id, matrix_user):
+    log(LogLevel.DEBUG, "Checking if %s is an admin of %s.", matrix_user, room_id)
 
-    room_power_levels = requests.get(
-        f"{MATRIX_URL}/_matrix/client/v3/rooms/{room_id}/state/m.room.power_levels",
-        headers=headers
-    )
-
-    log(LogLevel.DEBUG, f"Room power levels: {room_power_levels.json()}")
+    power_levels = await get_power_levels(room_id)
 
-    if matrix_user in room_power_levels.json().get("users", {}):
-        if room_power_levels.json().get("users").get(matrix_user) >= 100:
-            log(LogLevel.DEBUG, f"{matrix_user} is an admin of {room_id}.")
-            return True
+    if power_levels.get(matrix_user, 0) >= 100:
+        log(LogLevel.DEBUG, "%s is an admin of %s.", matrix_user, room_id)
+        return True
 
-    log(LogLevel.DEBUG, f"{matrix_user} is not an admin of {room_id}.")
+    log(LogLevel.DEBUG, "%s is not an admin of %s.", matrix_user, room_id)
     return False
 
 
 # Make provided matrix user an admin of the room
-def make_room_admin(headers, room_id, matrix_user):
+async def make_room_admin(room_id, matrix_user):
     log(LogLevel.INFO, f"Adding {MATRIX_ADMIN_USER_ID} to {room_id}.")
 
     # Check if this admin user is already in the room, if not join it and become room admin
-    matrix_admin_response = requests.post(
-        f"{MATRIX_URL}/_synapse/admin/v1/rooms/{room_id}/make_room_admin",
-        headers=headers,
+    matrix_admin_response = await request(
+        "POST",
+        f"/_synapse/admin/v1/rooms/{room_id}/make_room_admin",
         json={"user_id": MATRIX_ADMIN_USER_ID}
     )
 
@@ -114,32 +250,34 @@ def make_room_admin(headers, room_id, matrix_user):
     if matrix_admin_response.status_code == 200:
 
         # Join the room
-        matrix_join_response = requests.post(
-            f"{MATRIX_URL}/_matrix/client/v3/join/{room_id}",
-            headers=headers
-        )
+        matrix_join_response = await request("POST", f"/_matrix/client/v3/join/{room_id}")
 
         if matrix_join_response.status_code == 200:
             log(LogLevel.INFO, f"{MATRIX_ADMIN_USER_ID} is now an admin of {room_id}.")
+            room_admin_cache.set_admin(room_id, MATRIX_ADMIN_USER_ID)
         else:
+            # Membership or power levels may have changed, so the cached state is stale
+            room_admin_cache.invalidate(room_id)
             log(LogLevel.ERROR, f"Failed to join admin to {room_id}.")
-            log(LogLevel.DEBUG, f"{matrix_join_response.status_code}: {matrix_join_response.text}")
+            log(LogLevel.DEBUG, "%d: %s", matrix_join_response.status_code, matrix_join_response.text)
     else:
+        room_admin_cache.invalidate(room_id)
         log(LogLevel.ERROR, f"Failed to make {MATRIX_ADMIN_USER_ID} an admin of {room_id}.")
-        log(LogLevel.DEBUG, f"{matrix_admin_response.status_code}: {matrix_admin_response.text}")
+        log(LogLevel.DEBUG, "%d: %s", matrix_admin_response.status_code, matrix_admin_response.text)
     return True
 
 
 # Check if matrix user is in room and admin, if not add them and make them an admin
-def ensure_room_admin(room_id, matrix_admin_user=MATRIX_ADMIN_USER_ID):
-    headers = get_headers()
-
-    if not is_in_room(headers, room_id, matrix_admin_user):
-        log(LogLevel.INFO, f"Adding admin ({matrix_admin_user}) to {room_id} (not currently in room).")
-
-        make_room_admin(headers, room_id, matrix_admin_user)
-    elif not is_room_admin(headers, room_id, matrix_admin_user):
-        log(LogLevel.INFO, f"Adding admin ({matrix_admin_user}) to {room_id} (not currently an admin).")
-
-        make_room_admin(headers, room_id, matrix_admin_user)
-    log(LogLevel.DEBUG, f"{matrix_admin_user} is in {room_id} and is an admin.")
+# Operations on the same room wait for each other here, so only the first one makes the admin an admin and the others
+# find it in the cache. The lock doesn't suspend when free, so cached checks stay cheap.
+async def ensure_room_admin(room_id, matrix_admin_user=MATRIX_ADMIN_USER_ID):
+    async with room_admin_cache.room_lock(room_id):
+        if not await is_in_room(room_id, matrix_admin_user):
+            log(LogLevel.INFO, f"Adding admin ({matrix_admin_user}) to {room_id} (not currently in room).")
+
+            await make_room_admin(room_id, matrix_admin_user)
+        elif not await is_room_admin(room_id, matrix_admin_user):
+            log(LogLevel.INFO, f"Adding admin ({matrix_admin_user}) to {room_id} (not currently an admin).")
+
+            await make_room_admin(room_id, matrix_admin_user)
+    log(LogLevel.DEBUG, "%s is in %s and is an admin.", matrix_admin_user, room_id)
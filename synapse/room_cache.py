@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from config import ROOM_ADMIN_CACHE_TTL
+
+JOINED_ROOMS_KEY = "joined_rooms"
+
+
+# In-process TTL cache of the admin user's room state, so ensure_room_admin doesn't hit Synapse for every membership change
+class RoomAdminCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._locks = {}
+        self._room_locks = {}
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    # Return the cached value for key, otherwise await loader() and cache its result (None results are not cached)
+    async def get_or_load(self, key, loader):
+        if self.ttl > 0:
+            entry = self._get_fresh(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+
+        # Only one loader per key runs at a time, concurrent callers wait for and reuse its result
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if self.ttl > 0:
+                entry = self._get_fresh(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+
+            self.misses += 1
+            value = await loader()
+            if value is not None and self.ttl > 0:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+            return value
+
+    # Lock held while checking and fixing the admin user's rights in a room, so concurrent operations on a room the
+    # admin isn't in yet make it an admin once
+    def room_lock(self, room_id):
+        lock = self._room_locks.get(room_id)
+        if lock is None:
+            lock = self._room_locks[room_id] = asyncio.Lock()
+        return lock
+
+    # Record that the admin user joined a room and is its admin, without reloading every joined room
+    def set_admin(self, room_id, matrix_user):
+        if self.ttl <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        joined = self._get_fresh(JOINED_ROOMS_KEY)
+        if joined is not None:
+            self._entries[JOINED_ROOMS_KEY] = (joined[0], joined[1] | {room_id})
+        power_levels = self._get_fresh(power_levels_key(room_id))
+        users = power_levels[1] if power_levels is not None else {}
+        self._entries[power_levels_key(room_id)] = (expires, {**users, matrix_user: 100})
+
+    # Drop the joined rooms list and, if given, the power levels of a room
+    def invalidate(self, room_id=None):
+        self._entries.pop(JOINED_ROOMS_KEY, None)
+        if room_id is not None:
+            self._entries.pop(power_levels_key(room_id), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+def power_levels_key(room_id):
+    return f"power_levels:{room_id}"
+
+
+room_admin_cache = RoomAdminCache(ROOM_ADMIN_CACHE_TTL)
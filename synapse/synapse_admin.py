@@ -1,5 +1,182 @@
-from config import MATRIX_ADMIN_TOKEN
+import asyncio
+import random
+import time
+from typing import Optional
+
+import httpx
+
+from config import MATRIX_ADMIN_TOKEN, MATRIX_URL, SYNAPSE_TIMEOUT, SYNAPSE_CONNECT_TIMEOUT, SYNAPSE_MAX_CONNECTIONS, \
+    SYNAPSE_MAX_KEEPALIVE_CONNECTIONS, SYNAPSE_MAX_RETRIES, SYNAPSE_RETRY_BASE_DELAY, SYNAPSE_RETRY_MAX_DELAY, \
+    SYNAPSE_RATE_LIMIT, SYNAPSE_RATE_BURST, UVICORN_WORKERS
+from utilities import metrics
+from utils import log, LogLevel
+
+# Status codes worth retrying, anything else is returned to the caller straight away
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+# Endpoint labels of the Synapse metrics, by a part of the request path. The first match wins.
+ENDPOINTS = (
+    ("/_synapse/admin/v1/join/", "join"),
+    ("/kick", "kick"),
+    ("/make_room_admin", "make_room_admin"),
+    ("/_matrix/client/v3/join/", "admin_join"),
+    ("/joined_rooms", "joined_rooms"),
+    ("/m.room.power_levels", "power_levels"),
+    ("/members", "room_members"),
+    ("/directory/room/", "room_alias"),
+    ("/_synapse/admin/v2/users/", "user"),
+    ("/auth_providers/", "auth_provider_user"),
+)
+
+SYNAPSE_REQUEST_SECONDS = metrics.Histogram(
+    "synapse_request_duration_seconds", "Time taken by requests to Synapse, including retries.", ("endpoint",)
+)
+SYNAPSE_RESPONSES = metrics.Counter(
+    "synapse_responses_total", "Responses from Synapse by status code (error for connection errors).",
+    ("endpoint", "status")
+)
+SYNAPSE_RETRIES = metrics.Counter("synapse_retries_total", "Retried requests to Synapse.", ("endpoint",))
+
+# Shared client, opened once per app lifespan so connections to Synapse are kept alive and reused
+_client: Optional[httpx.AsyncClient] = None
+
+
+# Token bucket shared by every request, so we stay under the homeserver's rate limits however many requests run at once
+class RateLimiter:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.rate <= 0:
+                return
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Hold back every request, i.e. when Synapse tells us to slow down
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Every app process gets an equal part of the limit
+rate_limiter = RateLimiter(SYNAPSE_RATE_LIMIT / UVICORN_WORKERS, max(SYNAPSE_RATE_BURST // UVICORN_WORKERS, 1))
 
 
 def get_headers():
     return {"Authorization": f"Bearer {MATRIX_ADMIN_TOKEN}"}
+
+
+def create_client(transport: Optional[httpx.AsyncBaseTransport] = None):
+    return httpx.AsyncClient(
+        base_url=MATRIX_URL,
+        headers=get_headers(),
+        timeout=httpx.Timeout(SYNAPSE_TIMEOUT, connect=SYNAPSE_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=SYNAPSE_MAX_CONNECTIONS,
+            max_keepalive_connections=SYNAPSE_MAX_KEEPALIVE_CONNECTIONS
+        ),
+        transport=transport
+    )
+
+
+async def open_client(transport: Optional[httpx.AsyncBaseTransport] = None):
+    global _client
+    if _client is not None:
+        await _client.aclose()
+    _client = create_client(transport)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Get the shared client, creating it lazily if used outside the app lifespan (i.e. scripts)
+def get_client():
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+
+# Seconds Synapse asked us to wait before retrying a 429, if it said
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        retry_after_ms = response.json().get("retry_after_ms")
+    except ValueError:
+        retry_after_ms = None
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return None
+
+
+# Exponential backoff with full jitter
+def get_backoff(attempt: int):
+    return random.uniform(0, min(SYNAPSE_RETRY_MAX_DELAY, SYNAPSE_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def get_endpoint(url: str):
+    for path, endpoint in ENDPOINTS:
+        if path in url:
+            return endpoint
+    return "other"
+
+
+# Send a request to Synapse through the rate limiter, retrying 429s and transient errors. Once out of retries the last
+# response is returned (or the last connection error raised).
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    endpoint = get_endpoint(url)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        await rate_limiter.acquire()
+        try:
+            response = await get_client().request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            SYNAPSE_RESPONSES.inc(endpoint, "error")
+            if attempt >= SYNAPSE_MAX_RETRIES:
+                SYNAPSE_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+                raise
+            delay = get_backoff(attempt)
+            log(LogLevel.INFO, f"Synapse request {method} {url} failed ({e!r}), retrying in {delay:.2f}s.")
+        else:
+            SYNAPSE_RESPONSES.inc(endpoint, str(response.status_code))
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= SYNAPSE_MAX_RETRIES:
+                duration = time.perf_counter() - start
+                SYNAPSE_REQUEST_SECONDS.observe(duration, endpoint)
+                log(LogLevel.DEBUG, "Synapse request %s %s returned %d.", method, url, response.status_code,
+                    endpoint=endpoint, status=response.status_code, duration=round(duration, 4), attempts=attempt + 1)
+                return response
+
+            delay = get_backoff(attempt)
+            if response.status_code == 429:
+                retry_after = get_retry_after(response)
+                if retry_after is not None:
+                    delay = retry_after + random.uniform(0, SYNAPSE_RETRY_BASE_DELAY)
+                # Everyone is being rate limited, not just this request
+                rate_limiter.pause(delay)
+            log(LogLevel.INFO, f"Synapse request {method} {url} returned {response.status_code}, retrying in {delay:.2f}s.")
+
+        SYNAPSE_RETRIES.inc(endpoint)
+        attempt += 1
+        await asyncio.sleep(delay)
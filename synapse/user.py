@@ -1,13 +1,23 @@
+import hashlib
+import json
+
 from fastapi import HTTPException
 from typing import Optional
 
-import requests
-from config import MATRIX_URL, IDP_NAME, MATRIX_SERVER_NAME
+from config import IDP_NAME, MATRIX_SERVER_NAME, USER_FORCE_SYNC
 from synapse import synapse_admin
+from synapse.account_cache import account_id_cache
+from utilities import database
 from utils import LogLevel, log
 
 
-def create_or_modify_user(matrix_id: str, display_name: str, external_id: str, email: Optional[str] = None):
+def get_body_hash(body: dict):
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+# Skipped (returning None) when the body is the same as the last one sent for the user, unless forced
+async def create_or_modify_user(matrix_id: str, display_name: str, external_id: str, email: Optional[str] = None,
+                                force: bool = USER_FORCE_SYNC):
     body = {
         "displayname": display_name,
         "external_ids": [
@@ -26,9 +36,17 @@ def create_or_modify_user(matrix_id: str, display_name: str, external_id: str, e
             }
         ]
 
-    synapse_response = requests.put(
-        f"{MATRIX_URL}/_synapse/admin/v2/users/{matrix_id}",
-        headers=synapse_admin.get_headers(),
+    body_hash = get_body_hash(body)
+    if not force:
+        row = database.fetchone("SELECT body_hash FROM user_profiles WHERE matrix_id = ?", (matrix_id,))
+        if row is not None and row[0] == body_hash:
+            log(LogLevel.DEBUG, "User %s is unchanged, skipping the Synapse update.", matrix_id)
+            account_id_cache.set(external_id, matrix_id)
+            return None
+
+    synapse_response = await synapse_admin.request(
+        "PUT",
+        f"/_synapse/admin/v2/users/{matrix_id}",
         json=body
     )
 
@@ -42,12 +60,23 @@ def create_or_modify_user(matrix_id: str, display_name: str, external_id: str, e
         # Error
         raise HTTPException(status_code=500, detail="Error creating or modifying user.")
 
+    # The account is now linked to the external ID
+    account_id_cache.set(external_id, matrix_id)
+    database.execute(
+        "INSERT OR REPLACE INTO user_profiles (matrix_id, body_hash) VALUES (?, ?)", (matrix_id, body_hash)
+    )
+
     return synapse_response.json()
 
-def get_matrix_account_id(external_id: str):
-    synapse_response = requests.get(
-        f"{MATRIX_URL}/_synapse/admin/v1/auth_providers/{IDP_NAME}/users/{external_id}",
-        headers=synapse_admin.get_headers()
+# Cached, the account linked to an external ID rarely changes
+async def get_matrix_account_id(external_id: str):
+    return await account_id_cache.get_or_load(external_id, lambda: _fetch_matrix_account_id(external_id))
+
+
+async def _fetch_matrix_account_id(external_id: str):
+    synapse_response = await synapse_admin.request(
+        "GET",
+        f"/_synapse/admin/v1/auth_providers/{IDP_NAME}/users/{external_id}"
     )
 
     if synapse_response.status_code == 200:
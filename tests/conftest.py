@@ -0,0 +1,64 @@
+# Fills in the required config with dummy values and points DATA_DIR at a temporary directory before any app module is
+# imported, so the tests never touch real data.
+import json
+import os
+import tempfile
+
+os.environ.setdefault("WEBHOOK_SECRET", "test")
+os.environ.setdefault("MATRIX_ADMIN_TOKEN", "test")
+os.environ.setdefault("MATRIX_ADMIN_USER_ID", "@admin:example.com")
+os.environ.setdefault("MATRIX_URL", "http://synapse.invalid")
+os.environ.setdefault("MATRIX_SERVER_NAME", "example.com")
+os.environ.setdefault("IDP_NAME", "oidc-test")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("AUTHENTIK_API_URL", "http://authentik.invalid")
+os.environ.setdefault("AUTHENTIK_TOKEN", "test")
+# Groups of the fake Authentik, group-3 isn't mapped
+os.environ["IDP_GROUP_TO_ROOM"] = json.dumps({
+    "group-0": ["!room0:example.com"],
+    "group-1": ["!room1:example.com", "!shared:example.com"],
+    "group-2": ["!shared:example.com"],
+})
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="synapse-group-sync-test-")
+os.environ.pop("DATABASE_FILE", None)
+os.environ.pop("GROUP_MAPPING_FILE", None)
+
+import pytest
+
+
+# Every test gets its own database, and starts without anything cached by the previous tests
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    from scim.store_cache import store_cache
+    from synapse.account_cache import account_id_cache
+    from synapse.coalesce import known_membership
+    from synapse.room_cache import room_admin_cache
+    from utilities import database, idempotency
+
+    database.close()
+    monkeypatch.setattr(database, "DATABASE_FILE", str(tmp_path / "synapse-group-sync.db"))
+    store_cache.clear()
+    store_cache._data_version = None
+    known_membership._pairs.clear()
+    known_membership._rooms.clear()
+    # Locks too, they belong to the previous test's event loop
+    for cache in (account_id_cache, room_admin_cache):
+        cache._entries.clear()
+        cache._locks.clear()
+    room_admin_cache._room_locks.clear()
+    if isinstance(idempotency.idempotency_store, idempotency.IdempotencyStore):
+        idempotency.idempotency_store._entries.clear()
+        idempotency.idempotency_store._scopes.clear()
+        idempotency.idempotency_store._in_flight.clear()
+    yield
+    database.close()
+
+
+# The app, without its lifespan (no Synapse client, job workers or schedules), authenticated as the IdP
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return TestClient(main.app, headers={"Authorization": "Bearer test"})
@@ -0,0 +1,101 @@
+# Importing a directory from the fake Authentik into the store and its rooms on the fake Synapse
+import asyncio
+
+import httpx
+
+import bootstrap
+from benchmarks import fake_authentik, fake_synapse
+from scim import store
+from scim.main import SCIM_GROUP_SCHEMA
+from synapse import synapse_admin
+from utilities import jobs
+
+USERS = 10
+# User i is in group-(i % GROUPS)
+GROUPS = 4
+
+
+def matrix_ids(*users):
+    return {f"@uid-{i}:example.com" for i in users}
+
+
+def run_bootstrap(directory, synapse):
+    async def run():
+        await synapse_admin.open_client(httpx.ASGITransport(app=synapse))
+        await jobs.start(resume=False)
+        try:
+            return await bootstrap.bootstrap(httpx.ASGITransport(app=directory))
+        finally:
+            await jobs.stop()
+            await synapse_admin.close_client()
+
+    return asyncio.run(run())
+
+
+def test_bootstrap():
+    directory = fake_authentik.create_app(USERS, GROUPS)
+    synapse = fake_synapse.create_app()
+
+    job = run_bootstrap(directory, synapse)
+
+    # Every user gets a Matrix account, linked to its Authentik uid
+    assert synapse.state.users == matrix_ids(*range(USERS))
+    assert synapse.state.external_ids[("oidc-test", "uid-3")] == "@uid-3:example.com"
+    user = store.get_user("uid-3")
+    assert user["userName"] == "user3"
+    assert user["displayName"] == "User 3"
+    assert user["emails"][0]["value"] == "user3@example.com"
+
+    # Every group, mapped or not, with its members
+    for group in range(GROUPS):
+        stored = store.get_group(f"group-{group}")
+        assert stored["displayName"] == f"Group {group}"
+        assert {member["value"] for member in stored["members"]} == matrix_ids(*range(group, USERS, GROUPS))
+
+    # The members of the mapped groups are joined to their rooms
+    assert job.status == "completed"
+    rooms = {room_id: members - {fake_synapse.ADMIN_USER_ID} for room_id, members in synapse.state.rooms.items()}
+    assert rooms == {
+        "!room0:example.com": matrix_ids(0, 4, 8),
+        "!room1:example.com": matrix_ids(1, 5, 9),
+        "!shared:example.com": matrix_ids(1, 5, 9, 2, 6),
+    }
+
+
+# A group stored before the import keeps its members while the users are imported, and only loses the ones that aren't
+# in the Authentik group once every user is in
+def test_stored_members_are_kept_until_every_user_is_imported(monkeypatch):
+    store.put_group("group-1", {
+        "schemas": [SCIM_GROUP_SCHEMA],
+        "displayName": "Old name",
+        "externalId": "group-1",
+        "members": [{"value": "@uid-1:example.com", "ref": None}, {"value": "@left:example.com", "ref": None}],
+    })
+    members_during_import = []
+    import_users = bootstrap.import_users
+
+    async def record_members(client, imported_members):
+        members_during_import.append({member["value"] for member in store.get_group("group-1")["members"]})
+        return await import_users(client, imported_members)
+
+    monkeypatch.setattr(bootstrap, "import_users", record_members)
+
+    run_bootstrap(fake_authentik.create_app(USERS, GROUPS), fake_synapse.create_app())
+
+    assert members_during_import == [{"@uid-1:example.com", "@left:example.com"}]
+    group = store.get_group("group-1")
+    assert group["displayName"] == "Group 1"
+    assert {member["value"] for member in group["members"]} == matrix_ids(1, 5, 9)
+
+
+def test_groups_list_their_users_unless_asked_not_to():
+    directory = fake_authentik.create_app(USERS, GROUPS)
+
+    async def run(params):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=directory), base_url="http://authentik") as client:
+            return (await client.get("/api/v3/core/groups/", params=params)).json()["results"]
+
+    groups = asyncio.run(run({}))
+    assert [user["uid"] for user in groups[1]["users_obj"]] == ["uid-1", "uid-5", "uid-9"]
+    assert groups[1]["users"] == [1, 5, 9]
+    assert "users_obj" not in asyncio.run(run({"include_users": "false"}))[1]
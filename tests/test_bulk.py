@@ -0,0 +1,190 @@
+# SCIM Bulk through the app, with the Synapse upserts and the job queue replaced by recorders
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from scim import bulk, handle_user, store
+from scim.main import SCIM_GROUP_SCHEMA, SCIM_USER_SCHEMA
+from utilities import database, jobs
+
+FAILED_EXTERNAL_ID = "fails"
+
+
+# Every Synapse upsert as (method, matrix_id, display_name), every store write and transaction, and every submitted job
+@pytest.fixture
+def recorded(monkeypatch):
+    recorded = SimpleNamespace(upserts=[], events=[], jobs=[])
+
+    async def upsert(method, matrix_id, display_name):
+        # Earlier operations take longer, so operations run concurrently would finish out of order
+        await asyncio.sleep(0.05 if display_name.endswith("1") else 0)
+        if matrix_id == f"@{FAILED_EXTERNAL_ID}:example.com":
+            raise RuntimeError("Synapse is down")
+        recorded.upserts.append((method, matrix_id, display_name))
+        return matrix_id
+
+    async def post(external_id, display_name, email=None):
+        return await upsert("POST", f"@{external_id}:example.com", display_name)
+
+    async def put(matrix_id, external_id, display_name, email=None, force=False):
+        return await upsert("PUT", matrix_id, display_name)
+
+    def record(name, function):
+        def wrapper(*args, **kwargs):
+            recorded.events.append(name)
+            return function(*args, **kwargs)
+        return wrapper
+
+    transaction = database.transaction
+
+    @contextlib.contextmanager
+    def record_transaction():
+        if database._transaction_depth == 0:
+            recorded.events.append("transaction")
+        with transaction() as connection:
+            yield connection
+
+    def submit(operations, reconcile_failed=False):
+        recorded.events.append("submit")
+        recorded.jobs.append(list(operations))
+        return SimpleNamespace(id="job-1")
+
+    monkeypatch.setattr(handle_user, "post", post)
+    monkeypatch.setattr(handle_user, "put", put)
+    monkeypatch.setattr(store, "put_user", record("put_user", store.put_user))
+    monkeypatch.setattr(store, "put_group", record("put_group", store.put_group))
+    monkeypatch.setattr(database, "transaction", record_transaction)
+    monkeypatch.setattr(jobs, "submit", submit)
+    return recorded
+
+
+def user(external_id: str, display_name: str = None):
+    return {
+        "schemas": [SCIM_USER_SCHEMA],
+        "userName": external_id,
+        "name": {"formatted": None, "familyName": None, "givenName": None},
+        "displayName": display_name or external_id,
+        "emails": [{"value": f"{external_id}@example.com"}],
+        "externalId": external_id,
+    }
+
+
+def group(external_id: str, *members: str):
+    return {"schemas": [SCIM_GROUP_SCHEMA], "displayName": external_id, "externalId": external_id,
+            "members": [{"value": member} for member in members]}
+
+
+def post_bulk(client, *operations, fail_on_errors=None):
+    body = {"schemas": [bulk.SCIM_BULK_REQUEST_SCHEMA], "Operations": list(operations)}
+    if fail_on_errors is not None:
+        body["failOnErrors"] = fail_on_errors
+    response = client.post("/scim/v2/Bulk", json=body)
+    assert response.status_code == 200
+    return response.json()["Operations"]
+
+
+def statuses(results):
+    return [result["status"] for result in results]
+
+
+def test_users_and_groups_are_stored_in_one_transaction_then_one_job(client, recorded):
+    results = post_bulk(
+        client,
+        {"method": "POST", "path": "/Users", "bulkId": "alice", "data": user("alice")},
+        {"method": "POST", "path": "/Users", "bulkId": "bob", "data": user("bob")},
+        {"method": "POST", "path": "/Groups", "bulkId": "g1", "data": group("group-1", "bulkId:alice")},
+        {"method": "POST", "path": "/Groups", "bulkId": "g2", "data": group("group-2", "bulkId:alice", "bulkId:bob")},
+    )
+
+    assert statuses(results) == ["201"] * 4
+    assert results[0]["location"].endswith("/scim/v2/Users/@alice:example.com")
+    assert results[2]["response"]["members"] == [{"value": "@alice:example.com", "ref": None}]
+    assert recorded.events == ["transaction", "put_user", "put_user", "put_group", "put_group", "submit"]
+    # The rooms of both groups in one job, which only queues alice's repeated join of the shared room once
+    assert recorded.jobs == [[
+        ("join", "@alice:example.com", "!room1:example.com"),
+        ("join", "@alice:example.com", "!shared:example.com"),
+        ("join", "@alice:example.com", "!shared:example.com"),
+        ("join", "@bob:example.com", "!shared:example.com"),
+    ]]
+    assert {member["value"] for member in store.get_group("group-2")["members"]} == {
+        "@alice:example.com", "@bob:example.com"
+    }
+
+
+@pytest.mark.parametrize("operation, status, scim_type", [
+    ({"method": "DELETE", "path": "/Users/alice"}, "405", None),
+    ({"method": "POST", "path": "/Devices", "bulkId": "x", "data": {}}, "400", "invalidPath"),
+    ({"method": "POST", "path": "/Users/alice", "bulkId": "x", "data": user("alice")}, "400", "invalidPath"),
+    ({"method": "PUT", "path": "/Users", "data": user("alice")}, "400", "invalidPath"),
+    ({"method": "POST", "path": "/Users", "data": user("alice")}, "400", "invalidValue"),
+    ({"method": "POST", "path": "/Users", "bulkId": "x", "data": {"userName": "alice"}}, "400", "invalidSyntax"),
+    ({"method": "POST", "path": "/Groups", "bulkId": "x", "data": group("group-1", "bulkId:missing")}, "409",
+     "invalidValue"),
+])
+def test_invalid_operations(client, recorded, operation, status, scim_type):
+    results = post_bulk(client, operation, {"method": "POST", "path": "/Users", "bulkId": "bob", "data": user("bob")})
+
+    assert statuses(results) == [status, "201"]
+    assert results[0]["response"]["status"] == status
+    assert results[0]["response"].get("scimType") == scim_type
+    # The valid operation is still applied
+    assert store.get_user("bob") is not None
+    assert recorded.events.count("put_user") == 1
+
+
+def test_invalid_requests(client, recorded):
+    assert client.post("/scim/v2/Bulk", content=b"{").json()["scimType"] == "invalidSyntax"
+    assert client.post("/scim/v2/Bulk", json={"Operations": "none"}).status_code == 400
+    assert recorded.events == []
+
+
+def test_fail_on_errors_stops_processing(client, recorded):
+    results = post_bulk(
+        client,
+        {"method": "POST", "path": "/Users", "bulkId": "a", "data": user("alice")},
+        {"method": "PATCH", "path": "/Users/alice"},
+        {"method": "POST", "path": "/Users", "bulkId": "f", "data": user(FAILED_EXTERNAL_ID)},
+        {"method": "POST", "path": "/Users", "bulkId": "b", "data": user("bob")},
+        fail_on_errors=2,
+    )
+
+    # Stopped at the second error, bob is neither upserted nor stored
+    assert statuses(results) == ["201", "405", "500"]
+    assert recorded.upserts == [("POST", "@alice:example.com", "alice")]
+    assert store.get_user("alice") is not None
+    assert store.get_user(FAILED_EXTERNAL_ID) is None
+    assert store.get_user("bob") is None
+
+
+def test_failed_upserts_are_not_stored(client, recorded):
+    results = post_bulk(
+        client,
+        {"method": "POST", "path": "/Users", "bulkId": "f", "data": user(FAILED_EXTERNAL_ID)},
+        {"method": "POST", "path": "/Users", "bulkId": "a", "data": user("alice")},
+    )
+
+    assert statuses(results) == ["500", "201"]
+    assert store.get_user(FAILED_EXTERNAL_ID) is None
+    assert store.get_user("alice") is not None
+
+
+# Operations on different users run concurrently, those on the same user one after another in request order
+def test_upserts_of_a_user_keep_request_order(client, recorded):
+    results = post_bulk(
+        client,
+        {"method": "PUT", "path": "/Users/@alice:example.com", "data": user("alice", "Alice 1")},
+        {"method": "PUT", "path": "/Users/@bob:example.com", "data": user("bob", "Bob 1")},
+        {"method": "PUT", "path": "/Users/@alice:example.com", "data": user("alice", "Alice 2")},
+        {"method": "PUT", "path": "/Users/@bob:example.com", "data": user("bob", "Bob 2")},
+    )
+
+    assert statuses(results) == ["200"] * 4
+    alice = [upsert[2] for upsert in recorded.upserts if upsert[1] == "@alice:example.com"]
+    bob = [upsert[2] for upsert in recorded.upserts if upsert[1] == "@bob:example.com"]
+    assert (alice, bob) == (["Alice 1", "Alice 2"], ["Bob 1", "Bob 2"])
+    # The last write of each user is stored
+    assert store.get_user("@alice:example.com")["displayName"] == "Alice 2"
+    assert store.get_user("@bob:example.com")["displayName"] == "Bob 2"
@@ -0,0 +1,28 @@
+# Planning the room operations of a SCIM group write in the default (join) mode
+from types import SimpleNamespace
+
+from scim import handle_group
+
+
+def group(group_id: str, *members: str):
+    return SimpleNamespace(
+        externalId=group_id, displayName=group_id, members=[{"value": member, "ref": None} for member in members],
+    )
+
+
+def test_join_mode_only_joins_added_members():
+    previous = {"members": [{"value": "@alice:example.com"}, {"value": "@bob:example.com"}]}
+
+    operations = handle_group.plan(group("group-1", "@alice:example.com", "@carol:example.com"), previous)
+
+    # bob was removed, but is left in the rooms
+    assert operations == [
+        ("join", "@carol:example.com", "!room1:example.com"),
+        ("join", "@carol:example.com", "!shared:example.com"),
+    ]
+
+
+def test_join_mode_plans_nothing_for_only_removed_members():
+    previous = {"members": [{"value": "@alice:example.com"}]}
+
+    assert handle_group.plan(group("group-1"), previous) == []
@@ -0,0 +1,132 @@
+# Replaying retried SCIM writes, with the in-memory store of a single process and the database store shared by several
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from scim import handle_user, store
+from scim.main import SCIM_USER_SCHEMA
+from utilities import idempotency
+
+AUTHORIZATION = {"authorization": "Bearer test"}
+
+
+@pytest.fixture(params=[idempotency.IdempotencyStore, idempotency.SharedIdempotencyStore])
+def idempotency_store(request, monkeypatch):
+    idempotency_store = request.param(100, 60)
+    monkeypatch.setattr(idempotency, "idempotency_store", idempotency_store)
+    return idempotency_store
+
+
+# Every Synapse update of a user as (matrix_id, display_name), slow enough for a retry to arrive while it runs
+@pytest.fixture
+def updates(monkeypatch):
+    updates = []
+
+    async def put(matrix_id, external_id, display_name, email=None, force=False):
+        updates.append((matrix_id, display_name))
+        await asyncio.sleep(0.2)
+        return matrix_id
+
+    monkeypatch.setattr(handle_user, "put", put)
+    return updates
+
+
+def user(display_name: str):
+    return {
+        "schemas": [SCIM_USER_SCHEMA],
+        "userName": "alice",
+        "name": {"formatted": None, "familyName": None, "givenName": None},
+        "displayName": display_name,
+        "emails": [{"value": "alice@example.com"}],
+        "externalId": "alice",
+    }
+
+
+async def put_users(*requests):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test",
+                                 headers=AUTHORIZATION) as client:
+        return await asyncio.gather(*(
+            client.put("/scim/v2/Users/@alice:example.com", json=user(display_name), headers=headers)
+            for display_name, headers in requests
+        ))
+
+
+def get_key(method="PUT", path="/scim/v2/Users/x", query="", headers=None, body=b"{}"):
+    return idempotency.get_key(method, path, query, headers or AUTHORIZATION, body)
+
+
+def test_key_covers_the_request():
+    key = get_key()
+    assert get_key() == key
+    assert get_key(method="POST") != key
+    assert get_key(path="/scim/v2/Users/y") != key
+    assert get_key(query="force=true") != key
+    assert get_key(headers={"authorization": "Bearer other"}) != key
+    assert get_key(headers={**AUTHORIZATION, "idempotency-key": "1"}) != key
+    assert get_key(headers={**AUTHORIZATION, "x-delivery-id": "1"}) != key
+    assert get_key(headers={**AUTHORIZATION, "x-delivery-id": "1"}) != get_key(
+        headers={**AUTHORIZATION, "x-delivery-id": "2"})
+    assert get_key(body=b'{"a": 1}') != key
+    # Other headers don't matter
+    assert get_key(headers={**AUTHORIZATION, "x-request-id": "1"}) == key
+
+
+def test_retry_is_replayed(idempotency_store, updates):
+    first, = asyncio.run(put_users(("Alice", {})))
+    retry, = asyncio.run(put_users(("Alice", {})))
+
+    assert updates == [("@alice:example.com", "Alice")]
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert (retry.status_code, retry.json()) == (first.status_code, first.json())
+    assert idempotency_store.stats()["hits"] == 1
+
+
+def test_different_requests_are_handled(idempotency_store, updates):
+    asyncio.run(put_users(("Alice", {})))
+    asyncio.run(put_users(("Alice", {"x-delivery-id": "2"})))
+    asyncio.run(put_users(("Alice B", {})))
+
+    assert updates == [("@alice:example.com", "Alice"), ("@alice:example.com", "Alice"),
+                       ("@alice:example.com", "Alice B")]
+
+
+# Only a resource's latest write is replayed, so going back to an earlier version is handled again
+def test_only_the_latest_write_of_a_resource_is_replayed(idempotency_store, updates):
+    asyncio.run(put_users(("Alice", {})))
+    asyncio.run(put_users(("Alice B", {})))
+    asyncio.run(put_users(("Alice", {})))
+
+    assert [display_name for _, display_name in updates] == ["Alice", "Alice B", "Alice"]
+    assert store.get_user("@alice:example.com")["displayName"] == "Alice"
+
+
+def test_retry_waits_for_the_request_in_flight(idempotency_store, updates):
+    first, retry = asyncio.run(put_users(("Alice", {}), ("Alice", {})))
+
+    assert updates == [("@alice:example.com", "Alice")]
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+
+
+def test_failed_writes_are_not_replayed(idempotency_store, monkeypatch):
+    calls = []
+
+    async def put(matrix_id, external_id, display_name, email=None, force=False):
+        calls.append(matrix_id)
+        if len(calls) == 1:
+            raise RuntimeError("Synapse is down")
+        return matrix_id
+
+    monkeypatch.setattr(handle_user, "put", put)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(put_users(("Alice", {})))
+    retry, = asyncio.run(put_users(("Alice", {})))
+
+    assert len(calls) == 2
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
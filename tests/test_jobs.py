@@ -0,0 +1,45 @@
+# The in-memory history of recent jobs
+import pytest
+
+from utilities import jobs
+
+HISTORY = 3
+
+
+@pytest.fixture(autouse=True)
+def history(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_HISTORY", HISTORY)
+    monkeypatch.setattr(jobs, "_jobs", jobs.OrderedDict())
+    monkeypatch.setattr(jobs, "_sharded", False)
+
+
+def remember(job_id: str, finished: bool = True):
+    jobs._remember(jobs.Job(job_id, 0.0, 1, finished_at=1.0 if finished else None))
+
+
+def test_oldest_finished_jobs_are_dropped_behind_unfinished_ones():
+    remember("unfinished-1", finished=False)
+    remember("finished-1")
+    remember("unfinished-2", finished=False)
+    remember("finished-2")
+    remember("finished-3")
+
+    assert list(jobs._jobs) == ["unfinished-1", "unfinished-2", "finished-3"]
+
+
+def test_unfinished_jobs_are_kept_beyond_the_history():
+    for i in range(HISTORY + 2):
+        remember(f"unfinished-{i}", finished=False)
+    remember("finished")
+
+    assert list(jobs._jobs) == [f"unfinished-{i}" for i in range(HISTORY + 2)]
+
+
+# Sharded jobs are read back from the database, so the history only keeps the latest jobs
+def test_sharded_history_drops_unfinished_jobs(monkeypatch):
+    monkeypatch.setattr(jobs, "_sharded", True)
+    remember("unfinished-1", finished=False)
+    for i in range(HISTORY):
+        remember(f"finished-{i}")
+
+    assert list(jobs._jobs) == [f"finished-{i}" for i in range(HISTORY)]
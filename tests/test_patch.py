@@ -0,0 +1,195 @@
+# SCIM PATCH of groups and users through the app. Group member changes are applied as a delta, the room operations
+# are planned from the same delta that is stored.
+from types import SimpleNamespace
+
+import pytest
+
+from scim import handle_group, handle_user, store
+from scim.main import SCIM_GROUP_SCHEMA, SCIM_USER_SCHEMA
+from scim.patch import SCIM_PATCH_SCHEMA
+from utilities import jobs
+
+ALICE, BOB, CAROL = "@alice:example.com", "@bob:example.com", "@carol:example.com"
+
+
+# The (added, removed) members of every plan_members call, and the operations of every submitted job
+@pytest.fixture
+def planned(monkeypatch):
+    planned = SimpleNamespace(deltas=[], jobs=[])
+    plan_members = handle_group.plan_members
+
+    def record_plan(external_id, display_name, added, removed):
+        planned.deltas.append((set(added), set(removed)))
+        return plan_members(external_id, display_name, added, removed)
+
+    def record_submit(operations, reconcile_failed=False):
+        planned.jobs.append(list(operations))
+        return SimpleNamespace(id=f"job-{len(planned.jobs)}")
+
+    monkeypatch.setattr(handle_group, "plan_members", record_plan)
+    monkeypatch.setattr(jobs, "submit", record_submit)
+    return planned
+
+
+def put_group(*members: str):
+    store.put_group("group-1", {
+        "schemas": [SCIM_GROUP_SCHEMA],
+        "displayName": "Group 1",
+        "externalId": "group-1",
+        "members": [{"value": member, "ref": None} for member in members],
+    })
+
+
+def get_members():
+    return {member["value"] for member in store.get_group("group-1")["members"]}
+
+
+def patch(client, path: str, *operations):
+    return client.patch(path, json={"schemas": [SCIM_PATCH_SCHEMA], "Operations": list(operations)})
+
+
+def patch_group(client, *operations):
+    response = patch(client, "/scim/v2/Groups/group-1", *operations)
+    assert response.status_code == 204
+    return response
+
+
+def test_add_members(client, planned):
+    put_group(ALICE)
+
+    response = patch_group(client, {"op": "add", "path": "members", "value": [{"value": ALICE}, {"value": BOB}]})
+
+    assert get_members() == {ALICE, BOB}
+    # alice was already a member
+    assert planned.deltas == [({BOB}, set())]
+    assert planned.jobs == [[("join", BOB, "!room1:example.com"), ("join", BOB, "!shared:example.com")]]
+    assert response.headers["X-Job-ID"] == "job-1"
+
+
+def test_remove_members(client, planned):
+    put_group(ALICE, BOB, CAROL)
+
+    patch_group(
+        client,
+        {"op": "remove", "path": f'members[value eq "{ALICE}"]'},
+        {"op": "remove", "path": "members", "value": [{"value": BOB}, {"value": "@unknown:example.com"}]},
+    )
+
+    assert get_members() == {CAROL}
+    assert planned.deltas == [(set(), {ALICE, BOB})]
+
+
+def test_remove_all_members(client, planned):
+    put_group(ALICE, BOB)
+
+    patch_group(client, {"op": "remove", "path": "members"})
+
+    assert get_members() == set()
+    assert planned.deltas == [(set(), {ALICE, BOB})]
+
+
+def test_replace_members(client, planned):
+    put_group(ALICE, BOB)
+
+    patch_group(client, {"op": "replace", "path": "members", "value": [{"value": BOB}, {"value": CAROL}]})
+
+    assert get_members() == {BOB, CAROL}
+    assert planned.deltas == [({CAROL}, {ALICE})]
+
+
+# A member added and removed again by the same request is neither stored nor joined
+def test_operations_apply_in_order(client, planned):
+    put_group(ALICE)
+
+    patch_group(
+        client,
+        {"op": "add", "path": "members", "value": [{"value": BOB}, {"value": CAROL}]},
+        {"op": "remove", "path": f'members[value eq "{BOB}"]'},
+        {"op": "replace", "value": {"displayName": "Renamed"}},
+    )
+
+    assert get_members() == {ALICE, CAROL}
+    assert store.get_group("group-1")["displayName"] == "Renamed"
+    assert planned.deltas == [({CAROL}, set())]
+
+
+def test_group_members_are_not_synced(client, planned):
+    put_group(ALICE)
+
+    patch_group(client, {"op": "add", "path": "members", "value": [{"value": "group-2", "$ref": "Group"}]})
+
+    assert get_members() == {ALICE, "group-2"}
+    assert planned.deltas == [(set(), set())]
+
+
+def test_patch_user(client, monkeypatch):
+    store.put_user("alice", {
+        "schemas": [SCIM_USER_SCHEMA],
+        "userName": "alice",
+        "name": {"formatted": "Alice A", "familyName": "A", "givenName": "Alice"},
+        "displayName": "Alice A",
+        "emails": [{"value": "alice@example.com", "type": "work", "primary": True}],
+        "active": True,
+        "externalId": "alice",
+    })
+    synced = []
+
+    async def put(user_id, external_id, display_name, email, force=False):
+        synced.append((user_id, external_id, display_name, email))
+        return ALICE
+
+    monkeypatch.setattr(handle_user, "put", put)
+
+    response = patch(
+        client, "/scim/v2/Users/alice",
+        {"op": "replace", "path": "displayName", "value": "Alice B"},
+        {"op": "replace", "path": "name.familyName", "value": "B"},
+        {"op": "replace", "path": 'emails[type eq "work"].value', "value": "alice.b@example.com"},
+        {"op": "add", "value": {"active": False}},
+    )
+
+    assert response.status_code == 200
+    user = store.get_user("alice")
+    assert user["displayName"] == "Alice B"
+    assert user["name"]["familyName"] == "B"
+    assert user["name"]["givenName"] == "Alice"
+    assert user["emails"] == [{"value": "alice.b@example.com", "type": "work", "primary": True}]
+    assert user["active"] is False
+    assert synced == [("alice", "alice", "Alice B", "alice.b@example.com")]
+
+
+@pytest.mark.parametrize("operation", [
+    {"op": "move", "path": "members", "value": []},
+    {"op": "add", "path": "owners", "value": []},
+    {"op": "add", "path": f'members[value eq "{ALICE}"]'},
+    {"op": "remove"},
+    {"op": "add", "value": "members"},
+    {"op": "add", "path": "members", "value": ["@alice:example.com"]},
+])
+def test_invalid_group_operations(client, planned, operation):
+    put_group(ALICE)
+
+    response = patch(client, "/scim/v2/Groups/group-1", operation)
+
+    assert response.status_code == 400
+    assert get_members() == {ALICE}
+    assert planned.jobs == []
+
+
+@pytest.mark.parametrize("operation", [
+    {"op": "copy", "path": "displayName", "value": "x"},
+    {"op": "replace", "path": "password", "value": "x"},
+    {"op": "replace", "path": 'emails[type eq "home"].value', "value": "x"},
+    {"op": "replace", "path": "active", "value": "not a boolean"},
+])
+def test_invalid_user_operations(client, operation):
+    store.put_user("alice", {"schemas": [SCIM_USER_SCHEMA], "userName": "alice", "displayName": "Alice",
+                             "emails": [{"value": "alice@example.com", "type": "work"}], "externalId": "alice"})
+
+    assert patch(client, "/scim/v2/Users/alice", operation).status_code == 400
+    assert store.get_user("alice")["displayName"] == "Alice"
+
+
+def test_missing_resources(client, planned):
+    assert patch(client, "/scim/v2/Groups/missing", {"op": "remove", "path": "members"}).status_code == 404
+    assert patch(client, "/scim/v2/Users/missing", {"op": "remove", "path": "active"}).status_code == 404
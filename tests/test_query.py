@@ -0,0 +1,100 @@
+# SCIM list filters compiled to SQL, run against the store through the list routes
+import pytest
+
+from scim import query, store
+from scim.main import SCIM_USER_SCHEMA
+
+USER_NAMES = ("alice", "Alfred", "bob", "carol", "dave")
+ERROR_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:Error"
+
+
+@pytest.fixture(autouse=True)
+def users():
+    for i, user_name in enumerate(USER_NAMES):
+        store.put_user(f"user-{i}", {
+            "schemas": [SCIM_USER_SCHEMA],
+            "userName": user_name,
+            "displayName": user_name.title() if user_name != "dave" else None,
+            "externalId": f"user-{i}",
+        })
+
+
+def list_user_names(client, **params):
+    response = client.get("/scim/v2/Users", params=params)
+    assert response.status_code == 200
+    return [user["userName"] for user in response.json()["Resources"]]
+
+
+def test_not_binds_tighter_than_and_which_binds_tighter_than_or(client):
+    # (bob) or ((not alice) and (not carol))
+    assert list_user_names(client, filter='userName eq "bob" or not userName eq "alice" and not userName eq "carol"') \
+        == ["Alfred", "bob", "dave"]
+    assert list_user_names(client, filter='(userName eq "bob" or userName eq "alice") and displayName sw "A"') \
+        == ["alice"]
+    assert list_user_names(client, filter='not (userName eq "bob" or userName sw "a")') == ["carol", "dave"]
+
+
+def test_starts_with_is_a_range_query():
+    sql, parameters = query.compile_filter('userName sw "al"', store.USER_COLUMNS)
+    assert sql == "(user_name >= ? AND user_name < ?)"
+    assert parameters == ["al", "al" + query.MAX_CHARACTER]
+
+
+def test_starts_with(client):
+    assert list_user_names(client, filter='userName sw "AL"') == ["alice", "Alfred"]
+    assert list_user_names(client, filter='userName sw ""') == list(USER_NAMES)
+
+
+def test_present(client):
+    assert list_user_names(client, filter="displayName pr") == ["alice", "Alfred", "bob", "carol"]
+    assert list_user_names(client, filter="not (displayName pr)") == ["dave"]
+
+
+# userName and displayName are NOCASE columns, externalId is case exact
+def test_case_folding(client):
+    assert list_user_names(client, filter='userName eq "ALICE"') == ["alice"]
+    assert list_user_names(client, filter='displayName co "LFR"') == ["Alfred"]
+    assert list_user_names(client, filter='userName ew "ED"') == ["Alfred"]
+    assert list_user_names(client, filter='externalId eq "USER-0"') == []
+    assert list_user_names(client, filter='externalId eq "user-0"') == ["alice"]
+
+
+def test_attribute_urn_prefix(client):
+    assert list_user_names(client, filter=f'{SCIM_USER_SCHEMA}:userName eq "bob"') == ["bob"]
+
+
+@pytest.mark.parametrize("expression", [
+    '(userName eq "bob"',
+    'userName eq "bob")',
+    'userName eq "bob',
+    'userName eq',
+    'userName "bob"',
+    'userName xx "bob"',
+    'password eq "bob"',
+    'userName eq bob',
+    'userName gt 1',
+    'userName eq "bob" and',
+    '()',
+])
+def test_malformed_filters_are_invalid_filter_errors(client, expression):
+    response = client.get("/scim/v2/Users", params={"filter": expression})
+    assert response.status_code == 400
+    error = response.json()
+    assert error["schemas"] == [ERROR_SCHEMA]
+    assert error["status"] == "400"
+    assert error["scimType"] == "invalidFilter"
+
+
+def test_pagination(client):
+    response = client.get("/scim/v2/Users", params={"startIndex": 2, "count": 2}).json()
+    assert (response["totalResults"], response["startIndex"], response["itemsPerPage"]) == (5, 2, 2)
+    assert [user["userName"] for user in response["Resources"]] == ["Alfred", "bob"]
+
+    # The total counts every match, not just the page
+    response = client.get("/scim/v2/Users", params={"filter": 'userName sw "a"', "count": 1}).json()
+    assert (response["totalResults"], response["itemsPerPage"]) == (2, 1)
+
+    # startIndex below 1 is 1, a page past the end is empty
+    assert list_user_names(client, startIndex=0, count=1) == ["alice"]
+    assert list_user_names(client, startIndex=6) == []
+    assert list_user_names(client, count=0) == []
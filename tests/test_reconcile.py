@@ -0,0 +1,76 @@
+# The full-state reconciler against the fake Synapse, with the store as the source of group members
+import asyncio
+
+import httpx
+
+import reconcile
+from benchmarks import fake_synapse
+from scim import store
+from scim.main import SCIM_GROUP_SCHEMA
+from synapse import synapse_admin
+
+
+def put_group(group_id: str, *members: str):
+    store.put_group(group_id, {
+        "schemas": [SCIM_GROUP_SCHEMA],
+        "displayName": group_id,
+        "externalId": group_id,
+        "members": [{"value": member, "ref": None} for member in members],
+    })
+
+
+def run_reconcile(synapse):
+    async def run():
+        await synapse_admin.open_client(httpx.ASGITransport(app=synapse))
+        try:
+            return await reconcile.reconcile("store")
+        finally:
+            await synapse_admin.close_client()
+
+    return asyncio.run(run())
+
+
+# group-1 is stored (received over SCIM), group-0 and group-2 only come in over the webhooks
+def test_only_rooms_of_stored_groups_are_kicked_from():
+    put_group("group-1", "@alice:example.com", "@bob:example.com")
+    synapse = fake_synapse.create_app()
+    synapse.state.rooms.update({
+        # Only mapped to group-0
+        "!room0:example.com": {"@webhook0:example.com"},
+        # Only mapped to group-1
+        "!room1:example.com": {"@alice:example.com", "@stale:example.com", "@remote:other.example"},
+        # Mapped to group-1 and group-2
+        "!shared:example.com": {"@alice:example.com", "@webhook2:example.com"},
+    })
+
+    summary = run_reconcile(synapse)
+
+    rooms = {room_id: members - {fake_synapse.ADMIN_USER_ID} for room_id, members in synapse.state.rooms.items()}
+    assert rooms == {
+        "!room0:example.com": {"@webhook0:example.com"},
+        "!room1:example.com": {"@alice:example.com", "@bob:example.com", "@remote:other.example"},
+        # bob is joined, but nobody is kicked, group-2's members are unknown
+        "!shared:example.com": {"@alice:example.com", "@bob:example.com", "@webhook2:example.com"},
+    }
+    assert (summary.rooms, summary.no_kick_rooms, summary.joins, summary.kicks) == (3, 2, 2, 1)
+
+
+def test_rooms_of_stored_groups_are_reconciled():
+    put_group("group-0", "@alice:example.com")
+    put_group("group-1", "@bob:example.com")
+    put_group("group-2")
+    synapse = fake_synapse.create_app()
+    synapse.state.rooms.update({
+        "!room0:example.com": {"@stale:example.com"},
+        "!shared:example.com": {"@alice:example.com", "@bob:example.com"},
+    })
+
+    summary = run_reconcile(synapse)
+
+    rooms = {room_id: members - {fake_synapse.ADMIN_USER_ID} for room_id, members in synapse.state.rooms.items()}
+    assert rooms == {
+        "!room0:example.com": {"@alice:example.com"},
+        "!room1:example.com": {"@bob:example.com"},
+        "!shared:example.com": {"@bob:example.com"},
+    }
+    assert summary.no_kick_rooms == 0
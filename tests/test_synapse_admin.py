@@ -0,0 +1,99 @@
+# Retries of rate limited requests to Synapse, against the fake Synapse
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks import fake_synapse
+from synapse import synapse_admin
+
+USER_URL = "/_synapse/admin/v2/users/@alice:example.com"
+
+
+# Send one request to a fake Synapse created with fake_options, returning the response, the fake, the seconds slept
+# before each retry and the seconds every request was paused for (the sleeps and pauses themselves are skipped)
+def send(monkeypatch, **fake_options):
+    delays = []
+    pauses = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        # httpx and the event loop yield with sleep(0)
+        if seconds:
+            delays.append(seconds)
+        else:
+            await real_sleep(0)
+
+    monkeypatch.setattr(synapse_admin.asyncio, "sleep", sleep)
+    # No rate limit, so the only sleeps are the retries'
+    rate_limiter = synapse_admin.RateLimiter(0, 1)
+    monkeypatch.setattr(rate_limiter, "pause", pauses.append)
+    monkeypatch.setattr(synapse_admin, "rate_limiter", rate_limiter)
+    # The longest possible delay, so the delays are predictable
+    monkeypatch.setattr(synapse_admin.random, "uniform", lambda low, high: high)
+
+    app = fake_synapse.create_app(**fake_options)
+
+    async def run():
+        await synapse_admin.open_client(httpx.ASGITransport(app=app))
+        try:
+            return await synapse_admin.request("PUT", USER_URL, json={"displayname": "Alice"})
+        finally:
+            await synapse_admin.close_client()
+
+    return asyncio.run(run()), app, delays, pauses
+
+
+def test_retry_after_ms_is_honoured(monkeypatch):
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_MAX_RETRIES", 2)
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_RETRY_BASE_DELAY", 0.25)
+
+    response, app, delays, pauses = send(monkeypatch, rate_limited=1.0, retry_after_ms=1500)
+
+    # Synapse's delay plus at most SYNAPSE_RETRY_BASE_DELAY of jitter, whatever the attempt
+    assert delays == [1.75, 1.75]
+    # And every other request waits too
+    assert pauses == delays
+    assert response.status_code == 429
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_MAX_RETRIES", 6)
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_RETRY_BASE_DELAY", 0.5)
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_RETRY_MAX_DELAY", 3.0)
+
+    # Without retry_after_ms the retries back off exponentially
+    response, app, delays, pauses = send(monkeypatch, rate_limited=1.0, retry_after_ms=None)
+
+    assert delays == [0.5, 1.0, 2.0, 3.0, 3.0, 3.0]
+    assert response.status_code == 429
+
+
+@pytest.mark.parametrize("retries", [0, 1, 3])
+def test_last_status_returned_once_out_of_retries(monkeypatch, retries):
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_MAX_RETRIES", retries)
+
+    response, app, delays, pauses = send(monkeypatch, rate_limited=1.0, retry_after_ms=10)
+
+    assert response.status_code == 429
+    assert response.json()["errcode"] == "M_LIMIT_EXCEEDED"
+    assert app.state.calls == {("injected", 429): retries + 1}
+    assert len(delays) == retries
+
+
+def test_succeeds_after_rate_limited(monkeypatch):
+    monkeypatch.setattr(synapse_admin, "SYNAPSE_MAX_RETRIES", 5)
+
+    # With this seed the first request is rate limited and the second isn't
+    response, app, delays, pauses = send(monkeypatch, rate_limited=0.5, retry_after_ms=10, seed=1)
+
+    assert response.status_code == 201
+    assert app.state.calls[("injected", 429)] == len(delays) == 1
+    assert app.state.calls[("user", 201)] == 1
+
+
+def test_errors_other_than_rate_limits_are_not_retried(monkeypatch):
+    response, app, delays, pauses = send(monkeypatch, errors=1.0)
+
+    assert response.status_code == 500
+    assert delays == []
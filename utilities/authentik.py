@@ -0,0 +1,76 @@
+# Authentik API client, used to read group memberships straight from the IdP instead of the SCIM store.
+# Groups are matched to IDP_GROUP_TO_ROOM by their pk and users to Matrix accounts by their uid, which is what
+# Authentik's SCIM provider sends as the group/user externalId.
+import asyncio
+from collections import deque
+from typing import Optional
+
+import httpx
+
+from config import AUTHENTIK_API_URL, AUTHENTIK_TOKEN, AUTHENTIK_PREFETCH_PAGES, SYNC_CONCURRENCY
+from synapse.user import get_matrix_account_id
+from utils import log, LogLevel
+
+PAGE_SIZE = 100
+TIMEOUT = 30
+
+
+# transport can be set to send requests somewhere other than AUTHENTIK_API_URL, i.e. to a fake Authentik
+def create_client(transport: Optional[httpx.AsyncBaseTransport] = None):
+    if not AUTHENTIK_API_URL or not AUTHENTIK_TOKEN:
+        raise RuntimeError("AUTHENTIK_API_URL and AUTHENTIK_TOKEN must be set to read groups from Authentik")
+    return httpx.AsyncClient(
+        base_url=AUTHENTIK_API_URL.rstrip("/"),
+        headers={"Authorization": f"Bearer {AUTHENTIK_TOKEN}"},
+        timeout=TIMEOUT,
+        transport=transport
+    )
+
+
+# Yield the results of every page of a paginated API, one page at a time. Up to prefetch (AUTHENTIK_PREFETCH_PAGES by
+# default) pages are fetched while the current page is being processed, so no more than prefetch + 1 pages are ever
+# held in memory.
+async def iter_pages(client: httpx.AsyncClient, path: str, params: Optional[dict] = None,
+                     prefetch: Optional[int] = None):
+    prefetch = max(AUTHENTIK_PREFETCH_PAGES if prefetch is None else prefetch, 1)
+
+    async def fetch(page):
+        response = await client.get(path, params={
+            **(params or {}), "page": page, "page_size": PAGE_SIZE, "ordering": "pk"
+        })
+        response.raise_for_status()
+        return response.json()
+
+    first = await fetch(1)
+    total_pages = first["pagination"]["total_pages"]
+    yield first["results"]
+
+    pending = deque()
+    next_page = 2
+    try:
+        while pending or next_page <= total_pages:
+            while next_page <= total_pages and len(pending) < prefetch:
+                pending.append(asyncio.create_task(fetch(next_page)))
+                next_page += 1
+            yield (await pending.popleft())["results"]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Matrix IDs of the active members of a group (by pk), read one page of users at a time. Users without a Matrix
+# account are left out.
+async def get_members_of_group(client: httpx.AsyncClient, group_id: str) -> set:
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def resolve(uid):
+        async with semaphore:
+            return await get_matrix_account_id(uid)
+
+    members = set()
+    async for page in iter_pages(client, "/api/v3/core/users/", {"groups_by_pk": group_id, "is_active": "true",
+                                                                 "include_groups": "false"}):
+        uids = [user["uid"] for user in page if user.get("is_active", True)]
+        members.update(matrix_id for matrix_id in await asyncio.gather(*map(resolve, uids)) if matrix_id is not None)
+    log(LogLevel.DEBUG, "Loaded %d members of group %s from Authentik.", len(members), group_id)
+    return members
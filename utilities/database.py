@@ -0,0 +1,204 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import DATABASE_FILE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    external_id TEXT,
+    user_name TEXT COLLATE NOCASE,
+    display_name TEXT COLLATE NOCASE,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_external_id ON users (external_id);
+CREATE INDEX IF NOT EXISTS users_user_name ON users (user_name);
+CREATE INDEX IF NOT EXISTS users_display_name ON users (display_name);
+
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    external_id TEXT,
+    display_name TEXT COLLATE NOCASE,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS groups_external_id ON groups (external_id);
+CREATE INDEX IF NOT EXISTS groups_display_name ON groups (display_name);
+
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    value TEXT NOT NULL,
+    ref TEXT,
+    PRIMARY KEY (group_id, value)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS group_members_value ON group_members (value);
+
+CREATE TABLE IF NOT EXISTS account_ids (
+    external_id TEXT PRIMARY KEY,
+    matrix_id TEXT,
+    expires_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_profiles (
+    matrix_id TEXT PRIMARY KEY,
+    body_hash TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    total INTEGER NOT NULL,
+    succeeded INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    errors TEXT NOT NULL DEFAULT '[]',
+    correlation_id TEXT,
+    failed_rooms TEXT
+);
+
+CREATE TABLE IF NOT EXISTS job_operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    matrix_user_id TEXT,
+    room_id TEXT NOT NULL,
+    shard INTEGER
+);
+CREATE INDEX IF NOT EXISTS job_operations_job_id ON job_operations (job_id);
+
+CREATE TABLE IF NOT EXISTS shard_leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_workers (
+    id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    scope TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    status_code INTEGER,
+    headers TEXT,
+    body BLOB,
+    route TEXT
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_scope ON idempotency_keys (scope);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at);
+"""
+
+# Columns added to tables after they were first created: (table, column, definition)
+COLUMNS = (
+    ("jobs", "correlation_id", "TEXT"),
+    ("jobs", "failed_rooms", "TEXT"),
+    ("job_operations", "shard", "INTEGER"),
+)
+
+# Indexes on added columns, created once the columns exist
+INDEXES = """
+CREATE INDEX IF NOT EXISTS job_operations_shard ON job_operations (shard, id);
+"""
+
+_connection = None
+_lock = threading.RLock()
+_transaction_depth = 0
+# Called after a transaction is rolled back, for in-memory copies of the database to drop what they cached from it
+_rollback_callbacks = []
+
+
+def _connect(database_file: str):
+    # Autocommit mode, transactions are opened explicitly with transaction()
+    connection = sqlite3.connect(database_file, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=5000")
+    connection.executescript(SCHEMA)
+    for table, column, definition in COLUMNS:
+        if column not in {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}:
+            connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    connection.executescript(INDEXES)
+    return connection
+
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        with _lock:
+            if _connection is None:
+                _connection = _connect(DATABASE_FILE)
+    return _connection
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+# Run the enclosed statements in one write transaction. Nested calls join the outermost transaction.
+@contextmanager
+def transaction():
+    global _transaction_depth
+    with _lock:
+        connection = get_connection()
+        if _transaction_depth > 0:
+            _transaction_depth += 1
+            try:
+                yield connection
+            finally:
+                _transaction_depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        _transaction_depth = 1
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            for callback in _rollback_callbacks:
+                callback()
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            _transaction_depth = 0
+
+
+def on_rollback(callback):
+    _rollback_callbacks.append(callback)
+
+
+def execute(sql: str, parameters=()):
+    with _lock:
+        return get_connection().execute(sql, parameters)
+
+
+def fetchone(sql: str, parameters=()):
+    with _lock:
+        return get_connection().execute(sql, parameters).fetchone()
+
+
+def fetchall(sql: str, parameters=()):
+    with _lock:
+        return get_connection().execute(sql, parameters).fetchall()
+
+
+def get_meta(key: str):
+    row = fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+    return row[0] if row else None
+
+
+def set_meta(key: str, value: str):
+    execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value))
@@ -0,0 +1,26 @@
+# JSON encoding/decoding for large SCIM payloads (i.e. groups with thousands of members). Uses orjson, which is several
+# times faster than the standard library, falling back to the json module if orjson isn't installed.
+import json
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+# Drop-in replacement for JSONResponse
+class JSONResponse(StarletteJSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,253 @@
+# Replays the response of a webhook or SCIM write that was already handled when the same request is sent again, i.e.
+# when the IdP retries a delivery after a timeout.
+# A request is identified by a hash of its method, path, query string, Authorization header, delivery ID header
+# (IDEMPOTENCY_HEADERS, if sent) and body. A retry that arrives while the first copy is still being handled waits for
+# it.
+# Every write belongs to a scope, the SCIM resource or webhook user it changes. Only a scope's latest write can be
+# replayed, so resending an earlier write after a different one (i.e. setting a group back to its previous members)
+# is handled again.
+# With several app processes (UVICORN_WORKERS) the responses are kept in the shared database, so a retry is replayed
+# whichever process it reaches.
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from starlette.responses import Response
+
+from config import IDEMPOTENCY_TTL, IDEMPOTENCY_SIZE, IDEMPOTENCY_HEADERS, UVICORN_WORKERS
+from utilities import database, fast_json
+from utils import get_user, get_user_id
+
+METHODS = ("POST", "PUT", "PATCH")
+PATH_PREFIXES = ("/sync/matrix", "/scim/v2/")
+
+# Responses larger than this are not kept, i.e. groups with many thousands of members
+MAX_BODY_SIZE = 1024 * 1024
+
+# Shared store: seconds between checks for a copy of the request handled by another process, seconds after which a
+# request that never finished (i.e. its process was killed) is handled again, and seconds between removals of expired
+# responses
+POLL_INTERVAL = 0.1
+PENDING_TIMEOUT = 60
+PRUNE_INTERVAL = 10
+
+
+def applies(method: str, path: str):
+    return method in METHODS and path.startswith(PATH_PREFIXES)
+
+
+def get_key(method: str, path: str, query: str, headers, body: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (method, path, query, headers.get("authorization", ""),
+                 *(headers.get(header, "") for header in IDEMPOTENCY_HEADERS)):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+# The SCIM resource (Users/<id>, Groups/<id>) or webhook user a write changes
+def get_scope(path: str, body: bytes) -> str:
+    try:
+        if path.startswith("/sync/matrix"):
+            return f"sync:{get_user_id(get_user(fast_json.loads(body)))}"
+
+        resource = path[len("/scim/v2/"):].strip("/")
+        if resource in ("Users", "Groups"):
+            # Created resources are stored under their externalId
+            return f"{resource}/{fast_json.loads(body).get('externalId')}"
+        return resource
+    except (ValueError, AttributeError):
+        return path
+
+
+class CachedResponse:
+    __slots__ = ("status_code", "headers", "body", "route")
+
+    # route is the path of the matched route, so replays are labelled with it in the request metrics
+    def __init__(self, status_code: int, headers: dict, body: bytes, route: Optional[str] = None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.route = route
+
+    def to_response(self):
+        return Response(content=self.body, status_code=self.status_code,
+                        headers={**self.headers, "Idempotent-Replayed": "true"})
+
+
+# Bounded TTL cache of request key -> response of the last successful write in each scope
+class IdempotencyStore:
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, scope, CachedResponse)
+        self._entries = OrderedDict()
+        # scope -> key of its latest write
+        self._scopes = {}
+        # key -> event set once the request is handled
+        self._in_flight = {}
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self.ttl > 0
+
+    # The response to replay for key, waiting for a copy of the request that is still being handled
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        event = self._in_flight.get(key)
+        if event is not None:
+            await event.wait()
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._forget(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    # Start handling the request with key, False if a copy of it is already being handled
+    def begin(self, key: str) -> bool:
+        if key in self._in_flight:
+            return False
+        self._in_flight[key] = asyncio.Event()
+        return True
+
+    # Record the outcome of a write, response is None if it can't be replayed (i.e. it failed)
+    def finish(self, key: str, scope: str, response: Optional[CachedResponse]):
+        previous = self._scopes.pop(scope, None)
+        if previous is not None:
+            self._entries.pop(previous, None)
+
+        if response is not None:
+            self._entries[key] = (time.monotonic() + self.ttl, scope, response)
+            self._scopes[scope] = key
+            while len(self._entries) > self.size:
+                self._forget(next(iter(self._entries)))
+
+        event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _forget(self, key: str):
+        _, scope, _ = self._entries.pop(key)
+        if self._scopes.get(scope) == key:
+            del self._scopes[scope]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+# The same cache in the shared database, for several app processes. A row without a status code is a request still
+# being handled, which copies of it wait for.
+class SharedIdempotencyStore:
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._pruned_at = 0.0
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self.ttl > 0
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        while True:
+            row = database.fetchone(
+                "SELECT expires_at, status_code, headers, body, route FROM idempotency_keys WHERE key = ?", (key,)
+            )
+            if row is None or row[0] < time.time():
+                self.misses += 1
+                return None
+            if row[1] is not None:
+                self.hits += 1
+                return CachedResponse(row[1], json.loads(row[2]), row[3], row[4])
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def begin(self, key: str) -> bool:
+        now = time.time()
+        with database.transaction() as connection:
+            row = connection.execute("SELECT expires_at FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] >= now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO idempotency_keys (key, scope, expires_at) VALUES (?, '', ?)",
+                               (key, now + PENDING_TIMEOUT))
+        return True
+
+    def finish(self, key: str, scope: str, response: Optional[CachedResponse]):
+        now = time.time()
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM idempotency_keys WHERE scope = ? AND key != ?", (scope, key))
+            if response is None:
+                connection.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+            else:
+                connection.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys (key, scope, expires_at, status_code, headers, body, route)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, scope, now + self.ttl, response.status_code, json.dumps(response.headers), response.body,
+                     response.route)
+                )
+
+            if now - self._pruned_at >= PRUNE_INTERVAL:
+                self._pruned_at = now
+                connection.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+                # Beyond size, the responses that expire first are dropped
+                connection.execute(
+                    "DELETE FROM idempotency_keys WHERE key IN (SELECT key FROM idempotency_keys"
+                    " WHERE status_code IS NOT NULL ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.size,)
+                )
+
+    def stats(self):
+        entries = database.fetchone("SELECT COUNT(*) FROM idempotency_keys WHERE status_code IS NOT NULL")[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+if UVICORN_WORKERS > 1:
+    idempotency_store = SharedIdempotencyStore(IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL)
+else:
+    idempotency_store = IdempotencyStore(IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL)
+
+
+# The app's route with the path (template), to label a replayed response with in the request metrics
+def get_route(request, path: Optional[str]):
+    for route in request.app.router.routes:
+        if getattr(route, "path", None) == path:
+            return route
+    return None
+
+
+# Handle a write request (see applies) with call_next, unless it's a copy of one already handled
+async def handle(request, call_next):
+    body = await request.body()
+    key = get_key(request.method, request.url.path, request.url.query, request.headers, body)
+    while True:
+        cached = await idempotency_store.get(key)
+        if cached is not None:
+            request.scope["route"] = get_route(request, cached.route)
+            return cached.to_response()
+        if idempotency_store.begin(key):
+            break
+        # A copy of the request started being handled since, wait for its response
+
+    cached = None
+    try:
+        response = await call_next(request)
+        if 200 <= response.status_code < 300:
+            content = b"".join([chunk async for chunk in response.body_iterator])
+            if len(content) <= MAX_BODY_SIZE:
+                route = request.scope.get("route")
+                cached = CachedResponse(response.status_code, dict(response.headers), content,
+                                        route.path if route else None)
+            response = Response(content=content, status_code=response.status_code, headers=dict(response.headers))
+        return response
+    finally:
+        idempotency_store.finish(key, get_scope(request.url.path, body), cached)
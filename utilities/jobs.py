@@ -0,0 +1,572 @@
+# Background job queue for room membership operations.
+# Handlers submit (action, matrix_user_id, room_id) operations and return straight away, workers apply them to Synapse.
+# Operations are sharded by room, so every operation for a room is handled by the same worker in submission order and
+# a join and a kick for the same user and room can never be reordered.
+# Operations wait COALESCE_WINDOW before running, so when several are queued for the same user and room only the last
+# one runs. Operations that wouldn't change a known room membership are skipped.
+# With several app processes (sharded), operations are only written to the database when submitted. Every process
+# leases a share of the JOB_SHARDS room shards (see shard_leases) and picks up the operations of its shards, so a room's
+# operations are still applied in order by one process, and records their results in the job's database row.
+# A process without workers (i.e. the bootstrap CLI next to a sharded app) only submits, and the app's processes run
+# its jobs.
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter, OrderedDict
+from itertools import islice
+from typing import Optional
+
+from config import JOB_WORKERS, JOB_BATCH_SIZE, JOB_PERSIST, JOB_HISTORY, COALESCE_WINDOW, JOB_SHARDS, \
+    JOB_LEASE_TTL, JOB_POLL_INTERVAL
+from scim.handle_group import reconcile_mapped_room
+from synapse.coalesce import coalescer, known_membership
+from synapse.room import add_to_room, remove_from_room, membership_slot
+from utilities import database, metrics
+from utilities.shard_leases import ShardLeases, get_shard
+from utils import log, LogLevel, correlation_id
+
+ACTIONS = {
+    "join": add_to_room,
+    "kick": remove_from_room,
+}
+
+# Maximum number of failed operations recorded per job
+MAX_JOB_ERRORS = 100
+
+
+class Job:
+    __slots__ = ("id", "created_at", "finished_at", "total", "succeeded", "failed", "skipped", "errors",
+                 "correlation_id", "failed_rooms")
+
+    # correlation_id is the ID of the request that submitted the job, jobs resumed after a restart use their own ID.
+    # failed_rooms is None, unless the rooms of failed operations are reconciled once the job finishes.
+    def __init__(self, job_id: str, created_at: float, total: int, succeeded: int = 0, failed: int = 0,
+                 skipped: int = 0, errors: Optional[list] = None, finished_at: Optional[float] = None,
+                 correlation_id: Optional[str] = None, failed_rooms: Optional[set] = None):
+        self.id = job_id
+        self.correlation_id = correlation_id or job_id
+        self.created_at = created_at
+        self.finished_at = finished_at
+        self.total = total
+        self.succeeded = succeeded
+        self.failed = failed
+        self.skipped = skipped
+        self.errors = errors if errors is not None else []
+        self.failed_rooms = failed_rooms
+
+    @property
+    def done(self):
+        return self.succeeded + self.failed + self.skipped
+
+    @property
+    def status(self):
+        if self.finished_at is None:
+            return "running" if self.done else "queued"
+        return "failed" if self.failed else "completed"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total": self.total,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "pending": self.total - self.done,
+            "errors": self.errors,
+        }
+
+
+class Operation:
+    __slots__ = ("id", "job", "action", "matrix_user_id", "room_id", "shard", "queued_at")
+
+    def __init__(self, job: Job, action: str, matrix_user_id: Optional[str], room_id: str, operation_id=None):
+        self.id = operation_id
+        self.job = job
+        self.action = action
+        self.matrix_user_id = matrix_user_id
+        self.room_id = room_id
+        self.shard = get_shard(room_id, JOB_SHARDS)
+        self.queued_at = time.monotonic()
+
+    @property
+    def key(self):
+        return self.matrix_user_id, self.room_id
+
+
+_queues = []
+_workers = []
+# Recent jobs by ID, unfinished jobs are never dropped
+_jobs = OrderedDict()
+
+# Sharded mode: whether jobs are submitted to the database for the shard holders, this process's shard leases (None if
+# it only submits), the ID of the last operation read from the database, the IDs of the operations queued here and not
+# done yet, and how many of those each shard has
+_sharded = False
+_leases: Optional[ShardLeases] = None
+_cursor = 0
+_dispatched = set()
+_pending = Counter()
+# Set when operations were submitted by this process, to pick them up without waiting for the next poll
+_wake = asyncio.Event()
+_coordinator = None
+
+OPERATIONS_IN_FLIGHT = metrics.Gauge("job_operations_in_flight", "Membership operations being applied, or waiting for a free Synapse slot.")
+OPERATIONS = metrics.Counter("job_operations_total", "Finished membership operations by action and result.",
+                             ("action", "result"))
+
+
+def _enqueue(operation: Operation):
+    coalescer.track(operation.key, operation)
+    _queues[operation.shard % len(_queues)].put_nowait(operation)
+
+
+# Beyond JOB_HISTORY, the oldest finished jobs are dropped, wherever they are behind older unfinished ones
+def _remember(job: Job):
+    _jobs[job.id] = job
+    excess = len(_jobs) - JOB_HISTORY
+    if excess <= 0:
+        return
+    # Sharded jobs are read back from the database, so unfinished ones can be dropped too
+    droppable = (job_id for job_id, old_job in _jobs.items() if _sharded or old_job.finished_at is not None)
+    for job_id in list(islice(droppable, excess)):
+        del _jobs[job_id]
+
+
+def _load_failed_rooms(value: Optional[str]) -> Optional[set]:
+    return set(json.loads(value)) if value is not None else None
+
+
+def _dump_failed_rooms(job: Job) -> Optional[str]:
+    return json.dumps(sorted(job.failed_rooms)) if job.failed_rooms is not None else None
+
+
+# Queue operations as one job and return it, without waiting for them to run.
+# With reconcile_failed, the rooms of any failed join/kick are reconciled once the job finishes, for jobs applying a
+# change that is already stored (i.e. a group's new members), which would otherwise be lost.
+def submit(operations, reconcile_failed: bool = False) -> Job:
+    if not _queues and not _sharded:
+        raise RuntimeError("Job queue is not running")
+
+    job = Job(uuid.uuid4().hex, time.time(), 0, correlation_id=correlation_id.get(),
+              failed_rooms=set() if reconcile_failed else None)
+    # Drop duplicate operations, keeping the first of each
+    queued = [Operation(job, *operation) for operation in dict.fromkeys(operations)]
+    job.total = len(queued)
+    _remember(job)
+    if not queued:
+        _finish_job(job)
+
+    if JOB_PERSIST:
+        with database.transaction() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, created_at, total, finished_at, correlation_id, failed_rooms)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.created_at, job.total, job.finished_at, job.correlation_id, _dump_failed_rooms(job))
+            )
+            for operation in queued:
+                operation.id = connection.execute(
+                    "INSERT INTO job_operations (job_id, action, matrix_user_id, room_id, shard) VALUES (?, ?, ?, ?, ?)",
+                    (job.id, operation.action, operation.matrix_user_id, operation.room_id, operation.shard)
+                ).lastrowid
+
+    if _sharded:
+        # Run by whichever process holds each room's shard, once it reads them from the database
+        _wake.set()
+    else:
+        for operation in queued:
+            _enqueue(operation)
+
+    log(LogLevel.DEBUG, "Queued job %s with %d operations.", job.id, job.total, job_id=job.id)
+    return job
+
+
+def _fetch_job(job_id: str) -> Optional[Job]:
+    row = database.fetchone(
+        "SELECT id, created_at, total, succeeded, failed, skipped, errors, finished_at, correlation_id, failed_rooms"
+        " FROM jobs WHERE id = ?",
+        (job_id,)
+    )
+    if row is None:
+        return None
+    return Job(*row[:6], errors=json.loads(row[6]), finished_at=row[7], correlation_id=row[8],
+               failed_rooms=_load_failed_rooms(row[9]))
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    # Sharded jobs may be submitted and run by other processes, the database is always up to date
+    if _sharded:
+        return _fetch_job(job_id)
+    job = _jobs.get(job_id)
+    if job is not None or not JOB_PERSIST:
+        return job
+    return _fetch_job(job_id)
+
+
+def get_queue_depth():
+    return sum(queue.qsize() for queue in _queues)
+
+
+# Number of room shards this process runs the operations of, None unless sharded
+def get_owned_shards():
+    return len(_leases.owned) if _leases is not None else None
+
+
+# Whether this process runs the app-wide background tasks (i.e. the scheduled reconcile), which is the process holding
+# shard 0 when sharded
+def is_leader():
+    return _leases is None or 0 in _leases.owned
+
+
+QUEUE_DEPTH = metrics.Gauge("job_queue_depth", "Membership operations waiting in the job queue.",
+                            function=get_queue_depth)
+
+
+def _finish_job(job: Job):
+    job.finished_at = time.time()
+    if job.failed:
+        log(LogLevel.ERROR, f"Job {job.id} finished with {job.failed}/{job.total} failed operations: {job.errors}",
+            job_id=job.id)
+    else:
+        log(LogLevel.DEBUG, "Job %s finished, %d operations succeeded and %d were skipped.", job.id, job.succeeded,
+            job.skipped, job_id=job.id)
+
+    if job.failed_rooms:
+        reconcile = submit(("reconcile", None, room_id) for room_id in sorted(job.failed_rooms))
+        log(LogLevel.INFO, f"Queued job {reconcile.id} reconciling the {len(job.failed_rooms)} rooms with failed "
+                           f"operations of job {job.id}.", job_id=job.id)
+
+
+# Whether a failed operation's room is to be reconciled when its job finishes
+def _track_failed_room(job: Job, operation: Operation):
+    if job.failed_rooms is None or operation.action == "reconcile" or operation.room_id in job.failed_rooms:
+        return False
+    job.failed_rooms.add(operation.room_id)
+    return True
+
+
+def _record(operation: Operation, success: bool, skipped: bool = False):
+    job = operation.job
+    result = "skipped" if skipped else "succeeded" if success else "failed"
+    OPERATIONS.inc(operation.action, result)
+    if _leases is not None:
+        _record_shared(operation, result)
+        return
+
+    if skipped:
+        job.skipped += 1
+    elif success:
+        job.succeeded += 1
+    else:
+        job.failed += 1
+        if len(job.errors) < MAX_JOB_ERRORS:
+            job.errors.append({
+                "action": operation.action, "matrix_user_id": operation.matrix_user_id, "room_id": operation.room_id
+            })
+        _track_failed_room(job, operation)
+    if job.done == job.total:
+        _finish_job(job)
+
+    if JOB_PERSIST:
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM job_operations WHERE id = ?", (operation.id,))
+            connection.execute(
+                "UPDATE jobs SET succeeded = ?, failed = ?, skipped = ?, errors = ?, finished_at = ?, failed_rooms = ?"
+                " WHERE id = ?",
+                (job.succeeded, job.failed, job.skipped, json.dumps(job.errors), job.finished_at,
+                 _dump_failed_rooms(job), job.id)
+            )
+
+
+# A sharded job's operations are recorded by the processes holding their rooms' shards, so the counts are incremented
+# in the database and whichever process records the last operation finishes the job
+def _record_shared(operation: Operation, result: str):
+    job = operation.job
+    with database.transaction() as connection:
+        connection.execute("DELETE FROM job_operations WHERE id = ?", (operation.id,))
+        connection.execute(f"UPDATE jobs SET {result} = {result} + 1 WHERE id = ?", (job.id,))
+        row = connection.execute(
+            "SELECT succeeded, failed, skipped, finished_at, errors, failed_rooms FROM jobs WHERE id = ?", (job.id,)
+        ).fetchone()
+        if row is None:
+            return
+        job.succeeded, job.failed, job.skipped, job.finished_at = row[:4]
+        job.failed_rooms = _load_failed_rooms(row[5])
+
+        if result == "failed":
+            job.errors = json.loads(row[4])
+            if len(job.errors) < MAX_JOB_ERRORS:
+                job.errors.append({
+                    "action": operation.action, "matrix_user_id": operation.matrix_user_id,
+                    "room_id": operation.room_id
+                })
+                connection.execute("UPDATE jobs SET errors = ? WHERE id = ?", (json.dumps(job.errors), job.id))
+            if _track_failed_room(job, operation):
+                connection.execute("UPDATE jobs SET failed_rooms = ? WHERE id = ?", (_dump_failed_rooms(job), job.id))
+        if job.done == job.total and job.finished_at is None:
+            _finish_job(job)
+            connection.execute("UPDATE jobs SET finished_at = ? WHERE id = ?", (job.finished_at, job.id))
+
+
+# Run an operation unless a later one for the same user and room replaced it, or it wouldn't change anything
+async def _run(operation: Operation):
+    # Log the operation's Synapse calls under the ID of the request that queued it
+    token = correlation_id.set(operation.job.correlation_id)
+    try:
+        if _leases is not None and operation.shard not in _leases.owned:
+            # The room's shard was taken over by another process, which runs the operation instead
+            return
+        if coalescer.is_superseded(operation.key, operation) or (
+                operation.action in ACTIONS
+                and known_membership.is_noop(operation.action, operation.matrix_user_id, operation.room_id)):
+            _record(operation, True, skipped=True)
+        else:
+            _record(operation, await _execute(operation))
+    finally:
+        coalescer.done(operation.key, operation)
+        if operation.id in _dispatched:
+            _dispatched.discard(operation.id)
+            _pending[operation.shard] -= 1
+        correlation_id.reset(token)
+
+
+async def _execute(operation: Operation):
+    OPERATIONS_IN_FLIGHT.inc()
+    try:
+        if operation.action == "reconcile":
+            results = await reconcile_mapped_room(operation.room_id)
+            return results is not None and all(results.values())
+
+        async with membership_slot(operation.room_id):
+            return await ACTIONS[operation.action](operation.matrix_user_id, operation.room_id)
+    except Exception as e:
+        log(LogLevel.ERROR, f"Error running {operation.action} for {operation.matrix_user_id} in {operation.room_id}: {e!r}")
+        return False
+    finally:
+        OPERATIONS_IN_FLIGHT.dec()
+
+
+# Run operations concurrently, except operations for the same user and room which run in order
+async def _run_concurrently(operations):
+    by_key = {}
+    for operation in operations:
+        by_key.setdefault((operation.matrix_user_id, operation.room_id), []).append(operation)
+
+    async def run_in_order(key_operations):
+        for operation in key_operations:
+            await _run(operation)
+
+    await asyncio.gather(*map(run_in_order, by_key.values()))
+
+
+# A reconcile reads a whole room, so it runs on its own after everything queued before it
+async def _run_batch(batch):
+    pending = []
+    for operation in batch:
+        if operation.action == "reconcile":
+            await _run_concurrently(pending)
+            pending = []
+            await _run(operation)
+        else:
+            pending.append(operation)
+    await _run_concurrently(pending)
+
+
+async def _worker(queue: asyncio.Queue):
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < JOB_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # Give later operations for the same user and room the chance to replace these
+        delay = batch[-1].queued_at + COALESCE_WINDOW - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            await _run_batch(batch)
+        except Exception as e:
+            log(LogLevel.ERROR, f"Job worker failed to run a batch: {e!r}")
+
+
+def _prune_history():
+    database.execute(
+        "DELETE FROM jobs WHERE finished_at IS NOT NULL AND id NOT IN "
+        "(SELECT id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+        (JOB_HISTORY,)
+    )
+
+
+# Load unfinished jobs persisted by a previous run and queue their remaining operations
+def _resume():
+    _prune_history()
+
+    jobs = {}
+    for row in database.fetchall(
+            "SELECT id, created_at, total, succeeded, failed, skipped, errors, correlation_id, failed_rooms FROM jobs"
+            " WHERE finished_at IS NULL ORDER BY created_at"):
+        jobs[row[0]] = Job(*row[:6], errors=json.loads(row[6]), correlation_id=row[7],
+                           failed_rooms=_load_failed_rooms(row[8]))
+        _remember(jobs[row[0]])
+
+    operations = database.fetchall(
+        "SELECT id, job_id, action, matrix_user_id, room_id FROM job_operations ORDER BY id"
+    )
+    for operation_id, job_id, action, matrix_user_id, room_id in operations:
+        job = jobs.get(job_id)
+        if job is None:
+            continue
+        _enqueue(Operation(job, action, matrix_user_id, room_id, operation_id))
+
+    # Jobs whose last operation finished just before the previous run stopped
+    for job_id in jobs.keys() - {operation[1] for operation in operations}:
+        job = jobs[job_id]
+        _finish_job(job)
+        database.execute("UPDATE jobs SET finished_at = ? WHERE id = ?", (job.finished_at, job.id))
+
+    if operations:
+        log(LogLevel.INFO, f"Resuming {len(operations)} queued operations from {len(jobs)} jobs.")
+
+
+# Queue the given (id, job_id, action, matrix_user_id, room_id, shard) operation rows, unless already queued
+def _load(rows):
+    for operation_id, job_id, action, matrix_user_id, room_id, shard in rows:
+        if operation_id in _dispatched:
+            continue
+        job = _jobs.get(job_id)
+        if job is None:
+            job = _fetch_job(job_id)
+            if job is None:
+                continue
+            _remember(job)
+        _dispatched.add(operation_id)
+        _pending[shard] += 1
+        _enqueue(Operation(job, action, matrix_user_id, room_id, operation_id))
+
+
+# Queue the operations submitted (by any process) since the last call for the shards this process holds
+def _dispatch():
+    global _cursor
+    rows = database.fetchall(
+        "SELECT id, job_id, action, matrix_user_id, room_id, shard FROM job_operations WHERE id > ? ORDER BY id",
+        (_cursor,)
+    )
+    if rows:
+        _cursor = rows[-1][0]
+    _load([row for row in rows if row[5] in _leases.owned])
+
+
+# Renew this process's shard leases, and queue the operations already submitted for any shards it took over
+def _balance():
+    claimed, _ = _leases.balance(lambda shard: not _pending[shard])
+    if not claimed:
+        return
+
+    # Memberships seen while another process ran these rooms' operations may have changed since
+    for room_id in known_membership.room_ids():
+        if get_shard(room_id, JOB_SHARDS) in claimed:
+            known_membership.forget_room(room_id)
+    placeholders = ", ".join("?" * len(claimed))
+    _load(database.fetchall(
+        "SELECT id, job_id, action, matrix_user_id, room_id, shard FROM job_operations"
+        f" WHERE shard IN ({placeholders}) AND id <= ? ORDER BY id",
+        (*claimed, _cursor)
+    ))
+
+
+async def _coordinate():
+    balanced_at = time.monotonic()
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+        try:
+            if time.monotonic() - balanced_at >= JOB_LEASE_TTL / 3:
+                balanced_at = time.monotonic()
+                _balance()
+            _dispatch()
+        except Exception as e:
+            log(LogLevel.ERROR, f"Job coordinator failed: {e!r}")
+
+
+def _start_sharded():
+    global _leases, _cursor, _coordinator
+    _prune_history()
+    with database.transaction() as connection:
+        # Operations queued by an older version, or before JOB_SHARDS was changed
+        if database.get_meta("job_shards") != str(JOB_SHARDS):
+            rows = connection.execute("SELECT id, room_id FROM job_operations").fetchall()
+            database.set_meta("job_shards", str(JOB_SHARDS))
+        else:
+            rows = connection.execute("SELECT id, room_id FROM job_operations WHERE shard IS NULL").fetchall()
+        connection.executemany("UPDATE job_operations SET shard = ? WHERE id = ?",
+                               ((get_shard(room_id, JOB_SHARDS), operation_id) for operation_id, room_id in rows))
+        # Jobs whose last operation was recorded by an older version just before it stopped
+        connection.execute("UPDATE jobs SET finished_at = ? WHERE finished_at IS NULL AND id NOT IN "
+                           "(SELECT job_id FROM job_operations)", (time.time(),))
+
+    _leases = ShardLeases(JOB_SHARDS, JOB_LEASE_TTL)
+    _cursor = database.fetchone("SELECT MAX(id) FROM job_operations")[0] or 0
+    _balance()
+    _coordinator = asyncio.create_task(_coordinate())
+
+
+# With resume=False jobs persisted by a previous run are left for the next start of the app.
+# With sharded=True (several app processes sharing the database) every persisted operation is run by the process
+# holding its room's shard, whatever resume is. With sharded=True and no workers, jobs are only submitted.
+async def start(workers: int = JOB_WORKERS, resume: bool = True, sharded: bool = False):
+    global _sharded
+    if sharded and not JOB_PERSIST:
+        raise RuntimeError("JOB_PERSIST must be enabled to share the job queue between processes")
+
+    for _ in range(workers):
+        queue = asyncio.Queue()
+        _queues.append(queue)
+        _workers.append(asyncio.create_task(_worker(queue)))
+
+    _sharded = sharded
+    if sharded and workers:
+        _start_sharded()
+    elif JOB_PERSIST and resume:
+        _resume()
+
+
+# Wait for a job to finish
+async def wait(job: Job, interval: float = 0.5):
+    while job.finished_at is None:
+        await asyncio.sleep(interval)
+        if _sharded:
+            latest = _fetch_job(job.id)
+            if latest is None:
+                return
+            job.succeeded, job.failed, job.skipped, job.errors, job.finished_at = \
+                latest.succeeded, latest.failed, latest.skipped, latest.errors, latest.finished_at
+
+
+# Stop the workers. Unfinished operations are kept in the database (if persisted) and resumed on the next start, or
+# when sharded, taken over by the other processes.
+async def stop():
+    global _sharded, _leases, _coordinator, _cursor
+    if _coordinator is not None:
+        _coordinator.cancel()
+        await asyncio.gather(_coordinator, return_exceptions=True)
+        _coordinator = None
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queues.clear()
+    _sharded = False
+
+    if _leases is not None:
+        _leases.release()
+        _leases = None
+        _cursor = 0
+        _dispatched.clear()
+        _pending.clear()
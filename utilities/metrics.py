@@ -0,0 +1,129 @@
+# Minimal metrics exported in the Prometheus text format (https://prometheus.io/docs/instrumenting/exposition_formats/)
+# on /metrics. Metrics register themselves when created, and label values are passed positionally in the order of
+# the metric's label names, i.e. SYNAPSE_RESPONSES.inc("join", 200).
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Optional
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, for HTTP requests
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds, for local storage calls
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def _samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}"
+
+    def render(self):
+        return "\n".join((f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}",
+                          *self._samples()))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+# A gauge is either set directly, or read from function() when rendered. function returns a single value for a gauge
+# without labels, or a dict of label values -> value.
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels=(), function: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def _samples(self):
+        if self.function is not None:
+            value = self.function()
+            self._values = value if isinstance(value, dict) else {(): value}
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    # Each label set's value is [count per bucket..., count above the last bucket, sum]
+    def observe(self, value: float, *label_values):
+        counts = self._values.get(label_values)
+        if counts is None:
+            counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _samples(self):
+        for label_values, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}"
+            labels = _format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+# Decorator observing how long each call of the function takes
+def timed(histogram: Histogram, *label_values):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *label_values)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
@@ -0,0 +1,270 @@
+# The IdP group -> Matrix rooms mapping. It is read from GROUP_MAPPING_FILE (YAML or JSON) if that exists, otherwise
+# from IDP_GROUP_TO_ROOM. Room aliases are resolved to room IDs once and cached.
+# Inside the app the file is watched. When it changes, it is parsed and validated, its aliases are resolved and its
+# indexes are built in the background. The new mapping then replaces the old one in one step, so a request only ever
+# sees one of them. An invalid file is logged and the previous mapping kept.
+# With GROUP_MAPPING_RECONCILE, a group's members (from RECONCILE_SOURCE) are joined to the rooms a reload added to the
+# group and kicked from the rooms it removed, unless another of their groups still grants the room.
+import asyncio
+import os
+from types import MappingProxyType
+
+import yaml
+
+from config import IDP_GROUP_TO_ROOM, GROUP_MAPPING_FILE, GROUP_MAPPING_RECONCILE, RECONCILE_SOURCE
+from scim import store
+from synapse.room import resolve_room_id
+from utils import log, LogLevel
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+# Seconds between checks of the file's modification time when watchfiles isn't installed
+POLL_INTERVAL = 5
+
+
+# Build read-only group -> rooms and room -> groups lookups from a group to room mapping
+def build_mapping_indexes(group_to_room):
+    group_to_rooms = {group: frozenset(rooms) for group, rooms in group_to_room.items()}
+    room_to_groups = {}
+    for group, rooms in group_to_rooms.items():
+        for room_id in rooms:
+            room_to_groups.setdefault(room_id, set()).add(group)
+    return (
+        MappingProxyType(group_to_rooms),
+        MappingProxyType({room_id: frozenset(groups) for room_id, groups in room_to_groups.items()})
+    )
+
+
+# One version of the mapping with its lookups, never changed once built
+class GroupMapping:
+    __slots__ = ("source", "group_to_room", "group_to_rooms", "room_to_groups")
+
+    def __init__(self, source: str, group_to_room: dict):
+        self.source = source
+        self.group_to_room = group_to_room
+        self.group_to_rooms, self.room_to_groups = build_mapping_indexes(group_to_room)
+
+
+# Check a parsed mapping is {group: [room ID or alias, ...]}, returning it with string group IDs
+def validate(data, source: str) -> dict:
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{source}: expected a mapping of groups to lists of rooms, got {type(data).__name__}")
+
+    group_to_room = {}
+    for group, rooms in data.items():
+        if not isinstance(group, (str, int)) or isinstance(group, bool):
+            raise ValueError(f"{source}: group {group!r} is not a string")
+        if not isinstance(rooms, list):
+            raise ValueError(f"{source}: rooms of group {group} must be a list")
+        for room in rooms:
+            if not isinstance(room, str) or not room.startswith(("!", "#", "%23")) or ":" not in room:
+                raise ValueError(f"{source}: {room!r} in group {group} is not a room ID (!room:server) or alias "
+                                 f"(#room:server)")
+        group_to_room[str(group)] = list(dict.fromkeys(rooms))
+    return group_to_room
+
+
+# Read and validate the mapping, from the file if it exists. Raises ValueError if it's invalid.
+def read() -> GroupMapping:
+    try:
+        with open(GROUP_MAPPING_FILE, "r") as f:
+            # JSON is valid YAML
+            data = yaml.safe_load(f)
+    except FileNotFoundError:
+        return GroupMapping("IDP_GROUP_TO_ROOM", validate(IDP_GROUP_TO_ROOM, "IDP_GROUP_TO_ROOM"))
+    except yaml.YAMLError as e:
+        raise ValueError(f"{GROUP_MAPPING_FILE}: {e}")
+    return GroupMapping(GROUP_MAPPING_FILE, validate(data, GROUP_MAPPING_FILE))
+
+
+try:
+    _current = read()
+except ValueError as e:
+    raise RuntimeError(f"Invalid group to room mapping: {e}")
+_task = None
+_stop = asyncio.Event()
+
+
+# The current mapping. Read it once per request, so every lookup in the request uses the same version.
+def get() -> GroupMapping:
+    return _current
+
+
+# Replace the rooms' aliases with their room IDs. Aliases that can't be resolved are kept, and retried on the next load.
+async def resolve_aliases(mapping: GroupMapping) -> GroupMapping:
+    aliases = {room for room in mapping.room_to_groups if not room.startswith("!")}
+    if not aliases:
+        return mapping
+
+    room_ids = dict(zip(aliases, await asyncio.gather(*map(resolve_room_id, aliases))))
+    group_to_room = {
+        group: list(dict.fromkeys(room_ids.get(room) or room for room in rooms))
+        for group, rooms in mapping.group_to_room.items()
+    }
+    return await asyncio.to_thread(GroupMapping, mapping.source, group_to_room)
+
+
+def _log_mapping(mapping: GroupMapping):
+    log(LogLevel.INFO, f"Loaded mapping of {len(mapping.group_to_rooms)} groups to {len(mapping.room_to_groups)} rooms "
+                       f"from {mapping.source}:")
+    for group, rooms in mapping.group_to_room.items():
+        log(LogLevel.INFO, f"Group: {group} -> Rooms: {rooms}")
+
+
+# Resolve the aliases of the mapping read at startup (needs the Synapse client to be open)
+async def load():
+    global _current
+    _current = await resolve_aliases(_current)
+    _log_mapping(_current)
+
+
+# The rooms added to or removed from any group between two mappings
+def get_changed_rooms(old: GroupMapping, new: GroupMapping):
+    rooms = set()
+    for group in old.group_to_rooms.keys() | new.group_to_rooms.keys():
+        rooms.update(old.group_to_rooms.get(group, frozenset()) ^ new.group_to_rooms.get(group, frozenset()))
+    return rooms
+
+
+# Read the mapping again and swap it in if it's valid. Returns the rooms whose groups changed.
+async def reload():
+    global _current
+    try:
+        mapping = await asyncio.to_thread(read)
+    except ValueError as e:
+        log(LogLevel.ERROR, f"Invalid group to room mapping, keeping the previous one: {e}")
+        return set()
+
+    mapping = await resolve_aliases(mapping)
+    previous, _current = _current, mapping
+    _log_mapping(mapping)
+    changed_rooms = get_changed_rooms(previous, mapping)
+    if changed_rooms and GROUP_MAPPING_RECONCILE:
+        await _apply_changes(previous, mapping)
+    return changed_rooms
+
+
+# Members of each of the groups from RECONCILE_SOURCE, None for a group the store has no record of
+async def get_members(groups) -> dict:
+    groups = sorted(groups)
+    if RECONCILE_SOURCE == "authentik":
+        # Imported here so the store source works without Authentik configured
+        from utilities import authentik
+        async with authentik.create_client() as client:
+            return dict(zip(groups, await asyncio.gather(
+                *(authentik.get_members_of_group(client, group) for group in groups)
+            )))
+
+    unknown = store.get_unknown_groups(groups)
+    return {group: store.get_members_of_groups([group]) if group not in unknown else None for group in groups}
+
+
+# The joins/kicks moving the members of every group from its rooms in old to its rooms in new. Members are kicked
+# from a room taken out of their group unless another group still mapped to it has them, and not at all if any of
+# those groups' members are unknown. members has the members of every group changed and every group of those rooms.
+def plan_changes(old: GroupMapping, new: GroupMapping, members: dict):
+    operations = []
+    for group in sorted(old.group_to_rooms.keys() | new.group_to_rooms.keys()):
+        old_rooms = old.group_to_rooms.get(group, frozenset())
+        new_rooms = new.group_to_rooms.get(group, frozenset())
+        group_members = members.get(group)
+        if old_rooms == new_rooms or group_members is None:
+            continue
+
+        operations.extend(
+            ("join", matrix_id, room_id)
+            for room_id in sorted(new_rooms - old_rooms) for matrix_id in sorted(group_members)
+        )
+        for room_id in sorted(old_rooms - new_rooms):
+            granting_groups = new.room_to_groups.get(room_id, frozenset())
+            if any(members.get(granting_group) is None for granting_group in granting_groups):
+                log(LogLevel.INFO, f"Not kicking the members of group {group} from {room_id}, the members of some "
+                                   f"of its other groups are unknown.")
+                continue
+            granted = set().union(*(members[granting_group] for granting_group in granting_groups))
+            operations.extend(("kick", matrix_id, room_id) for matrix_id in sorted(group_members - granted))
+    return operations
+
+
+# Queue the joins/kicks of the rooms added to and removed from each group by a reload
+async def _apply_changes(old: GroupMapping, new: GroupMapping):
+    # Imported here, the job queue imports this module through handle_group
+    from utilities import jobs
+
+    # Only one of several app processes applies the changes
+    if not jobs.is_leader():
+        return
+
+    changed_groups = {
+        group for group in old.group_to_rooms.keys() | new.group_to_rooms.keys()
+        if old.group_to_rooms.get(group) != new.group_to_rooms.get(group)
+    }
+    removed_rooms = set().union(*(
+        old.group_to_rooms.get(group, frozenset()) - new.group_to_rooms.get(group, frozenset())
+        for group in changed_groups
+    ))
+    members = await get_members(
+        changed_groups.union(*(new.room_to_groups.get(room_id, ()) for room_id in removed_rooms))
+    )
+    unknown = sorted(group for group in changed_groups if members[group] is None)
+    if unknown:
+        log(LogLevel.INFO, f"Groups without stored members, their rooms are left as they are: {unknown}")
+
+    operations = plan_changes(old, new, members)
+    if operations:
+        job = jobs.submit(operations)
+        log(LogLevel.INFO, f"Queued job {job.id} with {job.total} joins/kicks for the groups changed by the new "
+                           f"mapping.")
+
+
+async def _watch():
+    if watchfiles is not None:
+        # Watch the directory, as editors often replace the file rather than write to it
+        path = os.path.abspath(GROUP_MAPPING_FILE)
+        # Stopped with _stop rather than cancelled, which would leave the watcher's thread running
+        async for _ in watchfiles.awatch(os.path.dirname(path), watch_filter=lambda change, changed: changed == path,
+                                         stop_event=_stop):
+            await _reload_logged()
+        return
+
+    def modified():
+        try:
+            return os.stat(GROUP_MAPPING_FILE).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    last_modified = modified()
+    while not _stop.is_set():
+        await asyncio.sleep(POLL_INTERVAL)
+        if modified() != last_modified:
+            last_modified = modified()
+            await _reload_logged()
+
+
+async def _reload_logged():
+    try:
+        await reload()
+    except Exception as e:
+        log(LogLevel.ERROR, f"Reloading the group to room mapping failed: {e!r}")
+
+
+# Reload the mapping in the background whenever the file changes
+def start():
+    global _task
+    _stop.clear()
+    _task = asyncio.create_task(_watch())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _stop.set()
+        if watchfiles is None:
+            _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
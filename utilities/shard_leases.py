@@ -0,0 +1,78 @@
+# Splits the job queue's shards between the app's worker processes (uvicorn --workers), using leases in the shared
+# database. Every room hashes to one of JOB_SHARDS shards and only the worker holding a shard's lease runs its
+# operations, so a room's operations are still applied in order by one process.
+# Workers renew their leases and heartbeat every JOB_LEASE_TTL / 3 seconds. Each worker holds about an equal share of
+# the shards: a new worker takes free shards as the others give back idle shards above their share, and the shards of
+# a worker that stopped heartbeating are taken over once their leases expire.
+import math
+import time
+import uuid
+import zlib
+
+from utilities import database
+from utils import log, LogLevel
+
+
+def get_shard(room_id: str, shards: int) -> int:
+    return zlib.crc32(room_id.encode()) % shards
+
+
+# Whether any app process holds shard leases, i.e. the app is running with several workers
+def has_live_leases() -> bool:
+    return database.fetchone("SELECT COUNT(*) FROM shard_leases WHERE expires_at >= ?", (time.time(),))[0] > 0
+
+
+class ShardLeases:
+    def __init__(self, shards: int, ttl: float):
+        self.shards = shards
+        self.ttl = ttl
+        self.id = uuid.uuid4().hex
+        self.owned = set()
+
+    # Heartbeat, renew the held leases, give back idle shards above this worker's share (is_idle(shard) says whether
+    # a shard has operations still running here) and take free ones up to it.
+    # Returns the newly taken shards and the shards lost to another worker since the last call.
+    def balance(self, is_idle):
+        now = time.time()
+        expires_at = now + self.ttl
+        with database.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO job_workers (id, heartbeat) VALUES (?, ?)", (self.id, now))
+            connection.execute("DELETE FROM job_workers WHERE heartbeat < ?", (now - self.ttl,))
+            workers = connection.execute("SELECT COUNT(*) FROM job_workers").fetchone()[0]
+            share = math.ceil(self.shards / workers)
+
+            connection.execute("UPDATE shard_leases SET expires_at = ? WHERE owner = ?", (expires_at, self.id))
+            owned = {
+                shard for shard, in connection.execute("SELECT shard FROM shard_leases WHERE owner = ?", (self.id,))
+            }
+            lost = self.owned - owned
+
+            for shard in sorted(owned, reverse=True):
+                if len(owned) <= share:
+                    break
+                if is_idle(shard):
+                    connection.execute("DELETE FROM shard_leases WHERE shard = ? AND owner = ?", (shard, self.id))
+                    owned.discard(shard)
+
+            taken = {
+                shard for shard, in connection.execute("SELECT shard FROM shard_leases WHERE expires_at >= ?", (now,))
+            }
+            claimed = [shard for shard in range(self.shards) if shard not in taken][:max(share - len(owned), 0)]
+            connection.executemany(
+                "INSERT OR REPLACE INTO shard_leases (shard, owner, expires_at) VALUES (?, ?, ?)",
+                ((shard, self.id, expires_at) for shard in claimed)
+            )
+            owned.update(claimed)
+
+        if claimed or lost:
+            log(LogLevel.INFO, f"Worker {self.id} holds {len(owned)}/{self.shards} job shards "
+                               f"({len(claimed)} taken, {len(lost)} lost, {workers} workers).")
+        self.owned = owned
+        return claimed, lost
+
+    # Give back every lease, so the other workers take the shards over without waiting for them to expire
+    def release(self):
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM shard_leases WHERE owner = ?", (self.id,))
+            connection.execute("DELETE FROM job_workers WHERE id = ?", (self.id,))
+        self.owned = set()
@@ -1,27 +1,94 @@
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
 import requests
 from fastapi import HTTPException
 from enum import Enum
 
-from config import WEBHOOK_SECRET, MATRIX_SERVER_NAME, MATRIX_ADMIN_USER_ID, MATRIX_URL, LOG_LEVEL, MATRIX_ADMIN_TOKEN
+from config import WEBHOOK_SECRET, MATRIX_SERVER_NAME, MATRIX_ADMIN_USER_ID, MATRIX_URL, LOG_LEVEL, LOG_FORMAT, \
+    MATRIX_ADMIN_TOKEN
 
 
 # Enum for log levels
 class LogLevel(Enum):
-    DEBUG = 1
-    INFO = 2
-    ERROR = 3
+    DEBUG = logging.DEBUG
+    INFO = logging.INFO
+    WARNING = logging.WARNING
+    ERROR = logging.ERROR
+
+
+# ID of the webhook/SCIM request (or job) being handled, added to every log line so the Synapse calls a request caused
+# can be found
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+
+class _CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+# One JSON object per line: time, level, message, correlation_id and any fields passed to log()
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, default=str)
+
 
+class TextFormatter(logging.Formatter):
+    COLORS = {"DEBUG": "\033[94m", "INFO": "\033[92m", "WARNING": "\033[93m", "ERROR": "\033[91m"}
 
-def log(level=LogLevel.INFO, message=""):
-    if level == LogLevel.DEBUG:
-        if LOG_LEVEL == "DEBUG":
-            print(f"{bcolors.OKBLUE}DEBUG:{bcolors.ENDC} {message}")
-    elif level == LogLevel.INFO:
-        print(f"{bcolors.OKGREEN}INFO:{bcolors.ENDC} {message}")
-    elif level == LogLevel.ERROR:
-        print(f"{bcolors.FAIL}ERROR:{bcolors.ENDC} {message}")
-    else:
-        print(f"UNKNOWN: {message}")
+    def format(self, record):
+        line = f"{self.COLORS.get(record.levelname, '')}{record.levelname}:\033[0m {record.getMessage()}"
+        if getattr(record, "correlation_id", None):
+            line += f" [{record.correlation_id}]"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+# Records are put on a queue by the caller and written to stdout by a background thread, so writing logs never blocks
+# the event loop
+_logger = logging.getLogger("synapse_group_sync")
+_log_level = logging.getLevelName(LOG_LEVEL.upper())
+_logger.setLevel(_log_level if isinstance(_log_level, int) else logging.INFO)
+_logger.propagate = False
+
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JSONFormatter())
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.addFilter(_CorrelationFilter())
+_logger.addHandler(_queue_handler)
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+def is_enabled(level: LogLevel) -> bool:
+    return _logger.isEnabledFor(level.value)
+
+
+# Log message at level. args are %-formatted into message only if the level is enabled, so expensive values should be
+# passed as args (or guarded with is_enabled) rather than formatted in an f-string. fields are added to the JSON line.
+def log(level=LogLevel.INFO, message="", *args, **fields):
+    if not _logger.isEnabledFor(level.value):
+        return
+    _logger.log(level.value, message, *args, extra={"fields": fields} if fields else None)
 
 
 class bcolors:
@@ -67,4 +134,16 @@ def get_user_groups(user_data):
     return user_data.get("groups", [])
 
 
+# Get all rooms mapped to any of the groups
+def get_rooms_for_groups(groups, group_to_rooms):
+    rooms = set()
+    for group in groups:
+        rooms.update(group_to_rooms.get(group, ()))
+    return rooms
+
 
+# Get the rooms granted by remove_groups that none of the user's other groups still grant
+def get_rooms_to_remove(user_groups, remove_groups, group_to_rooms):
+    remove_groups = set(remove_groups)
+    kept_groups = set(user_groups) - remove_groups
+    return get_rooms_for_groups(remove_groups, group_to_rooms) - get_rooms_for_groups(kept_groups, group_to_rooms)
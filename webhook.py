@@ -1,15 +1,14 @@
-import requests
 from fastapi import APIRouter, Request, HTTPException
 
-from config import MATRIX_ADMIN_TOKEN, IDP_GROUP_TO_ROOM, MATRIX_URL, LOG_LEVEL
-from utils import verify_secret, get_user, get_user_id, get_matrix_user, get_user_groups, bcolors
-from synapse.room import add_to_room, remove_from_room
+from utils import verify_secret, get_user, get_user_id, get_matrix_user, get_user_groups, get_rooms_for_groups, \
+    get_rooms_to_remove
+from utilities import jobs, room_mapping
 
 router = APIRouter()
 
 
-# Adds a user to a room in Synapse (does not remove users)
-@router.post("/sync/matrix", tags=["sync"])
+# Queues adding a user to rooms in Synapse (does not remove users)
+@router.post("/sync/matrix", tags=["sync"], status_code=202)
 async def matrix_sync(request: Request):
     data = await request.json()
 
@@ -24,15 +23,15 @@ async def matrix_sync(request: Request):
     user_groups = get_user_groups(user)
 
     # Add User to Rooms
-    for group, rooms in IDP_GROUP_TO_ROOM.items():
-        if group in user_groups:
-            for room_id in rooms:
-                status = add_to_room(matrix_user, room_id)
-    return {"status": "processing sync..."}
+    group_to_rooms = room_mapping.get().group_to_rooms
+    job = jobs.submit(
+        ("join", matrix_user, room_id) for room_id in sorted(get_rooms_for_groups(user_groups, group_to_rooms))
+    )
+    return {"status": "processing sync...", "job_id": job.id}
 
 
-# Removes a user from a room in Synapse
-@router.post("/sync/matrix/remove", tags=["sync"])
+# Queues removing a user from rooms in Synapse
+@router.post("/sync/matrix/remove", tags=["sync"], status_code=202)
 async def matrix_sync_remove(request: Request):
     data = await request.json()
 
@@ -51,20 +50,11 @@ async def matrix_sync_remove(request: Request):
     if not remove_groups:
         raise HTTPException(status_code=400, detail="No remove_groups provided")
 
-    rooms_to_remove = []
-    for group, rooms in IDP_GROUP_TO_ROOM.items():
-        if group in remove_groups:
-            for room_id in rooms:
-                # Check if the user is allowed to be in the room because of another group
-                allowed = False
-                for other_group, other_rooms in IDP_GROUP_TO_ROOM.items():
-                    if other_group != group and other_group in user_groups and room_id in other_rooms:
-                        allowed = True
-                        break
-                if not allowed:
-                    rooms_to_remove.append(room_id)
-
-    for room_id in rooms_to_remove:
-        status = remove_from_room(matrix_user, room_id)
-
-    return {"status": "processing sync..."}
\ No newline at end of file
+    # Rooms the user is still allowed in because of another group are kept
+    group_to_rooms = room_mapping.get().group_to_rooms
+    job = jobs.submit(
+        ("kick", matrix_user, room_id)
+        for room_id in sorted(get_rooms_to_remove(user_groups, remove_groups, group_to_rooms))
+    )
+
+    return {"status": "processing sync...", "job_id": job.id}
\ No newline at end of file